@@ -10,13 +10,32 @@ mkdir -p assets
 
 echo "Creating zip of data sets..."
 for folder in data/*/; do
+    # the GeoParquet release files are zipped per source below
+    if [ "$folder" = "data/geoparquet/" ]; then
+        continue
+    fi
+    # per-source splits of drug_data.jsonl and geocoded_data.jsonl made by analyze
+    if [ "$folder" = "data/partitions/" ]; then
+        continue
+    fi
     echo "Processing $folder ..."
-    zip -rv9 assets/"$(basename "$folder")".zip "$folder"
+    # skip the preprocessed spatial caches, they are rebuilt from the TIGER zips
+    zip -rv9 assets/"$(basename "$folder")".zip "$folder" -x "*/cache/*"
+done
+
+echo "Creating zips of GeoParquet release files..."
+for folder in data/geoparquet/data_source=*/; do
+    source="$(basename "$folder")"
+    # parquet is already compressed, store only
+    zip -rv0 assets/"${source#data_source=}"_geoparquet.zip "$folder"
 done
 
 echo "Copying spatial join form csv files to assets"
 cp data/*_wide_form.csv assets/
 
+echo "Copying slim csv files to assets"
+cp data/*_slim.csv assets/
+
 echo "Copying extracted drug output csv file to assets"
 cp data/drug_output.csv assets/
 
@@ -3,72 +3,163 @@
 It is responsible for combining the data from the different sources and
 converting into wide format for analysis.
 
+The geocoded and drug results of all sources share one file each, so they are
+first split by source (see `partition_artifacts`) and each source only reads
+its own part.
+
 You can actually run this as a script directly from the command line if you cloned the repo.
 """
 
-from collections import defaultdict
+import contextlib
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Callable, Generator, Optional
 
+import numpy as np
+import orjson
 import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import BaseModel, PrivateAttr
 
-from opendata_pipeline import manage_config, models
+from opendata_pipeline import analyze_polars, dates, manage_config, models
 from opendata_pipeline.utils import console
 
+PARTITION_DIR = Path("data") / "partitions"
+"""Where the per-source parts of the shared artifacts are written."""
+
+ARTIFACTS = {"geocoded": "geocoded_data.jsonl", "drug": "drug_data.jsonl"}
+"""The artifacts shared by all sources (tagged with `data_source`) and their files."""
+
+INDICATOR_DTYPE = pd.ArrowDtype(pa.bool_())
+"""Drug indicator columns: Arrow booleans, bit-packed."""
+
+WIDE_METADATA_KEY = b"opendata_pipeline"
+"""Schema metadata key of the wide-form Parquet files."""
+
+MEMORY_PER_INPUT_BYTE = 6
+"""Rough peak memory of analyzing a source per byte of its input files."""
+
+MEMORY_HEADROOM = 0.8
+"""Share of the available memory the running sources may use by default."""
+
+ENGINES = ("pandas", "polars")
+"""The analyze engines (see `analyze_polars`)."""
+
+FLOAT_TOLERANCE = 1e-14
+"""Relative difference of floats the engines' parity check allows."""
+
+
+def partition_path(artifact: str, source: models.DataSource) -> Path:
+    """The file with a source's part of an artifact."""
+    key = source.name.replace(" ", "_").lower()
+    return PARTITION_DIR / artifact / f"data_source={key}" / "part-0.jsonl"
+
+
+def partition_artifacts(settings: models.Settings) -> None:
+    """Split the shared artifacts by source in a single pass over each.
+
+    Lines are copied as is, but column types are inferred per part (see
+    `read_partition`), so they may differ from inferring them over the whole
+    file. Every source gets a part, maybe empty.
+
+    Args:
+        settings (models.Settings): The settings.
+    """
+    for artifact, filename in ARTIFACTS.items():
+        path = Path("data") / filename
+        with contextlib.ExitStack() as stack:
+            parts = {}
+            for source in settings.sources:
+                part_path = partition_path(artifact, source)
+                part_path.parent.mkdir(parents=True, exist_ok=True)
+                parts[source.name] = stack.enter_context(open(part_path, "wb"))
+            if not path.is_file():
+                console.log(f"[yellow]{path} not found, no {artifact} data")
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    part = parts.get(orjson.loads(line)["data_source"])
+                    if part is not None:
+                        part.write(line)
+        console.log(f"Split {path} by data source")
+
+
+def read_partition(
+    artifact: str, source: models.DataSource, id_column: str, ids: pd.Index
+) -> pd.DataFrame:
+    """Read a source's part of an artifact, empty if it has none.
+
+    The types of the other columns are inferred from the part alone, but the
+    ID column is read as text and typed like the records' index, so whether it
+    joins to the records doesn't depend on the other sources' IDs.
+
+    Args:
+        artifact (str): The artifact (see `ARTIFACTS`).
+        source (models.DataSource): The source.
+        id_column (str): The column holding the `CaseIdentifier`.
+        ids (pd.Index): The records' index.
+
+    Returns:
+        pd.DataFrame: The source's part, indexed by `CaseIdentifier`.
+    """
+    path = partition_path(artifact, source)
+    if path.stat().st_size == 0:
+        return pd.DataFrame(index=pd.Index([], name="CaseIdentifier"))
+    df = pd.read_json(
+        path, lines=True, orient="records", typ="frame", dtype={id_column: str}
+    )
+    df = df.rename(columns={id_column: "CaseIdentifier"}).set_index("CaseIdentifier")
+    # IDs that can't be typed like the records' stay text and join nothing
+    with contextlib.suppress(TypeError, ValueError):
+        df.index = df.index.astype(ids.dtype)
+    return df
+
 
-def read_geocoded_data(source: models.DataSource) -> pd.DataFrame:
+def read_geocoded_data(source: models.DataSource, ids: pd.Index) -> pd.DataFrame:
     """Reads the geocoded data from the data directory.
 
     Sets the index to `CaseIdentifier`, and handles some minor column renaming.
 
-    Only returns the data for the given source (i.e. filtered).
+    Only returns the data for the given source (i.e. its partition).
 
     Args:
         source (models.DataSource): The source to read.
+        ids (pd.Index): The records' index (see `read_partition`).
 
     Returns:
         pd.DataFrame: The geocoded data.
     """
-    # expects geocoding to be done and file to be in
+    # expects geocoding to be done and `partition_artifacts` to have split
     # data/geocoded_data.jsonl
-    # returns filtered data to save memory
-    df = pd.read_json(
-        Path("data") / "geocoded_data.jsonl",
-        lines=True,
-        orient="records",
-        typ="frame",
-    ).set_index("CaseIdentifier")
+    df = read_partition("geocoded", source, "CaseIdentifier", ids)
+    if df.empty:
+        return df
     # column we set to data source name --> `data_source`
-    filt_df = df[df["data_source"] == source.name].drop(columns=["data_source"])
+    filt_df = df.drop(columns=["data_source"])
     dff = filt_df.rename(columns={col: f"geocoded_{col}" for col in filt_df.columns})
     return dff
 
 
-def read_drug_data(source: models.DataSource) -> pd.DataFrame:
+def read_drug_data(source: models.DataSource, ids: pd.Index) -> pd.DataFrame:
     """Reads the drug data from the data directory.
 
     Sets the index to `CaseIdentifier`/`record_id`, and handles some minor column renaming.
 
-    Only returns the data for the given source (i.e. filtered).
+    Only returns the data for the given source (i.e. its partition).
 
     Args:
         source (models.DataSource): The source to read.
+        ids (pd.Index): The records' index (see `read_partition`).
 
     Returns:
         pd.DataFrame: The drug data.
     """
-    df = (
-        pd.read_json(
-            Path("data") / "drug_data.jsonl",
-            lines=True,
-            orient="records",
-            typ="frame",
-        )
-        .rename(columns={"row_id": "CaseIdentifier"})
-        .set_index("CaseIdentifier")
-    )
-    # column we set to data source name --> `data_source`
-    filt_df = df[df["data_source"] == source.name].copy()
-    return filt_df
+    return read_partition("drug", source, "row_id", ids)
 
 
 def join_geocoded_data(base_df: pd.DataFrame, geo_df: pd.DataFrame) -> pd.DataFrame:
@@ -111,6 +202,9 @@ def add_death_date_breakdowns(
 ) -> pd.DataFrame:
     """Adds death date breakdowns to the data IN PLACE.
 
+    The date field is parsed as the source declares (`date_format` or
+    `date_unit`), once per distinct value (see `dates.parse_with_breakdowns`).
+
     Args:
         df (pd.DataFrame): The records dataframe.
         source (models.DataSource): The source config
@@ -118,56 +212,148 @@ def add_death_date_breakdowns(
     Returns:
         pd.DataFrame: The records dataframe with death date breakdowns added.
     """
-    date_col = source.date_field
-    # some sources are Unix timestamps
-    if source.name in ("Milwaukee County", "Sacramento County", "Connecticut"):
-        df[date_col] = pd.to_datetime(df[date_col], unit="ms")
-    else:
-        df[date_col] = pd.to_datetime(df[date_col])
-
+    columns = dates.parse_with_breakdowns(
+        df[source.date_field],
+        prefix="death",
+        date_format=source.date_format,
+        date_unit=source.date_unit,
+    )
     # now add breakdowns with appropriate names
-    df["death_day"] = df[date_col].dt.day
-    df["death_month"] = df[date_col].dt.month_name()
-    df["death_month_num"] = df[date_col].dt.month
-    df["death_year"] = df[date_col].dt.year
-    df["death_day_of_week"] = df[date_col].dt.day_name()
-    df["death_day_is_weekend"] = df[date_col].dt.day_of_week > 4
-    df["death_day_week_of_year"] = df[date_col].dt.isocalendar().week
+    for col in columns.columns:
+        df[col] = columns[col]
     return df
 
 
+def drug_flag_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """Lists the flags each drug result sets, in the order they are set.
+
+    A result sets its search term, then `<search_field>_matched`, then a
+    `<META>_meta` flag per pipe delimited metadata value. Fields and metadata
+    are factorized, so the names are only built once per distinct value.
+
+    Args:
+        df (pd.DataFrame): The drug data, `CaseIdentifier` as a column.
+
+    Returns:
+        pd.DataFrame: One row per flag with the result's `row` position, the
+            flag's `seq` within the result and its `key` (the column name).
+    """
+    rows = np.arange(len(df))
+    terms = pd.DataFrame({"row": rows, "seq": 0, "key": df["search_term"].to_numpy()})
+
+    # need to rename so doesn't overwrite on joining to source data
+    field_codes, fields = pd.factorize(df["search_field"], use_na_sentinel=False)
+    field_keys = np.array(
+        [f"{field.replace(' ', '_')}_matched" for field in fields], dtype=object
+    )
+    matched = pd.DataFrame({"row": rows, "seq": 1, "key": field_keys[field_codes]})
+
+    # metadata binary flags, assumes metadata is pipe delimited
+    # uses "group" to avoid potential column name conflicts
+    meta_codes, metas = pd.factorize(df["metadata"], use_na_sentinel=False)
+    meta_keys = [
+        [f"{meta.upper()}_meta" for meta in value.split("|")]
+        if isinstance(value, str) and value
+        else []
+        for value in metas
+    ]
+    key_counts = np.array([len(keys) for keys in meta_keys], dtype=np.int64)
+    key_starts = np.cumsum(key_counts) - key_counts
+    flat_keys = np.array([key for keys in meta_keys for key in keys], dtype=object)
+    # gather each result's metadata flags from the flat list
+    counts = key_counts[meta_codes]
+    seq = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    meta = pd.DataFrame(
+        {
+            "row": np.repeat(rows, counts),
+            "seq": 2 + seq,
+            "key": flat_keys[np.repeat(key_starts[meta_codes], counts) + seq],
+        }
+    )
+    return pd.concat([terms, matched, meta], ignore_index=True)
+
+
+def drug_flag_matrix(df: pd.DataFrame) -> tuple[pd.Index, pd.Index, np.ndarray]:
+    """One-hot encodes the flags each case sets.
+
+    Args:
+        df (pd.DataFrame): The drug data.
+
+    Returns:
+        tuple[pd.Index, pd.Index, np.ndarray]: The cases in order of first
+            appearance, the flags in the order a case-by-case pass would first
+            set them, and a boolean (case, flag) matrix.
+    """
+    # expects drug_df to have CaseIdentifier as index
+    df = df.reset_index()
+    case_codes, cases = pd.factorize(df["CaseIdentifier"], use_na_sentinel=False)
+    flags = drug_flag_keys(df)
+    flag_cases = case_codes[flags["row"].to_numpy()]
+    # a column's position is where it is first set, case by case
+    order = np.lexsort((flags["seq"].to_numpy(), flags["row"].to_numpy(), flag_cases))
+    key_codes, keys = pd.factorize(
+        flags["key"].to_numpy()[order], use_na_sentinel=False
+    )
+
+    # one-hot from the (case, flag) coordinates
+    matched = np.zeros((len(cases), len(keys)), dtype=bool)
+    matched[flag_cases[order], key_codes] = True
+    return pd.Index(cases, name="CaseIdentifier"), pd.Index(keys), matched
+
+
 def make_wide(df: pd.DataFrame) -> pd.DataFrame:
     """Converts the drug data from long to wide format.
 
+    Each case gets a binary flag (1, missing if not set) for every search term,
+    search field and metadata value it matched. Cases are in order of first
+    appearance and columns in the order a case-by-case pass would first set
+    them. Columns set for every case are integers, the rest floats.
+
     Args:
         df (pd.DataFrame): The drug data.
 
     Returns:
         pd.DataFrame: The drug data in wide format.
     """
-    # expects drug_df to have CaseIdentifier as index
-    records: dict[str, dict[str, int]] = {}
-    for row in df.reset_index().to_dict(orient="records"):
-        # binary flag for each search term
-        if row["CaseIdentifier"] not in records:
-            records[row["CaseIdentifier"]] = defaultdict(int)
-        records[row["CaseIdentifier"]][row["search_term"]] = 1
-        # binary flag for search field
-        # need to rename so doesn't overwrite on joining to source data
-        records[row["CaseIdentifier"]][
-            f"{row['search_field'].replace(' ', '_')}_matched"
-        ] = 1
-        # metadata binary flags, assumes metadata is pipe delimited
-        # uses "group" to avoid potential column name conflicts
-        if row["metadata"]:
-            for meta in row["metadata"].split("|"):
-                records[row["CaseIdentifier"]][f"{meta.upper()}_meta"] = 1
-
-    flat_records = [{"CaseIdentifier": k, **v} for k, v in records.items()]
-    wide_df = pd.DataFrame(flat_records).set_index("CaseIdentifier")
+    cases, keys, matched = drug_flag_matrix(df)
+    columns: dict = {}
+    for i, key in enumerate(keys):
+        column = matched[:, i]
+        if column.all():
+            columns[key] = np.ones(len(cases), dtype=np.int64)
+        else:
+            columns[key] = np.where(column, 1.0, np.nan)
+    wide_df = pd.DataFrame(
+        {"CaseIdentifier": cases, **columns}, columns=["CaseIdentifier", *keys]
+    ).set_index("CaseIdentifier")
     return wide_df
 
 
+def make_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts the drug data to wide format with bit-packed boolean flags.
+
+    Same cases and columns as `make_wide`, but every flag is an Arrow boolean
+    column (one bit per case), False where not set.
+
+    Args:
+        df (pd.DataFrame): The drug data.
+
+    Returns:
+        pd.DataFrame: The drug indicators.
+    """
+    cases, keys, matched = drug_flag_matrix(df)
+    columns = {
+        key: pd.array(pa.array(matched[:, i]), dtype=INDICATOR_DTYPE)
+        for i, key in enumerate(keys)
+    }
+    return pd.DataFrame(columns, index=cases, columns=keys)
+
+
+def is_indicator(column: pd.Series) -> bool:
+    """Whether a column is a drug indicator (see `make_indicators`)."""
+    return column.dtype == INDICATOR_DTYPE
+
+
 def merge_wide_drugs_to_records(
     base_df: pd.DataFrame, wide_drug_df: pd.DataFrame
 ) -> pd.DataFrame:
@@ -219,6 +405,65 @@ def combine(
         return joined_df
 
 
+def merge_indicators(
+    base_df: pd.DataFrame, indicator_df: pd.DataFrame
+) -> tuple[pd.DataFrame, list[str]]:
+    """Merges the drug indicators to the base data (on index).
+
+    Records without drug results get False flags.
+
+    Args:
+        base_df (pd.DataFrame): The base data.
+        indicator_df (pd.DataFrame): The drug indicators.
+
+    Returns:
+        tuple[pd.DataFrame, list[str]]: The joined data, and the flags that
+            `make_wide` + `merge_wide_drugs_to_records` would have left as
+            integers (set for every case and every record).
+    """
+    merged = merge_wide_drugs_to_records(base_df=base_df, wide_drug_df=indicator_df)
+    integer_columns = []
+    for col in indicator_df.columns:
+        if col not in merged.columns:
+            continue
+        if indicator_df[col].all() and merged[col].notna().all():
+            integer_columns.append(col)
+        merged[col] = merged[col].fillna(False)
+    return merged, integer_columns
+
+
+def combine_indicators(
+    base_df: pd.DataFrame,
+    geo_df: pd.DataFrame,
+    drug_df: pd.DataFrame,
+) -> tuple[pd.DataFrame, list[str]]:
+    """Combines the data into a single dataframe, drug flags as indicators.
+
+    Like `combine`, but with `make_indicators` and `merge_indicators`.
+
+    Args:
+        base_df (pd.DataFrame): The base data.
+        geo_df (pd.DataFrame): The geocoded data.
+        drug_df (pd.DataFrame): The drug data.
+
+    Returns:
+        tuple[pd.DataFrame, list[str]]: The combined data, and the integer flags
+            (see `merge_indicators`).
+    """
+    records_indicators, integer_columns = merge_indicators(
+        base_df=base_df, indicator_df=make_indicators(df=drug_df)
+    )
+    if geo_df.empty:
+        return records_indicators, integer_columns
+    joined_df = join_geocoded_data(base_df=records_indicators, geo_df=geo_df)
+    return joined_df, integer_columns
+
+
+def clean_column_name(col: str) -> str:
+    """Lowercases a column name and replaces spaces with underscores."""
+    return col.lower().replace(" ", "_")
+
+
 def cleanup_columns(df: pd.DataFrame):
     """Cleans up the column names.
 
@@ -227,82 +472,588 @@ def cleanup_columns(df: pd.DataFrame):
     """
     # drop columns we don't need?
     # lowercase columns
-    return df.rename(columns={col: col.lower().replace(" ", "_") for col in df.columns})
+    return df.rename(columns={col: clean_column_name(col) for col in df.columns})
 
 
-def handle_mil_eventdate(x: str):
-    if pd.isna(x):
-        return None
-    else:
-        try:
-            return pd.to_datetime(x).strftime("%Y-%m-%d")
-        except:
+def densify(df: pd.DataFrame, integer_columns: list[str]) -> pd.DataFrame:
+    """Converts the drug indicators back to the dense wide-form values.
+
+    Set flags become 1 and the rest missing, as floats, or as integers for
+    `integer_columns` (set for every record).
+
+    Args:
+        df (pd.DataFrame): The data with drug indicators.
+        integer_columns (list[str]): The flags to write as integers.
+
+    Returns:
+        pd.DataFrame: The data as `combine` would have built it.
+    """
+    dense = {}
+    for col in df.columns:
+        if not is_indicator(df[col]):
+            continue
+        flags = df[col].to_numpy(dtype=bool)
+        if col in integer_columns:
+            dense[col] = np.ones(len(df), dtype=np.int64)
+        else:
+            dense[col] = np.where(flags, 1.0, np.nan)
+    return df.assign(**dense)
+
+
+def write_wide_parquet(
+    df: pd.DataFrame, path: Path, integer_columns: list[str]
+) -> None:
+    """Writes the wide-form data to Parquet, drug indicators as boolean columns.
+
+    The indicator and integer flag names are kept in the schema metadata, so
+    `read_dense_wide` can rebuild the dense form.
+
+    Args:
+        df (pd.DataFrame): The wide-form data with drug indicators.
+        path (Path): The Parquet file.
+        integer_columns (list[str]): The flags to write as integers when dense.
+    """
+    df = df.reset_index()
+    # mixed type object columns (e.g. numeric and text ZIP codes) are kept as text
+    for col in df.columns:
+        if df[col].dtype == object:
             try:
-                return pd.to_datetime(x.split(" ")[0].strip()).strftime("%Y-%m-%d")
-            except:
-                return None
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = df[col].map(
+                    lambda value: (
+                        value if value is None or pd.isna(value) else str(value)
+                    )
+                )
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = {
+        "indicators": [col for col in df.columns if is_indicator(df[col])],
+        "integer_indicators": integer_columns,
+    }
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), WIDE_METADATA_KEY: orjson.dumps(meta)}
+    )
+    pq.write_table(table, path)
 
 
-def run(settings: models.Settings) -> None:
-    """Runs the data processing.
+def read_wide_metadata(path: Path) -> dict[str, list[str]]:
+    """Reads the indicator and integer flag names of a wide-form Parquet file."""
+    metadata = pq.read_schema(path).metadata or {}
+    if WIDE_METADATA_KEY not in metadata:
+        return {"indicators": [], "integer_indicators": []}
+    return orjson.loads(metadata[WIDE_METADATA_KEY])
+
+
+def to_dense_wide(df: pd.DataFrame, meta: dict[str, list[str]]) -> pd.DataFrame:
+    """Converts wide-form data read from Parquet (maybe only some columns) to the dense wide form.
 
     Args:
-        settings (models.Settings): The settings.
+        df (pd.DataFrame): The data as read from Parquet.
+        meta (dict[str, list[str]]): The file's metadata (see `read_wide_metadata`).
+
+    Returns:
+        pd.DataFrame: The dense wide-form data (see `densify`).
+    """
+    indicators = [col for col in meta["indicators"] if col in df.columns]
+    df = df.astype({col: INDICATOR_DTYPE for col in indicators})
+    return densify(df, meta["integer_indicators"])
+
+
+def read_dense_wide(path: Path) -> pd.DataFrame:
+    """Reads a wide-form Parquet file into the dense wide form (see `densify`)."""
+    return to_dense_wide(pd.read_parquet(path), read_wide_metadata(path))
+
+
+def iter_dense_wide(
+    path: Path, batch_size: int, columns: Optional[list[str]] = None
+) -> Generator[pd.DataFrame, None, None]:
+    """Streams a wide-form Parquet file in the dense wide form, in batches.
+
+    Args:
+        path (Path): The Parquet file.
+        batch_size (int): Records per batch.
+        columns (Optional[list[str]]): Only read these columns, default all.
+
+    Yields:
+        pd.DataFrame: The dense wide-form data of each batch.
+    """
+    meta = read_wide_metadata(path)
+    for batch in pq.ParquetFile(path).iter_batches(
+        batch_size=batch_size, columns=columns
+    ):
+        yield to_dense_wide(batch.to_pandas(), meta)
+
+
+def missing_integer_columns(df: pd.DataFrame) -> list[str]:
+    """The integer columns of the wide-form data with missing values."""
+    return [
+        col
+        for col in df.columns
+        if pd.api.types.is_integer_dtype(df[col].dtype) and df[col].hasnans
+    ]
+
+
+def read_missing_integer_columns(path: Path) -> list[str]:
+    """The integer columns of a wide-form Parquet file with missing values."""
+    schema = pq.read_schema(path)
+    integers = [field.name for field in schema if pa.types.is_integer(field.type)]
+    table = pq.read_table(path, columns=integers)
+    return [col for col in integers if table.column(col).null_count]
+
+
+def publish_types(df: pd.DataFrame, missing_integers: list[str]) -> pd.DataFrame:
+    """Casts the integer columns with missing values to floats.
+
+    The wide-form file has always been written from a CSV round trip, which
+    reads such columns back as floats (`46.0`), so they are published that way.
+
+    Args:
+        df (pd.DataFrame): The dense wide-form data.
+        missing_integers (list[str]): The columns to cast (see
+            `missing_integer_columns`).
+
+    Returns:
+        pd.DataFrame: The data typed as the wide-form file publishes it.
+    """
+    return df.astype({col: "float64" for col in missing_integers if col in df.columns})
+
+
+class SourceAnalysis(BaseModel):
+    """Outcome and timing of one source's analysis."""
+
+    source: str
+    records: int = 0
+    steps: dict[str, float] = {}
+    """Seconds spent in each step."""
+    error: Optional[str] = None
+    """The traceback, if the analysis failed."""
+
+    _started: float = PrivateAttr(default_factory=time.perf_counter)
+
+    @property
+    def elapsed_seconds(self) -> float:
+        """Total seconds spent."""
+        return sum(self.steps.values())
+
+    def step(self, name: str) -> None:
+        """Record the seconds since the previous step (or the start) as `name`."""
+        now = time.perf_counter()
+        self.steps[name] = now - self._started
+        self._started = now
+
+
+def build_wide(
+    data_source: models.DataSource, result: SourceAnalysis
+) -> tuple[pd.DataFrame, list[str]]:
+    """Builds a source's wide-form data and writes its analysis step files.
+
+    Args:
+        data_source (models.DataSource): The source config.
+        result (SourceAnalysis): Where the record count and step timings go.
+
+    Returns:
+        tuple[pd.DataFrame, list[str]]: The wide-form data with drug
+            indicators, and the flags to write as integers (see `densify`).
+    """
+    records_df = read_records(source=data_source)
+    result.records = len(records_df)
+    console.log(f"Read {len(records_df)} records from {data_source.records_filename}")
+
+    add_death_date_breakdowns(df=records_df, source=data_source)
+    # a little hard coding needed
+    if data_source.name == "Milwaukee County":
+        # overwrite column with cleaned up version
+        records_df["EventDate"] = dates.normalize(records_df["EventDate"])
+        records_df.drop_duplicates(
+            subset=["CaseNum"],
+            keep="first",
+        )
+    console.log("Added death date breakdowns to records")
+
+    drug_df = read_drug_data(source=data_source, ids=records_df.index)
+    console.log(f"Read {len(drug_df)} drug records for {data_source.name}")
+
+    geocoded_df = read_geocoded_data(source=data_source, ids=records_df.index)
+    if not geocoded_df.empty:
+        console.log(f"Read {len(geocoded_df)} geocoded records for {data_source.name}")
+    result.step("read")
+
+    # write a file for each analysis step for the data source
+    # written into a folder for the data source so that we can zip
+    data_dir = Path("data") / data_source.name.replace(" ", "_")
+    data_dir.mkdir(exist_ok=True)
+    records_df.reset_index().to_csv(data_dir / "records.csv", index=False)
+    drug_df.reset_index().to_csv(data_dir / "drug.csv", index=False)
+    if not geocoded_df.empty:
+        geocoded_df.reset_index().to_csv(data_dir / "geocoded.csv", index=False)
+    # eventually add spatial
+    result.step("write steps")
+
+    console.log("Combining data...")
+    combined_df, integer_columns = combine_indicators(
+        base_df=records_df,
+        geo_df=geocoded_df,
+        drug_df=drug_df,
+    )
+    console.log(f"Combined data has {combined_df.shape} shape")
+
+    cleaned_df = cleanup_columns(df=combined_df)
+    integer_columns = [clean_column_name(col) for col in integer_columns]
+    result.step("combine")
+    return cleaned_df, integer_columns
+
+
+def from_polars(df: pl.DataFrame, indicators: list[str]) -> pd.DataFrame:
+    """Converts the polars engine's wide-form data to the pandas engine's layout.
+
+    Args:
+        df (pl.DataFrame): The wide-form data, `CaseIdentifier` first.
+        indicators (list[str]): The drug flags.
+
+    Returns:
+        pd.DataFrame: The data indexed by `CaseIdentifier`, drug flags as indicators.
     """
-    for data_source in settings.sources:
-        records_df = read_records(source=data_source)
+    # unsigned integers only come from the date breakdowns, kept nullable by pandas
+    pdf = df.to_pandas(types_mapper={pa.uint32(): pd.UInt32Dtype()}.get)
+    pdf = pdf.set_index("CaseIdentifier")
+    return pdf.astype({col: INDICATOR_DTYPE for col in indicators})
+
+
+def build_wide_polars(
+    data_source: models.DataSource, result: SourceAnalysis
+) -> tuple[pd.DataFrame, list[str]]:
+    """Builds a source's wide-form data with the polars engine, like `build_wide`.
+
+    Sources with JSON columns mixing text and other values are built with
+    `build_wide` (see `analyze_polars.mixed_type_columns`).
+    """
+    drug_path = partition_path("drug", data_source)
+    geocoded_path = partition_path("geocoded", data_source)
+    paths = [Path("data") / data_source.records_filename, drug_path, geocoded_path]
+    mixed = [col for path in paths for col in analyze_polars.mixed_type_columns(path)]
+    if mixed:
         console.log(
-            f"Read {len(records_df)} records from {data_source.records_filename}"
+            f"[yellow]{data_source.name} has columns mixing text and other values "
+            f"({', '.join(mixed)}), analyzing it with pandas"
         )
+        return build_wide(data_source, result)
+    wide_df, indicators, integer_columns = analyze_polars.build_wide(
+        data_source, drug_path=drug_path, geocoded_path=geocoded_path
+    )
+    result.records = wide_df.height
+    console.log(f"Combined data has {wide_df.shape} shape")
+    result.step("build")
+    df = from_polars(wide_df, indicators)
+    result.step("convert")
+    return df, integer_columns
+
+
+BUILDERS = {"pandas": build_wide, "polars": build_wide_polars}
+"""The wide-form builder of each engine."""
+
 
-        add_death_date_breakdowns(df=records_df, source=data_source)
-        # a little hard coding needed
-        if data_source.name == "Milwaukee County":
-            # overwrite column with cleaned up version
-            records_df["EventDate"] = records_df["EventDate"].apply(
-                handle_mil_eventdate
+def parity_mismatches(
+    expected: tuple[pd.DataFrame, list[str]], actual: tuple[pd.DataFrame, list[str]]
+) -> list[str]:
+    """Compares the wide-form data of two engines as the dense CSV would have it.
+
+    Args:
+        expected (tuple[pd.DataFrame, list[str]]): One engine's data and integer flags.
+        actual (tuple[pd.DataFrame, list[str]]): The other engine's.
+
+    Returns:
+        list[str]: What differs (columns, or the integer flags), empty if nothing.
+    """
+    expected_df = densify(*expected).reset_index()
+    actual_df = densify(*actual).reset_index()
+    if list(expected_df.columns) != list(actual_df.columns):
+        missing = set(expected_df.columns) - set(actual_df.columns)
+        extra = set(actual_df.columns) - set(expected_df.columns)
+        return [f"columns (missing {sorted(missing)}, extra {sorted(extra)})"]
+    if len(expected_df) != len(actual_df):
+        return [f"rows ({len(expected_df)} vs {len(actual_df)})"]
+    mismatches = []
+    for col in expected_df.columns:
+        left, right = expected_df[col], actual_df[col]
+        if left.dtype.kind == "f" and right.dtype.kind == "f":
+            # `pd.read_json` parses some floats a bit off, polars exactly
+            same = np.allclose(
+                left, right, rtol=FLOAT_TOLERANCE, atol=0, equal_nan=True
             )
-            records_df.drop_duplicates(
-                subset=["CaseNum"],
-                keep="first",
+        else:
+            same = left.to_frame().to_csv(index=False) == right.to_frame().to_csv(
+                index=False
             )
-        console.log("Added death date breakdowns to records")
+        if not same:
+            mismatches.append(col)
+    if sorted(expected[1]) != sorted(actual[1]):
+        mismatches.append("integer flags")
+    return mismatches
+
 
-        drug_df = read_drug_data(source=data_source)
-        console.log(f"Read {len(drug_df)} drug records for {data_source.name}")
+def analyze_source(
+    data_source: models.DataSource,
+    dense_csv: bool = False,
+    engine: str = "pandas",
+    check_parity: bool = False,
+) -> SourceAnalysis:
+    """Analyzes one source and writes its files.
 
-        geocoded_df = read_geocoded_data(source=data_source)
-        if not geocoded_df.empty:
-            console.log(
-                f"Read {len(geocoded_df)} geocoded records for {data_source.name}"
+    Args:
+        data_source (models.DataSource): The source config.
+        dense_csv (bool): Also write the dense wide-form CSV (1/missing flags).
+        engine (str): The engine building the wide-form data, `pandas` or `polars`.
+        check_parity (bool): Also build it with the pandas engine and fail if
+            the two differ.
+
+    Raises:
+        ValueError: If `check_parity` finds differences.
+
+    Returns:
+        SourceAnalysis: The record count and step timings.
+    """
+    result = SourceAnalysis(source=data_source.name)
+    if check_parity:
+        expected = build_wide(data_source, SourceAnalysis(source=data_source.name))
+        result.step("parity build")
+    cleaned_df, integer_columns = BUILDERS[engine](data_source, result)
+    if check_parity:
+        mismatches = parity_mismatches(expected, (cleaned_df, integer_columns))
+        if mismatches:
+            raise ValueError(
+                f"The {engine} engine differs from the pandas engine in: "
+                + ", ".join(mismatches)
             )
+        console.log(f"The {engine} engine matches the pandas engine")
+        result.step("parity check")
+
+    console.log("Writing combined data to parquet...")
+    write_wide_parquet(
+        cleaned_df,
+        Path("data") / data_source.temp_wide_parquet_filename,
+        integer_columns,
+    )
+    csv_path = Path("data") / data_source.temp_wide_filename
+    if dense_csv:
+        console.log("Writing combined data to csv...")
+        densify(cleaned_df, integer_columns).reset_index().to_csv(csv_path, index=False)
+    else:
+        # never leave a stale CSV next to the Parquet file
+        csv_path.unlink(missing_ok=True)
+    result.step("write wide")
+    return result
+
+
+def run_source(
+    task: Callable[..., SourceAnalysis], data_source: models.DataSource, *args
+) -> SourceAnalysis:
+    """Runs a task (e.g. `analyze_source`) on one source, returning (not raising) any failure."""
+    try:
+        return task(data_source, *args)
+    except Exception:
+        console.log(f"[red]Analysis of {data_source.name} failed")
+        return SourceAnalysis(source=data_source.name, error=traceback.format_exc())
+
+
+def estimate_memory(data_source: models.DataSource) -> int:
+    """Rough peak memory (bytes) of analyzing a source, from the size of its inputs."""
+    paths = [Path("data") / data_source.records_filename] + [
+        partition_path(artifact, data_source) for artifact in ARTIFACTS
+    ]
+    size = sum(path.stat().st_size for path in paths if path.is_file())
+    return size * MEMORY_PER_INPUT_BYTE
+
+
+def available_memory() -> int | None:
+    """Memory available for new processes (bytes), None if unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
 
-        # write a file for each analysis step for the data source
-        # written into a folder for the data source so that we can zip
-        data_dir = Path("data") / data_source.name.replace(" ", "_")
-        data_dir.mkdir(exist_ok=True)
-        records_df.reset_index().to_csv(data_dir / "records.csv", index=False)
-        drug_df.reset_index().to_csv(data_dir / "drug.csv", index=False)
-        if not geocoded_df.empty:
-            geocoded_df.reset_index().to_csv(data_dir / "geocoded.csv", index=False)
-        # eventually add spatial
-
-        console.log("Combining data...")
-        combined_df = combine(
-            base_df=records_df,
-            geo_df=geocoded_df,
-            drug_df=drug_df,
+
+def run_parallel(
+    task: Callable[..., SourceAnalysis],
+    sources: list[models.DataSource],
+    workers: int,
+    memory_budget: int | None,
+    *args,
+) -> list[SourceAnalysis]:
+    """Runs a task on each source in a process pool, within a memory budget.
+
+    A source is only started while the estimated memory of the running sources
+    (see `estimate_memory`) fits the budget, though one always runs. When a
+    worker dies (e.g. out of memory) the pool goes down with every running
+    source, so those are retried one at a time and only the one that dies
+    again fails.
+
+    Args:
+        task (Callable[..., SourceAnalysis]): The task, e.g. `analyze_source`.
+        sources (list[models.DataSource]): The sources to run it on.
+        workers (int): Max sources run at once.
+        memory_budget (int | None): Bytes the running sources may use, no limit
+            if None.
+        *args: More arguments of the task.
+
+    Returns:
+        list[SourceAnalysis]: The results, in source order.
+    """
+    estimates = {source.name: estimate_memory(source) for source in sources}
+    queue = list(sources)
+    # sources running when a worker died, each retried alone to find the culprit
+    suspects: set[str] = set()
+    results: dict[str, SourceAnalysis] = {}
+    pool = ProcessPoolExecutor(max_workers=workers)
+    running: dict[Future[SourceAnalysis], models.DataSource] = {}
+    try:
+        while queue or running:
+            in_use = sum(estimates[source.name] for source in running.values())
+            # start whatever fits, in order, the first source always fits
+            for source in list(queue):
+                if (
+                    len(running) >= workers
+                    or running
+                    and (
+                        source.name in suspects
+                        or any(other.name in suspects for other in running.values())
+                    )
+                ):
+                    break
+                fits = memory_budget is None or (
+                    in_use + estimates[source.name] <= memory_budget
+                )
+                if running and not fits:
+                    continue
+                queue.remove(source)
+                running[pool.submit(run_source, task, source, *args)] = source
+                in_use += estimates[source.name]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if not any(
+                isinstance(future.exception(), BrokenProcessPool) for future in done
+            ):
+                for future in done:
+                    source = running.pop(future)
+                    results[source.name] = future.result()
+                continue
+            # the pool is gone and every running source with it
+            casualties = list(running.values())
+            running.clear()
+            pool.shutdown(cancel_futures=True)
+            pool = ProcessPoolExecutor(max_workers=workers)
+            if len(casualties) == 1:
+                results[casualties[0].name] = SourceAnalysis(
+                    source=casualties[0].name,
+                    error="The worker process died (out of memory?)",
+                )
+            else:
+                suspects.update(source.name for source in casualties)
+                queue = casualties + queue
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return [results[source.name] for source in sources]
+
+
+def run_sources(
+    task: Callable[..., SourceAnalysis],
+    sources: list[models.DataSource],
+    workers: int,
+    max_memory_gb: Optional[float],
+    *args,
+) -> list[SourceAnalysis]:
+    """Runs a task on each source, in a process pool if more than one worker.
+
+    Args:
+        task (Callable[..., SourceAnalysis]): The task, e.g. `analyze_source`.
+        sources (list[models.DataSource]): The sources to run it on.
+        workers (int): Sources run at once, 1 to run them in turn in this process.
+        max_memory_gb (Optional[float]): Memory the running sources may use,
+            defaults to most of the available memory.
+        *args: More arguments of the task.
+
+    Returns:
+        list[SourceAnalysis]: The results, in source order.
+    """
+    if workers <= 1:
+        return [run_source(task, data_source, *args) for data_source in sources]
+    if max_memory_gb is not None:
+        memory_budget = int(max_memory_gb * 1024**3)
+    else:
+        available = available_memory()
+        memory_budget = (
+            int(available * MEMORY_HEADROOM) if available is not None else None
         )
-        console.log(f"Combined data has {combined_df.shape} shape")
+    return run_parallel(task, sources, workers, memory_budget, *args)
 
-        cleaned_df = cleanup_columns(df=combined_df)
 
-        console.log("Writing combined data to csv...")
-        cleaned_df.reset_index().to_csv(
-            Path("data") / data_source.temp_wide_filename, index=False
+def log_source_analyses(results: list[SourceAnalysis]) -> None:
+    """Log the per-source record counts and step timings."""
+    for result in results:
+        if result.error is not None:
+            console.log(f"[bold red]{result.source}[/bold red] failed:\n{result.error}")
+            continue
+        steps = ", ".join(f"{name} {secs:,.1f}s" for name, secs in result.steps.items())
+        console.log(
+            f"[bold]{result.source}[/bold] -> {result.records:,} records in "
+            f"{result.elapsed_seconds:,.1f}s ({steps})"
         )
 
 
+def run(
+    settings: models.Settings,
+    dense_csv: bool = False,
+    workers: int = 1,
+    max_memory_gb: Optional[float] = None,
+    engine: str = "pandas",
+    check_parity: bool = False,
+) -> None:
+    """Runs the data processing.
+
+    The wide-form data of each source is written to Parquet with the drug
+    flags as boolean columns, which the spatial join reads. The dense CSV is
+    only written when `dense_csv` asks for it.
+
+    Sources share no state, so with more than one worker they are analyzed in
+    a process pool (see `run_parallel`). Either way a failing source doesn't
+    stop the others; the run fails at the end.
+
+    Args:
+        settings (models.Settings): The settings.
+        dense_csv (bool): Also write the dense wide-form CSV (1/missing flags).
+        workers (int): Sources analyzed at once, 1 to analyze them in turn
+            in this process.
+        max_memory_gb (Optional[float]): Memory the running sources may use,
+            defaults to most of the available memory.
+        engine (str): The engine building the wide-form data, `pandas` or
+            `polars` (see `analyze_polars`).
+        check_parity (bool): Also build it with the pandas engine and fail the
+            sources where the two differ.
+
+    Raises:
+        ValueError: If the engine is unknown.
+        RuntimeError: If any source failed.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got {engine!r}")
+    partition_artifacts(settings=settings)
+    results = run_sources(
+        analyze_source,
+        settings.sources,
+        workers,
+        max_memory_gb,
+        dense_csv,
+        engine,
+        check_parity,
+    )
+    log_source_analyses(results)
+    failed = [result.source for result in results if result.error is not None]
+    if failed:
+        raise RuntimeError(f"Analysis failed for {', '.join(failed)}")
+
+
 if __name__ == "__main__":
     settings = manage_config.get_local_config()
     run(settings=settings)
@@ -0,0 +1,413 @@
+"""This module is the polars engine of the analyze stage.
+
+It builds the same wide-form data as `analyze.build_wide`, as one lazy polars
+query per source: the records, drug results and geocoded results are scanned,
+the drug results pivoted to one flag per term, field and metadata value, joined
+on `CaseIdentifier` and renamed, and the analysis step files are sunk from the
+same query. The query optimizer only reads the columns each output needs and
+runs the scans, pivot and joins multi-threaded.
+
+A few small queries run first, over single columns: the column types (see
+`coerce_types`), the distinct dates (see `map_distinct`) and the drug flag
+names (see `drug_flag_keys`).
+
+Floats are parsed exactly, where `pd.read_json` is sometimes off in the last
+digit, so floats in the step files may differ from the pandas engine's in that
+digit. Otherwise the step files are formatted as the pandas engine writes them
+(see `to_csv_values`).
+
+JSON columns mixing text with numbers or booleans (e.g. a latitude field
+holding both `45.0` and `"41.5,-72.1"`) are read as text by polars, which
+formats the numbers its own way (`45.0` as `45`), where `pd.read_json` keeps
+each value as parsed. Sources with such columns (see `mixed_type_columns`)
+are analyzed with the pandas engine instead.
+
+Select it with `analyze --engine polars`, and compare it with the pandas
+engine with `--check-parity`.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable
+
+import orjson
+import pandas as pd
+import polars as pl
+
+from opendata_pipeline import dates, models
+
+DISTINCT_KEY = "__distinct_value"
+"""Temporary column holding the raw values in `map_distinct`."""
+
+
+def coerce_types(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Types the columns like `pd.read_json` does.
+
+    Text columns that are all numbers become floats (integers if none is
+    missing), floats that are all whole (and none missing) become integers,
+    and empty columns become floats. Unlike `pd.read_json`, columns named like
+    dates (e.g. `*_time`) are not parsed, only the date field is (see
+    `add_death_date_breakdowns`).
+
+    Args:
+        lf (pl.LazyFrame): The scanned JSON lines.
+
+    Returns:
+        pl.LazyFrame: The retyped data.
+    """
+    schema = lf.collect_schema()
+    checks = []
+    for col, dtype in schema.items():
+        values = pl.col(col)
+        if dtype == pl.String:
+            as_float = values.cast(pl.Float64, strict=False)
+            checks += [
+                (as_float.null_count() == values.null_count()).alias(f"{col}:float"),
+                (values.cast(pl.Int64, strict=False).null_count() == 0).alias(
+                    f"{col}:int"
+                ),
+            ]
+        elif dtype == pl.Float64:
+            checks.append(
+                (
+                    (values.null_count() == 0)
+                    & (values.is_finite() & (values == values.round())).all()
+                ).alias(f"{col}:int")
+            )
+    found = lf.select(checks).collect().row(0, named=True) if checks else {}
+
+    casts = {}
+    for col, dtype in schema.items():
+        if found.get(f"{col}:int"):
+            casts[col] = pl.Int64
+        elif found.get(f"{col}:float") or dtype == pl.Null:
+            casts[col] = pl.Float64
+    return lf.with_columns(pl.col(col).cast(dtype) for col, dtype in casts.items())
+
+
+def mixed_type_columns(path: Path) -> list[str]:
+    """Lists the columns of a JSON lines file holding both text and other values.
+
+    Polars reads such columns as text, so a column is mixed if it is read as
+    text but some line has a value for it that isn't a string (or null).
+
+    Args:
+        path (Path): The JSON lines file.
+
+    Returns:
+        list[str]: The mixed type columns, empty if the file is empty.
+    """
+    if path.stat().st_size == 0:
+        return []
+    schema = pl.scan_ndjson(path, infer_schema_length=None).collect_schema()
+    text = [col for col, dtype in schema.items() if dtype == pl.String]
+    if not text:
+        return []
+    # each line as one value, JSON escapes control characters
+    lines = pl.scan_csv(
+        path, has_header=False, separator="\x1f", quote_char=None, new_columns=["line"]
+    )
+    found = (
+        lines.select(
+            pl.col("line")
+            .str.contains(
+                rf'{pl.escape_regex(orjson.dumps(col).decode())}\s*:\s*[^"\sn]'
+            )
+            .any()
+            .alias(col)
+            for col in text
+        )
+        .collect()
+        .row(0, named=True)
+    )
+    return [col for col in text if found[col]]
+
+
+def scan_json_lines(path: Path) -> pl.LazyFrame | None:
+    """Scans a JSON lines file, typed like `pd.read_json`, None if it's empty."""
+    if path.stat().st_size == 0:
+        return None
+    return coerce_types(pl.scan_ndjson(path, infer_schema_length=None))
+
+
+def to_first(lf: pl.LazyFrame, column: str) -> pl.LazyFrame:
+    """Moves a column first, like setting and resetting the index in pandas."""
+    return lf.select(column, pl.exclude(column))
+
+
+def map_distinct(
+    lf: pl.LazyFrame,
+    column: str,
+    func: Callable[[pd.Series], pd.DataFrame],
+) -> pl.LazyFrame:
+    """Transforms a column once per distinct value, with pandas.
+
+    Args:
+        lf (pl.LazyFrame): The data.
+        column (str): The column.
+        func (Callable[[pd.Series], pd.DataFrame]): Takes the distinct values
+            and returns the new column (same name) and any added columns.
+
+    Returns:
+        pl.LazyFrame: The data with the column replaced and added columns last.
+    """
+    distinct = lf.select(pl.col(column).unique(maintain_order=True)).collect()
+    mapped = pl.from_pandas(func(distinct.to_series().to_pandas()))
+    mapped = mapped.with_columns(distinct.to_series().alias(DISTINCT_KEY))
+    columns = lf.collect_schema().names()
+    added = [col for col in mapped.columns if col not in (column, DISTINCT_KEY)]
+    joined = lf.rename({column: DISTINCT_KEY}).join(
+        mapped.lazy(),
+        on=DISTINCT_KEY,
+        how="left",
+        nulls_equal=True,
+        maintain_order="left",
+    )
+    return joined.select(*columns, *added)
+
+
+def add_death_date_breakdowns(
+    lf: pl.LazyFrame, source: models.DataSource
+) -> pl.LazyFrame:
+    """Parses the date field and adds its breakdowns, like `analyze.add_death_date_breakdowns`.
+
+    The distinct dates are parsed with `dates.parse_with_breakdowns`, so both
+    engines parse them the same way.
+    """
+    return map_distinct(
+        lf,
+        source.date_field,
+        lambda values: dates.parse_with_breakdowns(
+            values,
+            prefix="death",
+            date_format=source.date_format,
+            date_unit=source.date_unit,
+        ).reset_index(drop=True),
+    )
+
+
+def scan_records(source: models.DataSource) -> pl.LazyFrame:
+    """Scans a source's records, with the date breakdowns (and fixes) added.
+
+    Args:
+        source (models.DataSource): The source config.
+
+    Returns:
+        pl.LazyFrame: The records, `CaseIdentifier` first.
+    """
+    lf = scan_json_lines(Path("data") / source.records_filename)
+    lf = add_death_date_breakdowns(to_first(lf, "CaseIdentifier"), source)
+    # a little hard coding needed
+    if source.name == "Milwaukee County":
+        lf = map_distinct(
+            lf, "EventDate", lambda values: dates.normalize(values).to_frame()
+        )
+    return lf
+
+
+def scan_drug_data(path: Path) -> pl.LazyFrame | None:
+    """Scans a source's drug results (`row_id` renamed `CaseIdentifier`), None if none."""
+    lf = scan_json_lines(path)
+    if lf is None:
+        return None
+    return to_first(lf.rename({"row_id": "CaseIdentifier"}), "CaseIdentifier")
+
+
+def scan_geocoded_data(path: Path) -> pl.LazyFrame | None:
+    """Scans a source's geocoded results (columns prefixed `geocoded_`), None if none."""
+    lf = scan_json_lines(path)
+    if lf is None:
+        return None
+    lf = to_first(lf.drop("data_source"), "CaseIdentifier")
+    return lf.rename(lambda col: col if col == "CaseIdentifier" else f"geocoded_{col}")
+
+
+def drug_flag_keys(drug_lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Lists the flags each drug result sets, like `analyze.drug_flag_keys`.
+
+    Args:
+        drug_lf (pl.LazyFrame): The drug results.
+
+    Returns:
+        pl.LazyFrame: One row per flag with its case, the result's `row`
+            position, the flag's `seq` within the result and its `key`.
+    """
+    results = drug_lf.with_row_index("row")
+    terms = results.select(
+        "CaseIdentifier", "row", seq=pl.lit(0, pl.Int64), key=pl.col("search_term")
+    )
+    # need to rename so doesn't overwrite on joining to source data
+    matched = results.select(
+        "CaseIdentifier",
+        "row",
+        seq=pl.lit(1, pl.Int64),
+        key=pl.col("search_field").str.replace_all(" ", "_", literal=True) + "_matched",
+    )
+    # metadata binary flags, assumes metadata is pipe delimited
+    if drug_lf.collect_schema().get("metadata") != pl.String:
+        return pl.concat([terms, matched])
+    meta = (
+        results.filter(pl.col("metadata").is_not_null() & (pl.col("metadata") != ""))
+        .select("CaseIdentifier", "row", key=pl.col("metadata").str.split("|"))
+        .explode("key")
+        .with_columns(
+            seq=2 + pl.int_range(pl.len(), dtype=pl.Int64).over("row"),
+            key=pl.col("key").str.to_uppercase() + "_meta",
+        )
+        .select("CaseIdentifier", "row", "seq", "key")
+    )
+    return pl.concat([terms, matched, meta])
+
+
+def make_indicators(drug_lf: pl.LazyFrame) -> tuple[pl.LazyFrame, list[str]]:
+    """Pivots the drug results to one boolean flag per case and key.
+
+    Args:
+        drug_lf (pl.LazyFrame): The drug results.
+
+    Returns:
+        tuple[pl.LazyFrame, list[str]]: The indicators of each case, and the
+            flags in the order a case-by-case pass would first set them.
+    """
+    flags = drug_flag_keys(drug_lf).with_columns(
+        first_row=pl.col("row").min().over("CaseIdentifier")
+    )
+    keys = (
+        flags.sort("first_row", "row", "seq")
+        .select(pl.col("key").unique(maintain_order=True))
+        .collect()
+        .to_series()
+        .to_list()
+    )
+    indicators = (
+        flags.select("CaseIdentifier", "key", hit=pl.lit(True))
+        .pivot(
+            on="key",
+            on_columns=keys,
+            index="CaseIdentifier",
+            values="hit",
+            aggregate_function="first",
+        )
+        .with_columns(pl.col(keys).fill_null(False))
+    )
+    return indicators, keys
+
+
+def format_datetime(col: str, dtype: pl.Datetime) -> pl.Expr:
+    """Formats a datetime column as `DataFrame.to_csv` writes it.
+
+    The time is left out when every value is at midnight, and written with
+    milliseconds or microseconds when some value has them.
+    """
+    values = pl.col(col)
+    fraction = values.dt.microsecond()
+    zone = "%:z" if dtype.time_zone is not None else ""
+    return (
+        pl.when(((values.dt.truncate("1d") == values) | values.is_null()).all())
+        .then(values.dt.strftime("%Y-%m-%d"))
+        .when((fraction % 1000 != 0).any())
+        .then(values.dt.strftime(f"%Y-%m-%d %H:%M:%S%.6f{zone}"))
+        .when((fraction != 0).any())
+        .then(values.dt.strftime(f"%Y-%m-%d %H:%M:%S%.3f{zone}"))
+        .otherwise(values.dt.strftime(f"%Y-%m-%d %H:%M:%S{zone}"))
+        .alias(col)
+    )
+
+
+def to_csv_values(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Formats the columns as `DataFrame.to_csv` writes them, for the step files.
+
+    Booleans become `True`/`False`, empty text is written like missing values
+    (polars quotes it) and datetimes are formatted by `format_datetime`.
+
+    Args:
+        lf (pl.LazyFrame): The step's data.
+
+    Returns:
+        pl.LazyFrame: The data with those columns as text.
+    """
+    formats = []
+    for col, dtype in lf.collect_schema().items():
+        values = pl.col(col)
+        if dtype == pl.Boolean:
+            formats.append(values.cast(pl.String).str.to_titlecase())
+        elif dtype == pl.String:
+            formats.append(pl.when(values != "").then(values).alias(col))
+        elif isinstance(dtype, pl.Datetime):
+            formats.append(format_datetime(col, dtype))
+    return lf.with_columns(formats)
+
+
+def build_wide(
+    source: models.DataSource, drug_path: Path, geocoded_path: Path
+) -> tuple[pl.DataFrame, list[str], list[str]]:
+    """Builds a source's wide-form data and writes its analysis step files.
+
+    Args:
+        source (models.DataSource): The source config.
+        drug_path (Path): The source's drug results (see `analyze.partition_path`).
+        geocoded_path (Path): The source's geocoded results.
+
+    Returns:
+        tuple[pl.DataFrame, list[str], list[str]]: The wide-form data, its drug
+            flags and the flags set for every record (see `analyze.merge_indicators`).
+    """
+    records = scan_records(source)
+    drug_lf = scan_drug_data(drug_path)
+    geocoded = scan_geocoded_data(geocoded_path)
+
+    # write a file for each analysis step for the data source
+    # written into a folder for the data source so that we can zip
+    data_dir = Path("data") / source.name.replace(" ", "_")
+    data_dir.mkdir(exist_ok=True)
+    steps = {"records": records, "drug": drug_lf, "geocoded": geocoded}
+    empty = pl.LazyFrame({"CaseIdentifier": []})
+    queries = [
+        to_csv_values(lf if lf is not None else empty).sink_csv(
+            data_dir / f"{name}.csv", lazy=True
+        )
+        for name, lf in steps.items()
+        if lf is not None or name == "drug"
+    ]
+
+    wide = records
+    keys: list[str] = []
+    everywhere = pl.LazyFrame({})
+    if drug_lf is not None:
+        indicators, keys = make_indicators(drug_lf)
+        ids = records.select("CaseIdentifier").collect_schema()["CaseIdentifier"]
+        indicators = indicators.with_columns(pl.col("CaseIdentifier").cast(ids))
+        wide = wide.join(
+            indicators, on="CaseIdentifier", how="left", maintain_order="left"
+        )
+        # set for every case and every record, like `make_wide` left them
+        everywhere = pl.concat(
+            [
+                indicators.select(pl.col(keys).all().name.suffix(":case")),
+                wide.select(pl.col(keys).is_not_null().all().name.suffix(":record")),
+            ],
+            how="horizontal",
+        )
+        wide = wide.with_columns(pl.col(keys).fill_null(False))
+    if geocoded is not None:
+        ids = wide.collect_schema()["CaseIdentifier"]
+        wide = wide.join(
+            geocoded.with_columns(pl.col("CaseIdentifier").cast(ids, strict=False)),
+            on="CaseIdentifier",
+            how="left",
+            maintain_order="left",
+        )
+    # `CaseIdentifier` is the index of the pandas engine, so it isn't renamed
+    wide = wide.rename(
+        lambda col: col if col == "CaseIdentifier" else col.lower().replace(" ", "_")
+    )
+
+    *_, wide_df, found = pl.collect_all([*queries, wide, everywhere])
+    flags = [key.lower().replace(" ", "_") for key in keys]
+    integer_columns = [
+        flag
+        for key, flag in zip(keys, flags, strict=True)
+        if found[f"{key}:case"].item() and found[f"{key}:record"].item()
+    ]
+    return wide_df, flags, integer_columns
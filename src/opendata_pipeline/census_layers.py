@@ -0,0 +1,224 @@
+"""This module loads the Census TIGER layers used for spatial joins.
+
+Layers (see `LAYER_FILES`) are downloaded into `data/spatial`:
+
+- tracts and block groups, per state: `tl_2024_{fips}_tract.zip`, `tl_2024_{fips}_bg.zip`
+- ZCTAs, national: `tl_2024_us_zcta520.zip`
+
+Reading a TIGER shapefile zip and reprojecting it to WGS84 is slow, so each zip
+is converted once to a reprojected GeoParquet file in `data/spatial/cache`.
+The cache is keyed by the SHA-256 of the source zip, so replacing the zip (e.g.
+with a new vintage) rebuilds it. Within a run, each layer is loaded at most once.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+from pathlib import Path
+
+import geopandas
+import orjson
+
+from opendata_pipeline.utils import console
+
+TIGER_VINTAGE = 2024
+"""The TIGER/Line vintage (year) of the layers in `data/spatial`."""
+
+SPATIAL_DIR = Path("data") / "spatial"
+"""Where the TIGER zips are downloaded to."""
+
+CACHE_DIR = SPATIAL_DIR / "cache"
+"""Where the preprocessed layers are cached."""
+
+LAYER_FILES = {
+    "tract": "tl_{vintage}_{fips}_tract.zip",
+    "block_group": "tl_{vintage}_{fips}_bg.zip",
+    "zcta": "tl_{vintage}_us_zcta520.zip",
+}
+"""TIGER zip file name for each layer kind."""
+
+NATIONAL_FIPS = "us"
+"""FIPS code national layers are loaded under, whatever the state."""
+
+
+def layer_zip_path(kind: str, fips_code: str) -> Path:
+    """Path of the TIGER zip for a layer kind and state.
+
+    Args:
+        kind (str): The layer kind, a key of `LAYER_FILES`.
+        fips_code (str): The Census state FIPS code (ignored for national layers)
+
+    Returns:
+        Path: The path to the zip in `data/spatial`
+    """
+    name = LAYER_FILES[kind].format(vintage=TIGER_VINTAGE, fips=fips_code)
+    return Path().cwd() / SPATIAL_DIR / name
+
+
+def is_national(kind: str) -> bool:
+    """Whether a layer kind has one national file rather than one per state."""
+    return "{fips}" not in LAYER_FILES[kind]
+
+
+def tract_zip_path(fips_code: str) -> Path:
+    """Path of the TIGER tract zip for a state.
+
+    Args:
+        fips_code (str): The Census state FIPS code (i.e. 17 for Illinois)
+
+    Returns:
+        Path: The path to `tl_{vintage}_{fips}_tract.zip`
+    """
+    return layer_zip_path("tract", fips_code)
+
+
+def file_hash(path: Path) -> str:
+    """SHA-256 of a file, memoized until the file's size or mtime changes."""
+    stat = path.stat()
+    return hash_file_version(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.cache
+def hash_file_version(path: Path, mtime_ns: int, size: int) -> str:
+    """SHA-256 of a file, read in chunks. Use `file_hash` instead."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_paths(source: Path) -> tuple[Path, Path]:
+    """The cached GeoParquet file and its metadata sidecar for a source zip."""
+    cache_dir = Path().cwd() / CACHE_DIR
+    stem = source.name.removesuffix(".zip")
+    return cache_dir / f"{stem}.parquet", cache_dir / f"{stem}.json"
+
+
+def read_cached_layer(source: Path, source_hash: str) -> geopandas.GeoDataFrame | None:
+    """Read the cached layer if it was built from this exact source file."""
+    parquet_path, meta_path = cache_paths(source)
+    if not parquet_path.is_file() or not meta_path.is_file():
+        return None
+    meta = orjson.loads(meta_path.read_bytes())
+    if meta.get("source_sha256") != source_hash:
+        console.log(f"{source.name} changed, rebuilding cached layer")
+        return None
+    return geopandas.read_parquet(parquet_path)
+
+
+def build_cached_layer(source: Path, source_hash: str) -> geopandas.GeoDataFrame:
+    """Read and reproject a TIGER zip, then cache it as GeoParquet."""
+    console.log(f"Preprocessing {source.name} into the spatial cache")
+    layer: geopandas.GeoDataFrame = geopandas.read_file(source).to_crs("EPSG:4326")
+    parquet_path, meta_path = cache_paths(source)
+    parquet_path.parent.mkdir(parents=True, exist_ok=True)
+    layer.to_parquet(parquet_path, index=False)
+    meta_path.write_bytes(
+        orjson.dumps({"source": source.name, "source_sha256": source_hash})
+    )
+    return layer
+
+
+def load_layer(source: Path) -> geopandas.GeoDataFrame:
+    """Load a TIGER layer in WGS84, using the GeoParquet cache when valid.
+
+    Args:
+        source (Path): The TIGER shapefile zip.
+
+    Returns:
+        geopandas.GeoDataFrame: The layer in EPSG:4326.
+    """
+    source_hash = file_hash(source)
+    layer = read_cached_layer(source, source_hash)
+    if layer is None:
+        layer = build_cached_layer(source, source_hash)
+    return layer
+
+
+def load_state_layer(kind: str, fips_code: str) -> geopandas.GeoDataFrame:
+    """Load a layer for a state, memoized per kind and FIPS code.
+
+    Args:
+        kind (str): The layer kind, a key of `LAYER_FILES`.
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+
+    Returns:
+        geopandas.GeoDataFrame: The layer, shared between callers so treat it
+            as read-only. National layers are shared by every state.
+    """
+    # memoized once for national layers, not once per state
+    return load_memoized_layer(kind, NATIONAL_FIPS if is_national(kind) else fips_code)
+
+
+@functools.cache
+def load_memoized_layer(kind: str, fips_code: str) -> geopandas.GeoDataFrame:
+    """Load a layer, memoized per kind and FIPS code. Use `load_state_layer` instead."""
+    return load_layer(layer_zip_path(kind, fips_code))
+
+
+def load_tracts(fips_code: str) -> geopandas.GeoDataFrame:
+    """Load the census tracts for a state, memoized per FIPS code.
+
+    Args:
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+
+    Returns:
+        geopandas.GeoDataFrame: The census tracts geodataframe, shared between
+            callers so treat it as read-only.
+    """
+    return load_state_layer("tract", fips_code)
+
+
+@functools.cache
+def load_clipped_layer(
+    kind: str,
+    fips_code: str,
+    extent: tuple[float, float, float, float] | None = None,
+    county_fips: tuple[str, ...] | None = None,
+) -> geopandas.GeoDataFrame:
+    """Load a layer for a state, restricted to an area of interest.
+
+    The original row labels are kept so they still identify the feature in the
+    full layer. The county filter only applies to layers with a `COUNTYFP`
+    column (not ZCTAs).
+
+    Args:
+        kind (str): The layer kind, a key of `LAYER_FILES`.
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (tuple[float, float, float, float] | None): Keep features intersecting this `(xmin, ymin, xmax, ymax)` box.
+        county_fips (tuple[str, ...] | None): Keep features in these counties.
+
+    Returns:
+        geopandas.GeoDataFrame: The clipped layer, treat as read-only.
+    """
+    layer = load_state_layer(kind, fips_code)
+    if extent is not None:
+        xmin, ymin, xmax, ymax = extent
+        layer = layer.cx[xmin:xmax, ymin:ymax]
+    if county_fips is not None and "COUNTYFP" in layer.columns:
+        layer = layer[layer["COUNTYFP"].isin(county_fips)]
+    console.log(f"Using {len(layer):,} {kind} features for state {fips_code}")
+    return layer
+
+
+def load_clipped_tracts(
+    fips_code: str,
+    extent: tuple[float, float, float, float] | None = None,
+    county_fips: tuple[str, ...] | None = None,
+) -> geopandas.GeoDataFrame:
+    """Load the census tracts for a state, restricted to an area of interest.
+
+    The original row labels are kept so they still identify the tract in the
+    full state layer.
+
+    Args:
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (tuple[float, float, float, float] | None): Keep tracts intersecting this `(xmin, ymin, xmax, ymax)` box.
+        county_fips (tuple[str, ...] | None): Keep tracts in these counties.
+
+    Returns:
+        geopandas.GeoDataFrame: The clipped census tracts, treat as read-only.
+    """
+    return load_clipped_layer("tract", fips_code, extent, county_fips)
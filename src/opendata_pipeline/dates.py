@@ -0,0 +1,143 @@
+"""This module parses the date fields of the records.
+
+Each data source declares how its date field is encoded (see
+`DataSource.date_format` and `DataSource.date_unit`), otherwise the format is
+inferred from the first value.
+
+Dates repeat heavily (many deaths a day, and a date field with a time still
+only has so many distinct values), so every distinct value is parsed once, the
+breakdown columns are computed on the distinct dates in one pass, and the
+results are mapped back to the records.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import pandas as pd
+
+
+def parse_unique(
+    values: pd.Series,
+    date_format: Optional[str] = None,
+    date_unit: Optional[str] = None,
+) -> tuple[pd.DatetimeIndex, pd.Series]:
+    """Parse the distinct values of a date field.
+
+    Args:
+        values (pd.Series): The date field.
+        date_format (Optional[str]): `strftime` format of the values (or `ISO8601`
+            / `mixed`), inferred if None.
+        date_unit (Optional[str]): Unit of numeric epoch values (e.g. `ms`).
+
+    Returns:
+        tuple[pd.DatetimeIndex, pd.Series]: The parsed distinct values (missing
+            values included, as NaT), and each record's position in them.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    if date_unit is not None:
+        parsed = pd.to_datetime(uniques, unit=date_unit)
+    else:
+        parsed = pd.to_datetime(uniques, format=date_format)
+    return pd.DatetimeIndex(parsed), pd.Series(codes, index=values.index)
+
+
+def breakdowns(dates: pd.Series, prefix: str) -> pd.DataFrame:
+    """Day, month, year, weekday and ISO week columns of dates.
+
+    Args:
+        dates (pd.Series): The dates.
+        prefix (str): Prefix of the column names (e.g. `death`).
+
+    Returns:
+        pd.DataFrame: The breakdown columns.
+    """
+    return pd.DataFrame(
+        {
+            f"{prefix}_day": dates.dt.day,
+            f"{prefix}_month": dates.dt.month_name(),
+            f"{prefix}_month_num": dates.dt.month,
+            f"{prefix}_year": dates.dt.year,
+            f"{prefix}_day_of_week": dates.dt.day_name(),
+            f"{prefix}_day_is_weekend": dates.dt.day_of_week > 4,
+            f"{prefix}_day_week_of_year": dates.dt.isocalendar().week,
+        },
+        index=dates.index,
+    )
+
+
+def parse_with_breakdowns(
+    values: pd.Series,
+    prefix: str,
+    date_format: Optional[str] = None,
+    date_unit: Optional[str] = None,
+) -> pd.DataFrame:
+    """Parse a date field and break it down, once per distinct value.
+
+    Args:
+        values (pd.Series): The date field.
+        prefix (str): Prefix of the breakdown column names (e.g. `death`).
+        date_format (Optional[str]): See `parse_unique`.
+        date_unit (Optional[str]): See `parse_unique`.
+
+    Returns:
+        pd.DataFrame: The parsed dates (under the field's name) and the
+            breakdown columns, indexed like `values`.
+    """
+    parsed, codes = parse_unique(values, date_format, date_unit)
+    unique_dates = pd.Series(parsed, name=values.name)
+    columns = pd.concat([unique_dates, breakdowns(unique_dates, prefix)], axis=1).take(
+        codes.to_numpy()
+    )
+    return columns.set_axis(values.index)
+
+
+def parse_mixed(text: pd.Series) -> pd.Series:
+    """Parse date text of any format, missing if unparseable.
+
+    Values with different time zones (or none) can't be parsed together, so
+    then each is parsed on its own and keeps its wall-clock time.
+
+    Args:
+        text (pd.Series): The date text.
+
+    Returns:
+        pd.Series: The parsed dates.
+    """
+    try:
+        return pd.to_datetime(text, format="mixed", errors="coerce")
+    except ValueError:
+        parsed = [
+            pd.to_datetime(value, format="mixed", errors="coerce") for value in text
+        ]
+        return pd.Series(
+            [pd.NaT if pd.isna(value) else value.tz_localize(None) for value in parsed],
+            index=text.index,
+        )
+
+
+def normalize(values: pd.Series) -> pd.Series:
+    """Normalize free-form date text to `YYYY-MM-DD`, missing if unparseable.
+
+    Each distinct value is parsed on its own; values that don't parse are
+    retried with only the text before the first space (e.g. a trailing time
+    or note).
+
+    Args:
+        values (pd.Series): The date text.
+
+    Returns:
+        pd.Series: The normalized dates (text, missing where missing or unparseable).
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    text = pd.Series(uniques, dtype=object)
+    parsed = parse_mixed(text)
+    retry = parsed.isna() & text.notna()
+    first_word = text[retry].astype(str).str.split(" ").str[0].str.strip()
+    normalized = parsed.dt.strftime("%Y-%m-%d").astype(object)
+    normalized[retry] = parse_mixed(first_word).dt.strftime("%Y-%m-%d").astype(object)
+    normalized = normalized.where(normalized.notna(), None)
+    # typed like text built value by value (e.g. with `Series.apply`)
+    return pd.Series(
+        normalized.to_numpy()[codes].tolist(), index=values.index, name=values.name
+    )
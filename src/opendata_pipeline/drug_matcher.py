@@ -0,0 +1,430 @@
+"""This module matches drug search terms in-process, without the external tool.
+
+`search_terms.csv` is compiled into one Aho-Corasick automaton over *tokens*
+(lowercase alphanumeric runs), so every term, including multi-word terms, is
+found in a single left to right pass over each text and only on word
+boundaries. Records are read straight from the records jsonl file and scanned
+in batches across a process pool.
+
+The compiled automaton is pickled into the search terms cache, keyed by the
+term file's SHA-256, so it is only rebuilt when the terms change.
+
+The output matches the tool's: one result per record, search term and search
+field with `row_id`, `search_term`, `search_field`, `metadata` and `data_source`.
+
+With a max edit distance, misspelled tokens (e.g. "fentanly") are first
+corrected to the closest term token through a SymSpell deletion dictionary
+(see `FuzzyIndex`), and results also carry the `edit_distance` of the match.
+"""
+
+from __future__ import annotations
+
+import csv
+import pickle
+import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Generator
+
+import orjson
+
+from opendata_pipeline import models, search_terms
+from opendata_pipeline.utils import console
+
+TOKEN = re.compile(r"[a-z0-9]+")
+"""What counts as a word, applied to lowercased text."""
+
+BATCH_SIZE = 5_000
+"""Records per pool task."""
+
+MAX_PENDING = 16
+"""Pool tasks in flight per source."""
+
+MATCHER_VERSION = 1
+"""Format of the pickled `TermMatcher`, bump it when the class changes (e.g. tokenization)."""
+
+MIN_FUZZY_LENGTH = 5
+"""Shorter tokens are only matched exactly (too many short words are a typo apart)."""
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase alphanumeric tokens."""
+    return TOKEN.findall(text.lower())
+
+
+def read_search_terms(path: Path) -> list[tuple[str, str]]:
+    """Read `(search_term, metadata)` pairs from the search terms file."""
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        return [
+            (row["search_term"], row.get("metadata") or "")
+            for row in reader
+            if row.get("search_term")
+        ]
+
+
+class TermMatcher:
+    """Finds search terms in text with a token-level Aho-Corasick automaton.
+
+    Attributes:
+        terms (list[tuple[str, str]]): The `(search_term, metadata)` pairs.
+        goto (list[dict[str, int]]): Token transitions of each state.
+        fail (list[int]): Failure transition of each state.
+        output (list[list[int]]): Terms (positions in `terms`) ending at each state.
+    """
+
+    def __init__(self, terms: list[tuple[str, str]]):
+        self.terms = terms
+        self.goto: list[dict[str, int]] = [{}]
+        self.output: list[list[int]] = [[]]
+        for i, (term, _) in enumerate(terms):
+            state = 0
+            for token in tokenize(term):
+                nxt = self.goto[state].get(token)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][token] = nxt
+                    self.goto.append({})
+                    self.output.append([])
+                state = nxt
+            if state:
+                self.output[state].append(i)
+        self.fail = [0] * len(self.goto)
+        self.build_failure_links()
+
+    def build_failure_links(self) -> None:
+        """Breadth first, link each state to its longest proper suffix state."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(token, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def find(self, text: str) -> list[int]:
+        """Find the terms in a text.
+
+        Args:
+            text (str): The text to search.
+
+        Returns:
+            list[int]: Positions in `terms` of the terms found, in order of first
+                appearance and without repeats.
+        """
+        found: dict[int, None] = {}
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for token in tokenize(text):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for i in output[state]:
+                found[i] = None
+        return list(found)
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Damerau-Levenshtein (optimal string alignment) distance between two words.
+
+    Args:
+        a (str): A word.
+        b (str): Another word.
+        max_distance (int): Stop early once the distance is known to exceed this.
+
+    Returns:
+        int: The distance, or `max_distance + 1` if it exceeds `max_distance`.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    before: list[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(
+                previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost
+            )
+            # adjacent transposition, the most common typo
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        before, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def deletes(word: str, max_distance: int) -> set[str]:
+    """Every string made by deleting up to `max_distance` characters of a word."""
+    found = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1 :] for w in frontier for i in range(len(w))}
+        found |= frontier
+    return found
+
+
+class FuzzyIndex:
+    """Finds search terms in text, allowing misspellings.
+
+    A SymSpell deletion dictionary maps every deletion of every term token to
+    the tokens it came from. Two words are within `max_distance` edits only if
+    they share such a deletion, so a text token is checked against a handful
+    of candidates instead of the whole vocabulary.
+
+    Each text token is corrected to the closest term token, then the corrected
+    text goes through the matcher's automaton. A term's distance is the sum of
+    its tokens' distances, and terms further than `max_distance` are dropped.
+
+    Attributes:
+        matcher (TermMatcher): The compiled search terms.
+        max_distance (int): The maximum edit distance of a match.
+        vocabulary (set[str]): The tokens of the search terms.
+        index (dict[str, list[str]]): Deletions to the term tokens they came from.
+        lengths (list[int]): Tokens in each term.
+        corrections (dict[str, tuple[str, int]]): Tokens already corrected.
+    """
+
+    def __init__(self, matcher: TermMatcher, max_distance: int):
+        self.matcher = matcher
+        self.max_distance = max_distance
+        self.vocabulary = {token for edges in matcher.goto for token in edges}
+        self.index: dict[str, list[str]] = {}
+        for token in sorted(self.vocabulary):
+            if len(token) < MIN_FUZZY_LENGTH:
+                continue
+            for deletion in deletes(token, max_distance):
+                self.index.setdefault(deletion, []).append(token)
+        self.lengths = [len(tokenize(term)) for term, _ in matcher.terms]
+        self.corrections: dict[str, tuple[str, int]] = {}
+
+    def correct(self, token: str) -> tuple[str, int]:
+        """The closest term token to a text token and its distance.
+
+        Args:
+            token (str): A text token.
+
+        Returns:
+            tuple[str, int]: The term token (the token itself when there is
+                none within `max_distance`) and the distance.
+        """
+        if token in self.vocabulary or len(token) < MIN_FUZZY_LENGTH:
+            return token, 0
+        if token in self.corrections:
+            return self.corrections[token]
+        candidates = {
+            candidate
+            for deletion in deletes(token, self.max_distance)
+            for candidate in self.index.get(deletion, ())
+        }
+        best = (token, 0)
+        best_distance = self.max_distance + 1
+        # sorted, so ties always go to the same token
+        for candidate in sorted(candidates):
+            distance = edit_distance(token, candidate, self.max_distance)
+            if distance < best_distance:
+                best, best_distance = (candidate, distance), distance
+        self.corrections[token] = best
+        return best
+
+    def find(self, text: str) -> dict[int, int]:
+        """Find the terms in a text, allowing misspellings.
+
+        Args:
+            text (str): The text to search.
+
+        Returns:
+            dict[int, int]: Positions in `terms` of the terms found (in order of
+                first appearance) and their smallest edit distance.
+        """
+        found: dict[int, int] = {}
+        distances: list[int] = []
+        state = 0
+        goto, fail, output = self.matcher.goto, self.matcher.fail, self.matcher.output
+        for raw in tokenize(text):
+            token, distance = self.correct(raw)
+            distances.append(distance)
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for i in output[state]:
+                total = sum(distances[-self.lengths[i] :])
+                if total <= self.max_distance and total < found.get(i, total + 1):
+                    found[i] = total
+        return found
+
+
+def load_matcher(terms_path: Path) -> tuple[TermMatcher, Path]:
+    """Load the compiled matcher for a search terms file, compiling it if needed.
+
+    Args:
+        terms_path (Path): The search terms file.
+
+    Returns:
+        tuple[TermMatcher, Path]: The matcher and where it is pickled.
+    """
+    digest = search_terms.file_sha256(terms_path)
+    # keyed by format too, so a changed TermMatcher never loads an old pickle
+    path = search_terms.CACHE_DIR / f"matcher.v{MATCHER_VERSION}.{digest[:16]}.pickle"
+    if path.is_file():
+        with open(path, "rb") as f:
+            return pickle.load(f), path
+    terms = read_search_terms(terms_path)
+    console.log(f"Compiling {len(terms):,} search terms")
+    matcher = TermMatcher(terms)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # drop matchers of older term files
+    for old in path.parent.glob("matcher.*.pickle"):
+        old.unlink()
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(matcher, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp.replace(path)
+    return matcher, path
+
+
+_matcher: TermMatcher | None = None
+"""The matcher of a pool worker process."""
+
+_fuzzy: FuzzyIndex | None = None
+"""The fuzzy index of a pool worker process, if fuzzy matching."""
+
+
+def init_worker(matcher_path: Path, max_distance: int = 0) -> None:
+    """Pool initializer: load the compiled automaton once per worker process."""
+    global _matcher, _fuzzy
+    with open(matcher_path, "rb") as f:
+        _matcher = pickle.load(f)
+    _fuzzy = FuzzyIndex(_matcher, max_distance) if max_distance else None
+
+
+def match_batch(
+    batch: list[dict[str, Any]], columns: list[str], source: str
+) -> list[dict[str, str]]:
+    """Pool task: match a batch of records (see `match_records`)."""
+    assert _matcher is not None, "worker was not initialized"
+    return match_records(_matcher, batch, columns, source, _fuzzy)
+
+
+def match_records(
+    matcher: TermMatcher,
+    records: list[dict[str, Any]],
+    columns: list[str],
+    source: str,
+    fuzzy: FuzzyIndex | None = None,
+) -> list[dict[str, Any]]:
+    """Match the drug columns of records.
+
+    Args:
+        matcher (TermMatcher): The compiled search terms.
+        records (list[dict[str, Any]]): Records with `CaseIdentifier` and the drug columns.
+        columns (list[str]): The drug columns, in order of priority.
+        source (str): The data source name.
+        fuzzy (FuzzyIndex | None): Match misspellings with this index, default
+            exact matches only.
+
+    Returns:
+        list[dict[str, Any]]: The results, in the extraction tool's schema plus
+            `edit_distance` when fuzzy matching.
+    """
+    results: list[dict[str, Any]] = []
+    for record in records:
+        row_id = str(record["CaseIdentifier"])
+        for column in columns:
+            text = record.get(column)
+            if not isinstance(text, str) or not text:
+                continue
+            found = fuzzy.find(text) if fuzzy else dict.fromkeys(matcher.find(text))
+            for i, distance in found.items():
+                term, metadata = matcher.terms[i]
+                result = {
+                    "row_id": row_id,
+                    "search_term": term,
+                    "search_field": column,
+                    "metadata": metadata,
+                    "data_source": source,
+                }
+                if fuzzy:
+                    result["edit_distance"] = distance
+                results.append(result)
+    return results
+
+
+def read_record_batches(
+    config: models.DataSource, batch_size: int, row_ids: set[str] | None = None
+) -> Generator[list[dict[str, Any]], None, None]:
+    """Read the ID and drug columns of a source's records (only `row_ids` if given) in batches."""
+    columns = ["CaseIdentifier"] + config.drug_columns
+    batch: list[dict[str, Any]] = []
+    with open(Path("data") / config.records_filename, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            if row_ids is not None and str(record["CaseIdentifier"]) not in row_ids:
+                continue
+            batch.append({col: record.get(col) for col in columns})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def run_native(
+    config: models.DataSource,
+    pool: ProcessPoolExecutor,
+    row_ids: set[str] | None = None,
+    batch_size: int = BATCH_SIZE,
+) -> Generator[list[dict[str, str]], None, None]:
+    """Match a source's records across the pool.
+
+    At most `MAX_PENDING` batches are in flight, so memory stays flat however
+    large the source is.
+
+    Args:
+        config (models.DataSource): The data source config.
+        pool (ProcessPoolExecutor): A pool started with `init_worker`.
+        row_ids (set[str] | None): Only match these records, default all.
+        batch_size (int): Records per pool task.
+
+    Yields:
+        list[dict[str, str]]: The results of each batch in record order, in the
+            extraction tool's schema.
+    """
+    console.log(f"Matching drug terms in {config.drug_columns} for {config.name}")
+    pending: deque[Future[list[dict[str, str]]]] = deque()
+    for batch in read_record_batches(config, batch_size, row_ids):
+        pending.append(
+            pool.submit(match_batch, batch, config.drug_columns, config.name)
+        )
+        if len(pending) >= MAX_PENDING:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def start_pool(
+    terms_path: Path, workers: int | None = None, max_distance: int = 0
+) -> ProcessPoolExecutor:
+    """Start a process pool with the compiled search terms loaded in every worker.
+
+    Args:
+        terms_path (Path): The search terms file.
+        workers (int | None): Worker processes, default the CPU count.
+        max_distance (int): Max edit distance of fuzzy matches, 0 for exact
+            matches only.
+
+    Returns:
+        ProcessPoolExecutor: The pool.
+    """
+    _, matcher_path = load_matcher(terms_path)
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(matcher_path, max_distance),
+    )
@@ -0,0 +1,112 @@
+"""This module keeps the drug extraction state between runs for incremental runs.
+
+Cause of death text rarely changes once a case is closed, so for each source
+the hash of every record's `drug_columns` text and the hits found are kept in
+the app directory (e.g. `~/.config/opendata-pipeline/drug_state`):
+
+- `<source>.hashes.parquet`: `CaseIdentifier` and `text_hash` of every record scanned
+- `<source>.hits.jsonl`: the drug results for those records, in record order
+- `<source>.json`: the state version (search terms, engine and drug columns)
+
+An incremental run only rescans records that are new or whose text hash
+changed, and reuses the stored hits for the rest. The state is discarded (a
+full rescan) when the version changes, e.g. new search terms.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Any, Generator
+
+import orjson
+import pandas as pd
+import typer
+
+from opendata_pipeline import models
+from opendata_pipeline.utils import console
+
+STATE_DIR = Path(typer.get_app_dir("opendata-pipeline")) / "drug_state"
+"""Where the per-source state is kept."""
+
+
+def state_paths(config: models.DataSource) -> tuple[Path, Path, Path]:
+    """The hashes, hits and version files of a source."""
+    stem = config.name.replace(" ", "_").lower()
+    return (
+        STATE_DIR / f"{stem}.hashes.parquet",
+        STATE_DIR / f"{stem}.hits.jsonl",
+        STATE_DIR / f"{stem}.json",
+    )
+
+
+def state_version(config: models.DataSource, term_sha256: str, engine: str) -> str:
+    """The state version: the search terms, engine and drug columns used."""
+    return f"{term_sha256}:{engine}:{'|'.join(config.drug_columns)}"
+
+
+def text_hashes(config: models.DataSource) -> pd.Series:
+    """Hash the `drug_columns` text of every record of a source.
+
+    Args:
+        config (models.DataSource): The data source config.
+
+    Returns:
+        pd.Series: The `text_hash` of each record, indexed by `CaseIdentifier`
+            (as text, like the drug results' `row_id`).
+    """
+    ids: list[str] = []
+    hashes: list[str] = []
+    with open(Path("data") / config.records_filename, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            text = orjson.dumps([record.get(col) for col in config.drug_columns])
+            ids.append(str(record["CaseIdentifier"]))
+            hashes.append(hashlib.blake2b(text, digest_size=8).hexdigest())
+    return pd.Series(
+        hashes, index=pd.Index(ids, name="CaseIdentifier"), name="text_hash"
+    )
+
+
+def load_hashes(config: models.DataSource, version: str) -> pd.Series | None:
+    """Load a source's stored text hashes, None if there is no state or it has another version.
+
+    Args:
+        config (models.DataSource): The data source config.
+        version (str): The current state version (see `state_version`).
+
+    Returns:
+        pd.Series | None: The stored text hashes (see `text_hashes`).
+    """
+    hashes_path, hits_path, version_path = state_paths(config)
+    if not all(p.is_file() for p in (hashes_path, hits_path, version_path)):
+        return None
+    if orjson.loads(version_path.read_bytes()).get("version") != version:
+        console.log(f"Drug state of {config.name} is outdated, rescanning all records")
+        return None
+    return pd.read_parquet(hashes_path).set_index("CaseIdentifier")["text_hash"]
+
+
+def read_hits(config: models.DataSource) -> Generator[dict[str, Any], None, None]:
+    """Stream a source's stored hits."""
+    _, hits_path, _ = state_paths(config)
+    with open(hits_path, "rb") as f:
+        for line in f:
+            yield orjson.loads(line)
+
+
+def pending_hits_path(config: models.DataSource) -> Path:
+    """Where a run writes a source's new hits until `save` moves them into place."""
+    _, hits_path, _ = state_paths(config)
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    return hits_path.with_suffix(".pending")
+
+
+def save(config: models.DataSource, version: str, hashes: pd.Series) -> None:
+    """Save a source's state, with the hits written to `pending_hits_path`."""
+    hashes_path, hits_path, version_path = state_paths(config)
+    # the version goes last, so a partly written state is never trusted
+    version_path.unlink(missing_ok=True)
+    pending_hits_path(config).replace(hits_path)
+    hashes.reset_index().to_parquet(hashes_path, index=False)
+    version_path.write_bytes(orjson.dumps({"version": version}))
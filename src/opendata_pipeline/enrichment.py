@@ -0,0 +1,217 @@
+"""This module assigns points to every configured Census geography in one pass.
+
+Census geographies nest: a block group lies within one tract, which lies within
+one county, and the GEOIDs encode that (`SSCCCTTTTTTB`). So only the finest
+configured layer needs a point-in-polygon lookup:
+
+- with `block_group` configured, points are looked up in the block groups and
+  the tract is the block group GEOID's first 11 characters
+- otherwise points are looked up in the tracts
+- the county is always the tract GEOID's first 5 characters
+
+ZCTAs don't nest in anything and get their own lookup.
+
+The lookup (`locate`) returns plain position arrays so it can run in worker
+processes, `attributes` turns them into columns. Lookups go through the
+persistent `point_memo` unless disabled.
+"""
+
+from __future__ import annotations
+
+import geopandas
+import numpy as np
+import pandas as pd
+
+from opendata_pipeline import census_layers, point_lookup, point_memo
+from opendata_pipeline.utils import console
+
+GEOID_COLUMNS = {"tract": "GEOID", "block_group": "GEOID", "zcta": "GEOID20"}
+"""GEOID column of each TIGER layer."""
+
+Extent = tuple[float, float, float, float]
+
+
+def point_arrays(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """The composite `(lon, lat)` arrays, NaN for points flagged `outside_bounds`."""
+    lon = df["composite_longitude"].to_numpy(dtype="float64", na_value=np.nan)
+    lat = df["composite_latitude"].to_numpy(dtype="float64", na_value=np.nan)
+    if "outside_bounds" in df.columns:
+        # flagged up front, no need to test them against any polygon
+        outside = df["outside_bounds"].to_numpy(dtype=bool)
+        lon = np.where(outside, np.nan, lon)
+        lat = np.where(outside, np.nan, lat)
+    return lon, lat
+
+
+def geoids(
+    layer: geopandas.GeoDataFrame, kind: str, positions: np.ndarray
+) -> pd.Series:
+    """The GEOID at each position of a layer, `<NA>` where the position is `OUTSIDE`."""
+    values = pd.Series(layer[GEOID_COLUMNS[kind]].to_numpy(), dtype="string")
+    return values.reindex(positions).reset_index(drop=True)
+
+
+def lookup_layer(
+    kind: str,
+    fips_code: str,
+    extent: Extent | None,
+    county_fips: tuple[str, ...] | None,
+    lon: np.ndarray,
+    lat: np.ndarray,
+    memo: bool,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Positions of the points in a clipped layer and whether each was memoized."""
+    layer = census_layers.load_clipped_layer(kind, fips_code, extent, county_fips)
+    lookup = point_lookup.load_layer_lookup(kind, fips_code, extent, county_fips)
+    if not memo:
+        return lookup.lookup(lon, lat), np.zeros(len(lon), dtype=bool)
+    return point_memo.memoized_lookup(
+        lookup,
+        layer,
+        GEOID_COLUMNS[kind],
+        point_memo.scope_key(kind, fips_code, f"{extent}:{county_fips}"),
+        point_memo.version_key(census_layers.layer_zip_path(kind, fips_code)),
+        lon,
+        lat,
+    )
+
+
+def locate(
+    df: pd.DataFrame,
+    fips_code: str,
+    extent: Extent | None,
+    county_fips: tuple[str, ...] | None,
+    geographies: tuple[str, ...],
+    memo: bool = True,
+) -> dict[str, np.ndarray]:
+    """Find each point's position in the tract layer and the configured layers.
+
+    Args:
+        df (pd.DataFrame): Records with composite coordinates (see `point_arrays`).
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (Extent | None): The clip extent of the layers.
+        county_fips (tuple[str, ...] | None): The county filter of the layers.
+        geographies (tuple[str, ...]): The geographies beyond tracts to assign.
+        memo (bool): Reuse (and save) results from the persistent `point_memo`.
+
+    Returns:
+        dict[str, np.ndarray]: Positions into each clipped layer (`tract` and any
+            `block_group`/`zcta`), `point_lookup.OUTSIDE` if none, and with `memo`
+            a `<layer>_memo_hit` mask for each layer that was looked up.
+    """
+    lon, lat = point_arrays(df)
+    positions: dict[str, np.ndarray] = {}
+    # ZCTAs are national and cross county lines, so only clip them to the extent
+    lookups = [("zcta", None)] if "zcta" in geographies else []
+    if "block_group" in geographies:
+        lookups.append(("block_group", county_fips))
+    else:
+        lookups.append(("tract", county_fips))
+    for kind, counties in lookups:
+        positions[kind], hits = lookup_layer(
+            kind, fips_code, extent, counties, lon, lat, memo
+        )
+        if memo:
+            positions[f"{kind}_memo_hit"] = hits
+    if "block_group" in geographies:
+        block_groups = census_layers.load_clipped_layer(
+            "block_group", fips_code, extent, county_fips
+        )
+        tracts = census_layers.load_clipped_tracts(fips_code, extent, county_fips)
+        tract_geoids = geoids(block_groups, "block_group", positions["block_group"])
+        positions["tract"] = pd.Index(tracts["GEOID"]).get_indexer(
+            tract_geoids.str.slice(0, 11)
+        )
+    return positions
+
+
+def log_memo_stats(positions: dict[str, np.ndarray], has_point: np.ndarray) -> None:
+    """Log the memo hit rate of each layer that was looked up, if memoized.
+
+    Args:
+        positions (dict[str, np.ndarray]): The output of `locate`.
+        has_point (np.ndarray): Which records had a point to look up.
+    """
+    total = int(has_point.sum())
+    for key, hits in positions.items():
+        if key.endswith("_memo_hit") and total:
+            layer = key.removesuffix("_memo_hit")
+            console.log(
+                f"{layer} memo: {int(hits.sum()):,} of {total:,} points "
+                f"({hits.sum() / total:.1%}) reused, {total - int(hits.sum()):,} looked up"
+            )
+
+
+def attributes(
+    positions: dict[str, np.ndarray],
+    index: pd.Index,
+    fips_code: str,
+    extent: Extent | None,
+    county_fips: tuple[str, ...] | None,
+    geographies: tuple[str, ...],
+) -> pd.DataFrame:
+    """Columns for the positions `locate` found.
+
+    The tract columns match a left `sjoin(predicate="within")` against the tracts
+    (`index_right` plus the tract attributes), followed by a `<geography>_geoid`
+    column per configured geography.
+
+    Args:
+        positions (dict[str, np.ndarray]): The output of `locate`.
+        index (pd.Index): The index of the records.
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (Extent | None): The clip extent of the layers.
+        county_fips (tuple[str, ...] | None): The county filter of the layers.
+        geographies (tuple[str, ...]): The geographies beyond tracts to assign.
+
+    Returns:
+        pd.DataFrame: The geography columns, NaN where a point is in no polygon.
+    """
+    tracts = census_layers.load_clipped_tracts(fips_code, extent, county_fips)
+    df = (
+        pd.DataFrame(tracts.drop(columns=tracts.geometry.name))
+        .rename_axis("index_right")
+        .reset_index()
+        .reindex(positions["tract"])
+        .set_axis(index)
+    )
+    for geography in geographies:
+        if geography == "county":
+            column = geoids(tracts, "tract", positions["tract"]).str.slice(0, 5)
+        elif geography == "zcta":
+            layer = census_layers.load_clipped_layer("zcta", fips_code, extent)
+            column = geoids(layer, "zcta", positions["zcta"])
+        else:
+            layer = census_layers.load_clipped_layer(
+                geography, fips_code, extent, county_fips
+            )
+            column = geoids(layer, geography, positions[geography])
+        df[f"{geography}_geoid"] = column.set_axis(index)
+    return df
+
+
+def enrich(
+    df: pd.DataFrame,
+    fips_code: str,
+    extent: Extent | None,
+    county_fips: tuple[str, ...] | None,
+    geographies: tuple[str, ...],
+    memo: bool = True,
+) -> pd.DataFrame:
+    """Assign every point to the tracts and configured geographies.
+
+    Args:
+        df (pd.DataFrame): Records with composite coordinates (see `point_arrays`).
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (Extent | None): The clip extent of the layers.
+        county_fips (tuple[str, ...] | None): The county filter of the layers.
+        geographies (tuple[str, ...]): The geographies beyond tracts to assign.
+        memo (bool): Reuse (and save) results from the persistent `point_memo`.
+
+    Returns:
+        pd.DataFrame: The geography columns (see `attributes`), indexed like `df`.
+    """
+    positions = locate(df, fips_code, extent, county_fips, geographies, memo)
+    lon, _ = point_arrays(df)
+    log_memo_stats(positions, ~np.isnan(lon))
+    return attributes(positions, df.index, fips_code, extent, county_fips, geographies)
@@ -2,35 +2,61 @@
 
 It utilizes the drug columns (in order) listed in the config file (config.json).
 
-It also requires you to have the [drug extraction tool](https://github.com/UK-IPOP/drug-extraction) installed.
+The default `tool` engine requires you to have the [drug extraction tool](https://github.com/UK-IPOP/drug-extraction) installed.
+The `native` engine matches the same search terms in-process (see `drug_matcher`),
+and can also match misspelled terms up to a max edit distance.
 """
 
 from __future__ import annotations
 
+import contextlib
 import csv
+import functools
+import heapq
+import itertools
+import os
+import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Generator
+from typing import Any, Callable, Generator, Iterator
 
 import orjson
 import pandas as pd
-import requests
+from pydantic import BaseModel
 
-from opendata_pipeline import manage_config, models
+from opendata_pipeline import (
+    drug_matcher,
+    drug_state,
+    hit_index,
+    manage_config,
+    models,
+    search_terms,
+)
 from opendata_pipeline.utils import console
 
+ENGINES = ("tool", "native")
+"""The drug matching engines."""
 
-def fetch_drug_search_terms() -> None:
-    """Fetch drug search terms from the remote github repo.
+WORK_DIR = Path("data") / "drug_work"
+"""Parent of the per-source working directories of the drug tool and the spools."""
+
+BATCH_SIZE = 5_000
+"""Results per batch when streaming drug results."""
+
+CSV_RENAMES = {"row_id": "CaseIdentifier"}
+"""Column renames in the `drug_output.csv` header."""
+
+
+def fetch_drug_search_terms() -> search_terms.TermVersion:
+    """Fetch drug search terms from the remote github repo, or the local cache.
 
     Returns:
-        dict[str, str]: a dictionary of search terms and their tags
+        search_terms.TermVersion: the version of the search terms
     """
     console.log("Fetching drug search terms from GitHub")
-    url = "https://raw.githubusercontent.com/UK-IPOP/drug-extraction/main/data/search_terms.csv"
-    resp = requests.get(url)
-    # data = resp.json()
-    Path("search_terms.csv").write_text(resp.text)
+    return search_terms.fetch()
 
 
 def command(input_fpath: str, target_columns: list[str] | str) -> list[str]:
@@ -61,27 +87,54 @@ def command(input_fpath: str, target_columns: list[str] | str) -> list[str]:
     return cmd
 
 
-def read_drug_output(source: str) -> Generator[dict[str, str], None, None]:
-    """Read the drug output file and yield each record."""
-    with open(Path().cwd() / "output.csv", "r") as f:
+def read_drug_output(
+    source: str, work_dir: Path | None = None
+) -> Generator[dict[str, str], None, None]:
+    """Read the drug output file (in `work_dir`, default cwd) and yield each record."""
+    with open((work_dir or Path().cwd()) / "output.csv", "r") as f:
         reader = csv.DictReader(f)
         for line in reader:
             line["data_source"] = source
             yield line
 
 
-def run_drug_tool(config: models.DataSource) -> list[dict[str, Any]]:
+def source_work_dir(config: models.DataSource) -> Path:
+    """The working directory of a source's drug tool run."""
+    return WORK_DIR / config.name.replace(" ", "_").lower()
+
+
+def run_drug_tool(
+    config: models.DataSource, row_ids: set[str] | None = None
+) -> Generator[list[dict[str, Any]], None, None]:
     """Run the drug extraction tool.
 
+    Each source runs in its own working directory, so its `output.csv` can't be
+    clobbered by (or read from) another source's run. The directory is removed
+    once the output is read.
+
     Args:
         config (models.DataSource): the data source config
+        row_ids (set[str] | None): only search these records, default all
 
-    Returns:
-        list[dict[str, Any]]: the drug results
+    Raises:
+        subprocess.CalledProcessError: if the tool fails
+        RuntimeError: if the tool wrote no output
+
+    Yields:
+        list[dict[str, Any]]: batches of the drug results
     """
-    drug_results: list[dict[str, Any]] = []
+    work_dir = source_work_dir(config).resolve()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+    # the tool works relative to the cwd, give it the search terms too
+    if Path("search_terms.csv").is_file():
+        shutil.copy(Path("search_terms.csv"), work_dir / "search_terms.csv")
 
-    in_file = Path("data") / config.drug_prep_filename
+    in_file = (Path("data") / config.drug_prep_filename).resolve()
+    if row_ids is not None:
+        prep = pd.read_csv(in_file, dtype=str, keep_default_na=False)
+        in_file = work_dir / "input.csv"
+        prep[prep["CaseIdentifier"].isin(row_ids)].to_csv(in_file, index=False)
     cmd = command(
         input_fpath=in_file.as_posix(),
         target_columns=config.drug_columns,
@@ -90,39 +143,268 @@ def run_drug_tool(config: models.DataSource) -> list[dict[str, Any]]:
         f"Running drug extraction tool on {config.drug_columns} for {config.name}"
     )
     # output is written to file
-    subprocess.run(cmd)
-    # so now we read the file using generators
-    # could code this better
-    for record in read_drug_output(config.name):
-        drug_results.append(record)
+    subprocess.run(cmd, cwd=work_dir, check=True)
+    if not (work_dir / "output.csv").is_file():
+        raise RuntimeError(f"Drug extraction tool wrote no output for {config.name}")
+    results = read_drug_output(config.name, work_dir)
+    for batch in itertools.batched(results, BATCH_SIZE, strict=False):
+        yield list(batch)
+    shutil.rmtree(work_dir)
 
-    return drug_results
 
+class SourceRun(BaseModel):
+    """Timing of one source's drug extraction."""
 
-def export_drug_output(drug_results: list[dict[str, Any]]) -> None:
-    """Export the drug output to a file."""
-    with open(Path("data") / "drug_data.jsonl", "w") as f:
-        for record in drug_results:
-            f.write(orjson.dumps(record).decode("utf-8") + "\n")
+    source: str
+    hits: int
+    """Matches found (rows of drug output)."""
+    elapsed_seconds: float
 
-    (
-        pd.DataFrame(drug_results)
-        .rename(columns={"row_id": "CaseIdentifier"})
-        .to_csv(Path("data") / "drug_output.csv", index=False)
-    )
+    @property
+    def hits_per_second(self) -> float:
+        """Matches found per second."""
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.hits / self.elapsed_seconds
 
 
-def run(settings: models.Settings) -> None:
-    """Run the drug extraction tool."""
-    fetch_drug_search_terms()
+def extract_incremental(
+    config: models.DataSource,
+    extract: Callable[..., Iterator[list[dict[str, Any]]]],
+    term_sha256: str,
+    engine: str,
+) -> Generator[list[dict[str, Any]], None, None]:
+    """Extract drugs only for new or changed records, reusing prior hits.
 
-    drug_results: list[dict[str, Any]] = []
-    for data_source in settings.sources:
-        results = run_drug_tool(config=data_source)
-        drug_results.extend(results)
+    Prior hits and new hits are both in record order, so they are merged as
+    they stream and the output is ordered like a full run. The state is only
+    saved once the engine has finished, so records of a failed run are
+    rescanned next time.
+
+    Args:
+        config (models.DataSource): the data source config
+        extract (Callable): the engine, called with the `row_ids` to search
+        term_sha256 (str): the search terms version
+        engine (str): the engine name
+
+    Yields:
+        list[dict[str, Any]]: batches of the drug results of all current records
+    """
+    version = drug_state.state_version(config, term_sha256, engine)
+    hashes = drug_state.text_hashes(config)
+    previous = drug_state.load_hashes(config, version)
+    if previous is None:
+        hits = itertools.chain.from_iterable(extract(config))
+    else:
+        unchanged = hashes.eq(previous.reindex(hashes.index))
+        changed = set(hashes.index[~unchanged])
+        console.log(
+            f"{config.name}: rescanning {len(changed):,} new or changed of {len(hashes):,} records"
+        )
+        kept = set(hashes.index[unchanged])
+        prior = (hit for hit in drug_state.read_hits(config) if hit["row_id"] in kept)
+        new = (
+            itertools.chain.from_iterable(extract(config, row_ids=changed))
+            if changed
+            else iter(())
+        )
+        order = {row_id: i for i, row_id in enumerate(hashes.index)}
+        hits = heapq.merge(prior, new, key=lambda hit: order[hit["row_id"]])
+    pending = drug_state.pending_hits_path(config)
+    try:
+        with open(pending, "wb") as f:
+            for batch in itertools.batched(hits, BATCH_SIZE, strict=False):
+                f.write(b"".join(orjson.dumps(hit) + b"\n" for hit in batch))
+                yield list(batch)
+    except BaseException:
+        # the engine failed (or the run stopped), keep the previous state
+        pending.unlink(missing_ok=True)
+        raise
+    drug_state.save(config, version, hashes)
+
+
+def spool_path(config: models.DataSource) -> Path:
+    """Where a source's results are spooled until they are merged."""
+    return WORK_DIR / f"{config.name.replace(' ', '_').lower()}.jsonl"
+
+
+def run_source(
+    config: models.DataSource,
+    extract: Callable[[models.DataSource], Iterator[list[dict[str, Any]]]],
+) -> SourceRun:
+    """Extract drugs for one source into its spool file, and time it."""
+    start = time.perf_counter()
+    hits = 0
+    spool = spool_path(config)
+    spool.parent.mkdir(parents=True, exist_ok=True)
+    with open(spool, "wb") as f:
+        for batch in extract(config):
+            f.write(b"".join(orjson.dumps(hit) + b"\n" for hit in batch))
+            hits += len(batch)
+    elapsed = time.perf_counter() - start
+    return SourceRun(source=config.name, hits=hits, elapsed_seconds=elapsed)
+
+
+def read_spool(spool: Path) -> Generator[list[dict[str, Any]], None, None]:
+    """Stream a spool file in batches."""
+    with open(spool, "rb") as f:
+        for lines in itertools.batched(f, BATCH_SIZE, strict=False):
+            yield [orjson.loads(line) for line in lines]
+
+
+def log_source_runs(runs: list[SourceRun]) -> None:
+    """Log the per-source duration and hits/sec."""
+    for run in runs:
+        console.log(
+            f"[bold]{run.source}[/bold] -> {run.hits:,} hits in "
+            f"{run.elapsed_seconds:,.1f}s ({run.hits_per_second:,.0f} hits/s)"
+        )
+
+
+class DrugOutputWriter:
+    """Writes drug results to `drug_data.jsonl` and `drug_output.csv` as they come.
+
+    The CSV columns are those of the first result, with `row_id` renamed to
+    `CaseIdentifier` in the header.
+
+    Attributes:
+        jsonl_file (BinaryIO): The open `drug_data.jsonl`.
+        csv_file (TextIO): The open `drug_output.csv`.
+        csv_writer (csv.DictWriter | None): Created with the first batch.
+        files (contextlib.ExitStack): Closes both files.
+    """
+
+    def __init__(self, data_dir: Path = Path("data")):
+        # if the second open fails, the first file is closed on the way out
+        with contextlib.ExitStack() as stack:
+            self.jsonl_file = stack.enter_context(
+                open(data_dir / "drug_data.jsonl", "wb")
+            )
+            self.csv_file = stack.enter_context(
+                open(data_dir / "drug_output.csv", "w", newline="")
+            )
+            self.files = stack.pop_all()
+        self.csv_writer: csv.DictWriter | None = None
+
+    def write(self, batch: list[dict[str, Any]]) -> None:
+        """Write a batch of results to both files."""
+        if not batch:
+            return
+        if self.csv_writer is None:
+            fieldnames = list(batch[0])
+            header = [CSV_RENAMES.get(name, name) for name in fieldnames]
+            # line endings as pandas wrote them
+            csv.writer(self.csv_file, lineterminator="\n").writerow(header)
+            self.csv_writer = csv.DictWriter(
+                self.csv_file,
+                fieldnames,
+                restval="",
+                extrasaction="ignore",
+                lineterminator="\n",
+            )
+        self.jsonl_file.write(b"".join(orjson.dumps(hit) + b"\n" for hit in batch))
+        self.csv_writer.writerows(batch)
+
+    def close(self) -> None:
+        """Close both files."""
+        self.files.close()
+
+    def __enter__(self) -> DrugOutputWriter:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def export_drug_output(sources: list[models.DataSource]) -> None:
+    """Export the drug output and hit indexes, streaming each source's spool.
+
+    Args:
+        sources (list[models.DataSource]): The sources, in output order.
+    """
+    with DrugOutputWriter() as writer:
+        for source in sources:
+            builder = hit_index.IndexBuilder(hit_index.read_case_ids(source))
+            for batch in read_spool(spool_path(source)):
+                writer.write(batch)
+                builder.add(batch)
+            builder.save(hit_index.index_path(source))
+
+
+def run(
+    settings: models.Settings,
+    engine: str = "tool",
+    workers: int | None = None,
+    incremental: bool = False,
+    max_distance: int = 0,
+) -> None:
+    """Run the drug extraction.
+
+    Args:
+        settings (models.Settings): The settings for the app.
+        engine (str): `tool` for the external extraction tool, `native` for the
+            in-process matcher.
+        workers (int | None): Number of sources to run the `tool` engine on at
+            once, or worker processes for the `native` engine. Defaults to the
+            CPU count.
+        incremental (bool): Only search new or changed records (see `drug_state`).
+        max_distance (int): Also match terms up to this edit distance, tagging
+            results with their `edit_distance`. Needs the `native` engine.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got {engine!r}")
+    if max_distance < 0:
+        raise ValueError(f"max_distance must be positive, got {max_distance}")
+    if max_distance and engine != "native":
+        raise ValueError("fuzzy matching (max_distance) needs the native engine")
+    # fuzzy results differ from exact ones, keep their state apart
+    engine_key = f"{engine}:fuzzy{max_distance}" if max_distance else engine
+    if engine == "native":
+        # a new matcher format may match differently, rescan
+        engine_key = f"{engine_key}:v{drug_matcher.MATCHER_VERSION}"
+    term_version = fetch_drug_search_terms()
+    console.log(
+        f"Using search terms {term_version.sha256[:12]} ({term_version.status})"
+    )
+
+    with contextlib.ExitStack() as stack:
+        if engine == "native":
+            pool = stack.enter_context(
+                drug_matcher.start_pool(Path("search_terms.csv"), workers, max_distance)
+            )
+            engine_run = functools.partial(drug_matcher.run_native, pool=pool)
+            # sources only queue batches on the shared process pool
+            concurrency = len(settings.sources)
+        else:
+            engine_run = run_drug_tool
+            concurrency = workers or os.cpu_count() or 1
+        extract = engine_run
+        if incremental:
+            extract = functools.partial(
+                extract_incremental,
+                extract=engine_run,
+                term_sha256=term_version.sha256,
+                engine=engine_key,
+            )
+        threads = stack.enter_context(
+            ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        )
+        futures = [
+            threads.submit(run_source, data_source, extract)
+            for data_source in settings.sources
+        ]
+        runs = [future.result() for future in futures]
+    log_source_runs(runs)
 
     console.log("Exporting drug data...")
-    export_drug_output(drug_results=drug_results)
+    # merge the spools in config order
+    export_drug_output(settings.sources)
+    for data_source in settings.sources:
+        spool_path(data_source).unlink()
+    # left behind only by failed tool runs
+    with contextlib.suppress(OSError):
+        WORK_DIR.rmdir()
+    search_terms.record_version(term_version, engine_key)
 
 
 if __name__ == "__main__":
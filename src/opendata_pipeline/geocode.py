@@ -6,16 +6,25 @@ It utilizes the ArcGIS geocoding API and asyncio to speed up the process.
 from __future__ import annotations
 
 import asyncio
+import functools
+import time
 import urllib.parse
+from collections import deque
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable, Callable, TypeVar
 
 import httpx
 import orjson
+import pandas as pd
 from rich.progress import track
 
-from opendata_pipeline import manage_config, models
-from opendata_pipeline.utils import console
+from opendata_pipeline import manage_config, models, preflight
+from opendata_pipeline.utils import console, percentile
+
+T = TypeVar("T")
+
+GEOCODE_URL = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates"
+"""The ArcGIS `findAddressCandidates` endpoint used for geocoding."""
 
 
 def read_records(config: models.DataSource) -> list[dict[str, Any]]:
@@ -136,7 +145,10 @@ def export_geocoded_results(data: list[dict[str, Any]]) -> None:
 
 
 def build_url(
-    bounds: models.GeoBounds, address_data: dict[str, str | int | None], key: str
+    bounds: models.GeoBounds,
+    address_data: dict[str, str | int | None],
+    key: str,
+    base_url: str = GEOCODE_URL,
 ) -> str:
     """Build the geocoding url.
 
@@ -146,11 +158,12 @@ def build_url(
         bounds (models.GeoBounds): The (rectangular) bounds to use for the geocoding.
         address_data (dict[str, str | int | None]): The address data to use for the geocoding.
         key (str): The ArcGIS token.
+        base_url (str): The `findAddressCandidates` endpoint. Defaults to ArcGIS, override for the local stand-in server.
 
     Returns:
         str: The geocoding url.
     """
-    fat_url = f"https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates?f=json&outFields=none&outSR=4326&token={key}&forStorage=false&locationType=street&sourceCountry=USA&maxLocations=1&maxOutOfRange=false"
+    fat_url = f"{base_url}?f=json&outFields=none&outSR=4326&token={key}&forStorage=false&locationType=street&sourceCountry=USA&maxLocations=1&maxOutOfRange=false"
 
     # combines values that we have
     address_string = " ".join([str(v) for v in address_data.values() if v])
@@ -167,6 +180,7 @@ async def get_geo_result(
     data_source_name: str,
     retry_number: int = 0,
     max_retries: int = 5,
+    retry_delay: float = 10,
 ) -> dict[str, Any] | None:
     """Get the geocoding result from an async web request to ArcGIS.
 
@@ -179,6 +193,9 @@ async def get_geo_result(
         url (str): The url to use for the request.
         id_ (int): The id of the record being geocoded.
         data_source_name (str): The name of the data source being geocoded.
+        retry_number (int): The current retry attempt.
+        max_retries (int): The number of retries allowed before giving up.
+        retry_delay (float): Seconds to wait before retrying a failed request.
 
     Returns:
         dict[str, Any] | None: The geocoding result or None if the request failed.
@@ -192,13 +209,15 @@ async def get_geo_result(
             print(
                 f"Bad response code: {response.status_code} Retry: {retry_number}/{max_retries} ID: {id_} URL: {url}"
             )
-            await asyncio.sleep(10)
+            await asyncio.sleep(retry_delay)
             return await get_geo_result(
                 client,
                 url,
                 id_,
                 data_source_name,
                 retry_number=retry_number + 1,
+                max_retries=max_retries,
+                retry_delay=retry_delay,
             )
         json_data = response.json()
         if results := json_data.get("candidates", None):
@@ -217,7 +236,7 @@ async def get_geo_result(
         )
         if retry_number > max_retries:
             raise ValueError("Exceeded max_retries")
-        await asyncio.sleep(retry_number + 1 * 10)
+        await asyncio.sleep(retry_number + retry_delay)
         return await get_geo_result(
             client,
             url,
@@ -225,22 +244,151 @@ async def get_geo_result(
             data_source_name,
             retry_number + 1,
             max_retries,
+            retry_delay,
+        )
+
+
+class RequestHedger:
+    """Hedges slow requests by racing a duplicate against them.
+
+    Latencies of recent calls are kept in a sliding window. When a call has not
+    returned within the `hedge_percentile` of that window, a duplicate is issued
+    and whichever answers first wins (the other is cancelled). Hedges are capped
+    at `max_hedge_rate` of all calls to keep ArcGIS credit usage bounded.
+
+    With `enabled=False` no duplicates are issued but latencies are still
+    tracked, so `stats()` can be used to pick a percentile before turning it on.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        hedge_percentile: float = 95,
+        max_hedge_rate: float = 0.05,
+        window: int = 500,
+        min_samples: int = 20,
+    ):
+        self.enabled = enabled
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @property
+    def hedge_delay(self) -> float | None:
+        """Seconds to wait before hedging, None until enough samples are seen."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return percentile(self.latencies, self.hedge_percentile)
+
+    def can_hedge(self) -> bool:
+        """Whether another hedge stays within `max_hedge_rate`."""
+        return self.hedges + 1 <= self.max_hedge_rate * self.calls
+
+    async def run(self, make_call: Callable[[], Awaitable[T]]) -> T:
+        """Run the call, hedging it if it is slow.
+
+        Args:
+            make_call (Callable[[], Awaitable[T]]): Creates a fresh request each time it is called.
+
+        Returns:
+            T: The result of whichever request answered first.
+        """
+        self.calls += 1
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(make_call())
+        delay = self.hedge_delay if self.enabled else None
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done and self.can_hedge():
+                self.hedges += 1
+                hedge = asyncio.ensure_future(make_call())
+                winner = await self.first_success(primary, hedge)
+                if winner is hedge:
+                    self.hedge_wins += 1
+                self.latencies.append(time.perf_counter() - start)
+                return winner.result()
+        result = await primary
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    async def first_success(*tasks: asyncio.Future[T]) -> asyncio.Future[T]:
+        """Wait for the first task to succeed, cancelling the rest.
+
+        If every task fails, the last one to fail is returned so its
+        exception is raised by the caller.
+        """
+        pending = set(tasks)
+        winner = tasks[0]
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = next(iter(done))
+            if any(task.exception() is None for task in done):
+                winner = next(task for task in done if task.exception() is None)
+                break
+        for task in pending:
+            task.cancel()
+        return winner
+
+    def stats(self) -> dict[str, float]:
+        """Tail latency (ms) and hedging stats over the current window."""
+        latencies = list(self.latencies)
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies, default=float("nan")) * 1000,
+        }
+
+    def log_stats(self, label: str) -> None:
+        """Log the latency and hedging stats to the console."""
+        stats = self.stats()
+        console.log(
+            f"{label} latency -> p50 {stats['p50_ms']:,.0f} ms | "
+            f"p90 {stats['p90_ms']:,.0f} ms | p99 {stats['p99_ms']:,.0f} ms | "
+            f"max {stats['max_ms']:,.0f} ms | hedges {stats['hedges']:,} "
+            f"({stats['hedge_rate']:.1%}), {stats['hedge_wins']:,} won"
         )
 
 
-async def geocode_records(config: models.DataSource, key: str) -> list[dict[str, Any]]:
+async def geocode_records(
+    config: models.DataSource,
+    key: str,
+    use_preflight: bool = True,
+    hedger: RequestHedger | None = None,
+) -> tuple[list[dict[str, Any]], pd.DataFrame]:
     """Geocode records for the data source.
 
     Args:
         config (models.DataSource): The data source config.
         key (str): The ArcGIS token.
+        use_preflight (bool): Skip records `preflight` flags as unlikely to geocode.
+        hedger (RequestHedger | None): Hedges slow requests, only tracks latency if None.
 
     Returns:
-        list[dict[str, Any]]: The geocoded records.
+        tuple[list[dict[str, Any]], pd.DataFrame]: The geocoded records and the
+            records skipped by the pre-flight check.
     """
     records = read_records(config)
     if config.spatial_config is None:
         raise ValueError("spatial_config is required for geocoding")
+    if use_preflight:
+        records, skipped = preflight.filter_records(records, config)
+    else:
+        skipped = pd.DataFrame(columns=["CaseIdentifier", "skip_reason", "data_source"])
+
+    if hedger is None:
+        hedger = RequestHedger(enabled=False)
 
     console.log(f"Geocoding {len(records)} records from {config.name}...")
     results: list[dict[str, Any]] = []
@@ -253,22 +401,42 @@ async def geocode_records(config: models.DataSource, key: str) -> list[dict[str,
             url = build_url(
                 bounds=config.spatial_config.bounds, address_data=address_data, key=key
             )
-            result: dict[str, Any] | None = await get_geo_result(
-                client=client,
-                url=url,
-                id_=id_,
-                data_source_name=config.name,
+            result: dict[str, Any] | None = await hedger.run(
+                functools.partial(
+                    get_geo_result,
+                    client=client,
+                    url=url,
+                    id_=id_,
+                    data_source_name=config.name,
+                )
             )
             if result is not None:
                 results.append(result)
 
     # this difference is due to cleaning
     print(f"Geocoded {len(results)} records out of {len(records)}")
-    return results
+    hedger.log_stats(config.name)
+    return results, skipped
+
 
+async def run(
+    settings: models.Settings,
+    alternate_key: str | None,
+    use_preflight: bool = True,
+    hedge: bool = False,
+    hedge_percentile: float = 95,
+    max_hedge_rate: float = 0.05,
+) -> None:
+    """Run the geocoding process.
 
-async def run(settings: models.Settings, alternate_key: str | None) -> None:
-    """Run the geocoding process."""
+    Args:
+        settings (models.Settings): The settings.
+        alternate_key (str | None): An ArcGIS key to use if none is configured.
+        use_preflight (bool): Skip records unlikely to geocode.
+        hedge (bool): Hedge requests slower than `hedge_percentile` of recent ones.
+        hedge_percentile (float): Latency percentile after which a request is hedged.
+        max_hedge_rate (float): Max fraction of requests that may be hedged.
+    """
     if settings.arcgis_api_key is None and alternate_key is None:
         raise ValueError(
             "arcgis_api_key is required for geocoding. Consider using the --alternate-key flag"
@@ -282,13 +450,26 @@ async def run(settings: models.Settings, alternate_key: str | None) -> None:
         raise ValueError("arcgis_api_key is required for geocoding")
 
     geocoded_results: list[dict[str, Any]] = []
+    skipped_records: list[pd.DataFrame] = []
     for data_source in settings.sources:
         if data_source.needs_geocoding:
-            source_set = await geocode_records(data_source, key)
+            hedger = RequestHedger(
+                enabled=hedge,
+                hedge_percentile=hedge_percentile,
+                max_hedge_rate=max_hedge_rate,
+            )
+            source_set, skipped = await geocode_records(
+                data_source, key, use_preflight=use_preflight, hedger=hedger
+            )
             geocoded_results.extend(source_set)
+            skipped_records.append(skipped)
 
     console.log(f"Exporting {len(geocoded_results)} geocoded records")
     export_geocoded_results(geocoded_results)
+    if use_preflight and skipped_records:
+        all_skipped = pd.concat(skipped_records, ignore_index=True)
+        preflight.log_summary(all_skipped)
+        preflight.export_skipped(all_skipped)
 
 
 if __name__ == "__main__":
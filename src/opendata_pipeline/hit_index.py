@@ -0,0 +1,391 @@
+"""This module keeps an inverted index of the drug results for cohort queries.
+
+Questions like "cases with fentanyl and xylazine but not heroin" only need to
+know which records hit which terms, not the wide-form file. For each source
+the drug stage writes `data/drug_index/<source>.json` with:
+
+- `case_ids`: every record's `CaseIdentifier`, in record order
+- `terms`: search term -> bitmap of the records that hit it
+- `tags`: metadata tag (e.g. `opioid`) -> bitmap of the records that hit it,
+  a result's pipe delimited metadata (e.g. `stimulant|amphetamine`) giving
+  one tag per value, like the `<tag>_meta` flags of the wide form
+- `version`: the index format (see `INDEX_VERSION`)
+
+A bitmap has one bit per record (by position in `case_ids`) and is stored
+zlib-compressed and base64 encoded. Queries are boolean expressions over terms
+and tags evaluated with bitwise operations, e.g.
+`fentanyl AND xylazine AND NOT heroin` or `tag:stimulant OR "drug12 x5"`.
+
+Indexes of an older format are rebuilt from `drug_data.jsonl` when queried.
+"""
+
+from __future__ import annotations
+
+import base64
+import itertools
+import re
+import zlib
+from pathlib import Path
+from typing import Any, Generator
+
+import numpy as np
+import orjson
+
+from opendata_pipeline import models
+from opendata_pipeline.utils import console
+
+INDEX_DIR = Path("data") / "drug_index"
+"""Where the per-source indexes are written."""
+
+INDEX_VERSION = 2
+"""Format of the indexes, bumped when what they hold changes."""
+
+DRUG_DATA_PATH = Path("data") / "drug_data.jsonl"
+"""The drug results of every source, indexes are rebuilt from them."""
+
+BATCH_SIZE = 5_000
+"""Results per batch when rebuilding an index."""
+
+TAG_PREFIX = "tag:"
+"""Prefix of metadata tags in query expressions."""
+
+QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+"""A parenthesis, a quoted term or a bare word."""
+
+
+def index_path(config: models.DataSource) -> Path:
+    """The index file of a source."""
+    return INDEX_DIR / f"{config.name.replace(' ', '_').lower()}.json"
+
+
+def read_case_ids(config: models.DataSource) -> list[str]:
+    """Every record's `CaseIdentifier` (as text, like `row_id`), in record order."""
+    with open(Path("data") / config.records_filename, "rb") as f:
+        return [str(orjson.loads(line)["CaseIdentifier"]) for line in f]
+
+
+def encode(bitmap: int) -> str:
+    """Compress a bitmap for storage."""
+    raw = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    return base64.b64encode(zlib.compress(raw)).decode("ascii")
+
+
+def decode(data: str) -> int:
+    """Decompress a stored bitmap."""
+    return int.from_bytes(zlib.decompress(base64.b64decode(data)), "little")
+
+
+class IndexBuilder:
+    """Builds a source's index from its drug results.
+
+    Attributes:
+        case_ids (list[str]): Every record's `CaseIdentifier`, in record order.
+        positions (dict[str, int]): Position of each `CaseIdentifier`.
+        terms (dict[str, bytearray]): Bitmap of each search term.
+        tags (dict[str, bytearray]): Bitmap of each metadata tag.
+    """
+
+    def __init__(self, case_ids: list[str]):
+        self.case_ids = case_ids
+        self.positions = {case_id: i for i, case_id in enumerate(case_ids)}
+        self.terms: dict[str, bytearray] = {}
+        self.tags: dict[str, bytearray] = {}
+
+    def set_bit(self, bitmaps: dict[str, bytearray], key: str, position: int) -> None:
+        """Set a record's bit in a key's bitmap."""
+        bitmap = bitmaps.get(key)
+        if bitmap is None:
+            bitmap = bitmaps[key] = bytearray((len(self.case_ids) + 7) // 8)
+        bitmap[position >> 3] |= 1 << (position & 7)
+
+    def add(self, batch: list[dict[str, Any]]) -> None:
+        """Add a batch of drug results."""
+        for hit in batch:
+            position = self.positions.get(hit["row_id"])
+            # the records changed since the drugs were extracted
+            if position is None:
+                continue
+            self.set_bit(self.terms, hit["search_term"].lower(), position)
+            # metadata is pipe delimited, as the analyze stage splits it
+            for tag in (hit.get("metadata") or "").split("|"):
+                tag = tag.strip().lower()
+                if tag:
+                    self.set_bit(self.tags, tag, position)
+
+    def save(self, path: Path) -> None:
+        """Write the index."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(
+            orjson.dumps(
+                {
+                    "version": INDEX_VERSION,
+                    "case_ids": self.case_ids,
+                    "terms": {
+                        key: encode(int.from_bytes(bitmap, "little"))
+                        for key, bitmap in self.terms.items()
+                    },
+                    "tags": {
+                        key: encode(int.from_bytes(bitmap, "little"))
+                        for key, bitmap in self.tags.items()
+                    },
+                }
+            )
+        )
+
+
+def rebuild(config: models.DataSource) -> None:
+    """Rebuild a source's index from its results in `drug_data.jsonl`.
+
+    Args:
+        config (models.DataSource): The data source config.
+    """
+    builder = IndexBuilder(read_case_ids(config))
+    with open(DRUG_DATA_PATH, "rb") as f:
+        for lines in itertools.batched(f, BATCH_SIZE, strict=False):
+            hits = (orjson.loads(line) for line in lines)
+            builder.add([hit for hit in hits if hit["data_source"] == config.name])
+    builder.save(index_path(config))
+
+
+class HitIndex:
+    """A source's index, bitmaps decompressed as queries need them.
+
+    Attributes:
+        version (int | None): The index format, None before it was recorded.
+        case_ids (list[str]): Every record's `CaseIdentifier`, in record order.
+        terms (dict[str, str]): Compressed bitmap of each search term.
+        tags (dict[str, str]): Compressed bitmap of each metadata tag.
+        universe (int): The bitmap of all records.
+    """
+
+    def __init__(self, path: Path):
+        data = orjson.loads(path.read_bytes())
+        self.version: int | None = data.get("version")
+        self.case_ids: list[str] = data["case_ids"]
+        self.terms: dict[str, str] = data["terms"]
+        self.tags: dict[str, str] = data["tags"]
+        self.universe = (1 << len(self.case_ids)) - 1
+        self._bitmaps: dict[str, int] = {}
+
+    def bitmap(self, operand: str) -> int:
+        """The bitmap of a term or `tag:` operand, empty if nothing hit it."""
+        key = operand.lower()
+        if key not in self._bitmaps:
+            if key.startswith(TAG_PREFIX):
+                data = self.tags.get(key.removeprefix(TAG_PREFIX))
+            else:
+                data = self.terms.get(key)
+            self._bitmaps[key] = decode(data) if data else 0
+        return self._bitmaps[key]
+
+    def ids(self, bitmap: int) -> list[str]:
+        """The `CaseIdentifier`s of the records in a bitmap."""
+        raw = np.frombuffer(
+            bitmap.to_bytes((len(self.case_ids) + 7) // 8, "little"), dtype=np.uint8
+        )
+        positions = np.flatnonzero(np.unpackbits(raw, bitorder="little"))
+        return [self.case_ids[i] for i in positions]
+
+
+def tokenize_query(expression: str) -> list[tuple[str, str]]:
+    """Split a query into `(kind, text)` tokens.
+
+    Args:
+        expression (str): The query.
+
+    Raises:
+        ValueError: If the query has an unterminated quote.
+
+    Returns:
+        list[tuple[str, str]]: Tokens, `kind` one of `(`, `)`, `AND`, `OR`,
+            `NOT` and `operand`.
+    """
+    tokens: list[tuple[str, str]] = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = QUERY_TOKEN.match(expression, pos)
+        if match is None:
+            raise ValueError(f"Unterminated quote in query: {expression!r}")
+        opening, closing, quoted, word = match.groups()
+        if opening or closing:
+            tokens.append((opening or closing, opening or closing))
+        elif quoted is not None:
+            tokens.append(("operand", quoted))
+        elif word.upper() in ("AND", "OR", "NOT"):
+            tokens.append((word.upper(), word))
+        else:
+            tokens.append(("operand", word))
+        pos = match.end()
+    return tokens
+
+
+class Query:
+    """A boolean query over terms and tags, parsed by recursive descent.
+
+    `NOT` binds tightest, then `AND`, then `OR`. Multi-word terms (or terms
+    named like an operator) are quoted. The query is parsed into a tree of
+    `(operator, *operands)` tuples, with `("operand", text)` leaves.
+
+    Attributes:
+        expression (str): The query.
+        tokens (list[tuple[str, str]]): Its tokens (see `tokenize_query`).
+        tree (tuple): The parsed query.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = tokenize_query(expression)
+        self.pos = 0
+        self.tree = self.parse_or()
+        if self.pos < len(self.tokens):
+            self.fail("end of query")
+
+    def peek(self) -> str | None:
+        """The kind of the next token, None at the end."""
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def fail(self, expected: str) -> None:
+        """Raise a syntax error at the next token."""
+        found = (
+            repr(self.tokens[self.pos][1])
+            if self.pos < len(self.tokens)
+            else "end of query"
+        )
+        raise ValueError(
+            f"Expected {expected} but found {found} in {self.expression!r}"
+        )
+
+    def parse_or(self) -> tuple:
+        """OR of AND expressions."""
+        node = self.parse_and()
+        while self.peek() == "OR":
+            self.pos += 1
+            node = ("OR", node, self.parse_and())
+        return node
+
+    def parse_and(self) -> tuple:
+        """AND of NOT expressions."""
+        node = self.parse_not()
+        while self.peek() == "AND":
+            self.pos += 1
+            node = ("AND", node, self.parse_not())
+        return node
+
+    def parse_not(self) -> tuple:
+        """A negated atom, or an atom."""
+        if self.peek() == "NOT":
+            self.pos += 1
+            return ("NOT", self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self) -> tuple:
+        """A parenthesized expression or a term."""
+        kind = self.peek()
+        if kind == "(":
+            self.pos += 1
+            node = self.parse_or()
+            if self.peek() != ")":
+                self.fail("')'")
+            self.pos += 1
+            return node
+        if kind != "operand":
+            self.fail("a term")
+        self.pos += 1
+        return ("operand", self.tokens[self.pos - 1][1])
+
+    def evaluate(self, index: HitIndex, node: tuple | None = None) -> int:
+        """The bitmap of the records matching the query (or one of its nodes)."""
+        node = node or self.tree
+        match node:
+            case ("operand", text):
+                return index.bitmap(text)
+            case ("NOT", operand):
+                return index.universe & ~self.evaluate(index, operand)
+            case ("AND", left, right):
+                return self.evaluate(index, left) & self.evaluate(index, right)
+            case ("OR", left, right):
+                return self.evaluate(index, left) | self.evaluate(index, right)
+        raise ValueError(f"Unknown query node {node!r}")
+
+
+def evaluate(
+    config: models.Settings, expression: str, source: str | None = None
+) -> Generator[tuple[str, HitIndex, int], None, None]:
+    """Evaluate a query on every source's index.
+
+    Args:
+        config (models.Settings): The settings for the app.
+        expression (str): The query, e.g. `fentanyl AND NOT heroin`.
+        source (str | None): Only query this source (by name), default all.
+
+    Raises:
+        ValueError: If the query is malformed.
+
+    Yields:
+        tuple[str, HitIndex, int]: Each source's name, index and bitmap of
+            matching records.
+    """
+    parsed = Query(expression)
+    for data_source in config.sources:
+        if source is not None and data_source.name != source:
+            continue
+        path = index_path(data_source)
+        if not path.is_file():
+            console.log(f"[yellow]{path} not found, skipping {data_source.name}")
+            continue
+        index = HitIndex(path)
+        if index.version != INDEX_VERSION:
+            if not DRUG_DATA_PATH.is_file():
+                console.log(
+                    f"[yellow]{path} is outdated and {DRUG_DATA_PATH} not found, skipping {data_source.name}"
+                )
+                continue
+            console.log(f"Rebuilding the outdated index of {data_source.name}")
+            rebuild(data_source)
+            index = HitIndex(path)
+        yield data_source.name, index, parsed.evaluate(index)
+
+
+def query(
+    config: models.Settings, expression: str, source: str | None = None
+) -> dict[str, list[str]]:
+    """Find the records matching a query in every source's index.
+
+    Args:
+        config (models.Settings): The settings for the app.
+        expression (str): The query, e.g. `fentanyl AND NOT heroin`.
+        source (str | None): Only query this source (by name), default all.
+
+    Raises:
+        ValueError: If the query is malformed.
+
+    Returns:
+        dict[str, list[str]]: The matching `CaseIdentifier`s of each source.
+    """
+    return {
+        name: index.ids(bitmap)
+        for name, index, bitmap in evaluate(config, expression, source)
+    }
+
+
+def count(
+    config: models.Settings, expression: str, source: str | None = None
+) -> dict[str, int]:
+    """Count the records matching a query in every source's index, without listing them.
+
+    Args:
+        config (models.Settings): The settings for the app.
+        expression (str): The query, e.g. `fentanyl AND NOT heroin`.
+        source (str | None): Only query this source (by name), default all.
+
+    Raises:
+        ValueError: If the query is malformed.
+
+    Returns:
+        dict[str, int]: The number of matching records of each source.
+    """
+    return {
+        name: bitmap.bit_count()
+        for name, _, bitmap in evaluate(config, expression, source)
+    }
@@ -22,6 +22,10 @@ from opendata_pipeline import (
     analyze as analyzer,
     utils,
     spatial_join as spatial_joiner,
+    stand_in,
+    release as releaser,
+    hit_index,
+    wide_form,
 )
 
 APP_NAME = "opendata-pipeline"
@@ -93,26 +97,94 @@ def extract_drugs(
         False,
         help="Whether to use the remote configuration or not. Default is False (i.e. use local config.json)",
     ),
+    engine: str = typer.Option(
+        "tool",
+        help="Matching engine: 'tool' (the extract-drugs CLI) or 'native' (in-process).",
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        help="Sources to run the tool engine on at once, or worker processes for the native engine. Default is the CPU count.",
+    ),
+    incremental: bool = typer.Option(
+        False,
+        help="Only search new or changed records, reusing the hits of previous runs.",
+    ),
+    max_distance: int = typer.Option(
+        0,
+        help="Also match misspelled terms up to this edit distance (native engine only). Results get an edit_distance column. Default is 0 (exact matches only).",
+    ),
 ) -> None:
     """Extract drugs from data sources.
 
     This command will extract drugs from data sources and save it to the data directory.
 
-    ** You will need the `extract-drugs` CLI program installed and in your PATH for this command to work.
+    ** With the default `tool` engine you will need the `extract-drugs` CLI program installed and in your PATH for this command to work.
     You can get it here: https://github.com/UK-IPOP/drug-extraction
 
+    The `native` engine matches the same search terms in-process and needs nothing else.
+    With `--max-distance` it also matches misspellings (e.g. "fentanly") and tags each result with its edit distance.
+
     If `use_remote` is True, the remote configuration will be used. Otherwise, the local configuration will be used.
 
     Expects the data to be fetched before running this command.
 
-    Example: opendata-pipeline extract-drugs --use-remote
+    Example: opendata-pipeline extract-drugs --use-remote --engine native
     """
     utils.console.rule("[bold cyan]Extracting drugs")
     settings = get_settings(remote=use_remote)
-    drug_extractor.run(settings=settings)
+    drug_extractor.run(
+        settings=settings,
+        engine=engine,
+        workers=workers,
+        incremental=incremental,
+        max_distance=max_distance,
+    )
     utils.console.log("[bold green]Drug extraction complete!")
 
 
+@app.command("query-drugs")
+def query_drugs(
+    expression: str = typer.Argument(
+        ...,
+        help="Boolean query over search terms and metadata tags, e.g. 'fentanyl AND xylazine AND NOT heroin' or 'tag:opioid OR \"drug12 x5\"'.",
+    ),
+    source: Optional[str] = typer.Option(
+        None, help="Only query this data source (by name). Default is all sources."
+    ),
+    ids: bool = typer.Option(
+        False, help="Print the matching CaseIdentifiers instead of counts."
+    ),
+    use_remote: bool = typer.Option(
+        False,
+        help="Whether to use the remote configuration or not. Default is False (i.e. use local config.json)",
+    ),
+) -> None:
+    """Count (or list) the records matching a drug query.
+
+    This command evaluates the query over the drug hit indexes in `data/drug_index`
+    without loading any data files. `NOT` binds tightest, then `AND`, then `OR`.
+
+    Expects the drugs to be extracted before running this command.
+
+    Example: opendata-pipeline query-drugs "fentanyl AND xylazine AND NOT heroin"
+    """
+    settings = get_settings(remote=use_remote)
+    try:
+        if ids:
+            results = hit_index.query(settings, expression, source=source)
+        else:
+            counts = hit_index.count(settings, expression, source=source)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="EXPRESSION") from e
+    if ids:
+        for name, case_ids in results.items():
+            for case_id in case_ids:
+                typer.echo(f"{name}\t{case_id}")
+    else:
+        for name, total in counts.items():
+            typer.echo(f"{name}\t{total}")
+
+
 @app.command("geocode")
 def geocode(
     use_remote: bool = typer.Option(
@@ -122,6 +194,20 @@ def geocode(
     custom_key: Optional[str] = typer.Option(
         None, help="Your own ArcGIS API key, geocoding not possible otherwise."
     ),
+    preflight: bool = typer.Option(
+        True,
+        help="Skip records unlikely to geocode (PO boxes, mile markers, out of bounds ZIPs...) before calling ArcGIS.",
+    ),
+    hedge: bool = typer.Option(
+        False,
+        help="Issue a duplicate request when one is slower than `hedge_percentile` of recent requests.",
+    ),
+    hedge_percentile: float = typer.Option(
+        95, help="Latency percentile of recent requests after which to hedge."
+    ),
+    max_hedge_rate: float = typer.Option(
+        0.05, help="Max fraction of requests that may be hedged (bounds credit usage)."
+    ),
 ) -> None:
     """:warning: Geocode data sources.
 
@@ -133,11 +219,24 @@ def geocode(
 
     If you are not me, you must provide your own ArcGIS API key using the `custom_key` option.
 
+    Skipped records and their reasons are written to `data/geocode_skipped.jsonl`.
+
+    Tail latency stats (p50/p90/p99) are logged per data source, use them to tune `--hedge-percentile`.
+
     Example: opendata-pipeline geocode --use-remote
     """
     utils.console.rule("[bold cyan]Geocoding data")
     settings = get_settings(remote=use_remote)
-    asyncio.run(geocoder.run(settings=settings, alternate_key=custom_key))
+    asyncio.run(
+        geocoder.run(
+            settings=settings,
+            alternate_key=custom_key,
+            use_preflight=preflight,
+            hedge=hedge,
+            hedge_percentile=hedge_percentile,
+            max_hedge_rate=max_hedge_rate,
+        )
+    )
     utils.console.log("[bold green]Geocoding complete!")
 
 
@@ -147,6 +246,22 @@ def spatial_join(
         False,
         help="Whether to use the remote configuration or not. Default is False (i.e. use local config.json)",
     ),
+    chunked: bool = typer.Option(
+        False,
+        help="Join in chunks across a process pool, keeping memory flat for large sources.",
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        help="Number of worker processes for --chunked. Default is the CPU count.",
+    ),
+    chunk_size: int = typer.Option(
+        50_000,
+        help="Records per chunk for --chunked.",
+    ),
+    memo: bool = typer.Option(
+        True,
+        help="Reuse the tracts found for unchanged points in previous runs.",
+    ),
 ) -> None:
     """Spatially join data sources.
 
@@ -156,14 +271,93 @@ def spatial_join(
 
     Expects the data to be geocoded before running this command.
 
-    Example: opendata-pipeline spatial-join --use-remote
+    With `--chunked`, only the ID and coordinate columns are read up front, tract
+    lookups run in worker processes, and the wide table is streamed through in
+    chunks.
+
+    Example: opendata-pipeline spatial-join --use-remote --chunked --workers 4
     """
     utils.console.rule("[bold cyan]Spatially joining data")
     settings = get_settings(remote=use_remote)
-    spatial_joiner.run(config=settings)
+    spatial_joiner.run(
+        config=settings,
+        chunked=chunked,
+        workers=workers,
+        chunk_size=chunk_size,
+        memo=memo,
+    )
     utils.console.log("[bold green]Spatial join complete!")
 
 
+@app.command("build-wide")
+def build_wide(
+    use_remote: bool = typer.Option(
+        False,
+        help="Whether to use the remote configuration or not. Default is False (i.e. use local config.json)",
+    ),
+    workers: int = typer.Option(
+        1,
+        help="Sources to build at once in worker processes. Default is 1 (one after another, in this process).",
+    ),
+    max_memory_gb: Optional[float] = typer.Option(
+        None,
+        help="Memory (GB) the sources built at once may use with --workers. Default is most of the available memory.",
+    ),
+    engine: str = typer.Option(
+        "pandas",
+        help="Analyze engine: 'pandas' or 'polars' (lazy, multi-threaded queries; floats in its step files can differ in the last digit, as it parses them exactly).",
+    ),
+    memo: bool = typer.Option(
+        True,
+        help="Reuse the tracts found for unchanged points in previous runs.",
+    ),
+) -> None:
+    """Analyze and spatially join data sources in one pass.
+
+    Same output as `analyze` followed by `spatial-join`, but the combined data is kept
+    in memory instead of being written to a temporary CSV and parsed back, and each
+    wide-form file is written once.
+
+    If `use_remote` is True, the remote configuration will be used. Otherwise, the local configuration will be used.
+
+    Expects the drugs to be extracted and the data to be geocoded before running this command.
+
+    Example: opendata-pipeline build-wide --workers 4
+    """
+    utils.console.rule("[bold cyan]Building wide-form data")
+    settings = get_settings(remote=use_remote)
+    wide_form.run(
+        settings=settings,
+        workers=workers,
+        max_memory_gb=max_memory_gb,
+        memo=memo,
+        engine=engine,
+    )
+    utils.console.log("[bold green]Wide-form data complete!")
+
+
+@app.command("release")
+def release(
+    use_remote: bool = typer.Option(
+        False,
+        help="Whether to use the remote configuration or not. Default is False (i.e. use local config.json)",
+    ),
+) -> None:
+    """Write the release files.
+
+    This command writes GeoParquet partitioned by data source and death year to
+    `data/geoparquet`, and a slim CSV per data source, from the spatially joined files.
+
+    Expects the data to be spatially joined before running this command.
+
+    Example: opendata-pipeline release
+    """
+    utils.console.rule("[bold cyan]Writing release files")
+    settings = get_settings(remote=use_remote)
+    releaser.run(config=settings)
+    utils.console.log("[bold green]Release files written!")
+
+
 @app.command("analyze")
 def analyze(
     use_remote: bool = typer.Option(
@@ -174,11 +368,32 @@ def analyze(
         False,
         help="Whether to update the remote configuration or not. Default is False (i.e. update local config.json)",
     ),
+    dense_csv: bool = typer.Option(
+        False,
+        help="Also write the dense wide-form CSV. Default is False (the spatial join reads the Parquet file).",
+    ),
+    workers: int = typer.Option(
+        1,
+        help="Sources to analyze at once in worker processes. Default is 1 (one after another, in this process).",
+    ),
+    max_memory_gb: Optional[float] = typer.Option(
+        None,
+        help="Memory (GB) the sources analyzed at once may use with --workers. Default is most of the available memory.",
+    ),
+    engine: str = typer.Option(
+        "pandas",
+        help="Analyze engine: 'pandas' or 'polars' (lazy, multi-threaded queries; floats in its step files can differ in the last digit, as it parses them exactly).",
+    ),
+    check_parity: bool = typer.Option(
+        False,
+        help="Also build each source with the pandas engine and fail the sources where the two engines differ.",
+    ),
 ) -> None:
     """:warning: Analyze the data.
 
     This command takes the various output files and joins them to the original data for
-    a "wide-form" datafile that is commonly used in data analysis.
+    a "wide-form" datafile that is commonly used in data analysis. It is written to
+    Parquet with the drug flags as boolean columns.
 
     This command will geocode data sources and save it to the data directory.
 
@@ -191,14 +406,128 @@ def analyze(
     Expects the drugs to be extracted before running this command.
     Expects the data to be geocoded before running this command.
 
-    Example: opendata-pipeline analyze --use-remote
+    A source that fails doesn't stop the others; the command fails once they are done.
+
+    The `polars` engine builds the same wide-form data with lazy polars queries. Use
+    `--check-parity` to compare it with the `pandas` engine on your data.
+
+    Example: opendata-pipeline analyze --use-remote --workers 4
     """
     utils.console.rule("[bold cyan]Analyzing data")
     settings = get_settings(remote=use_remote)
-    analyzer.run(settings=settings)
+    analyzer.run(
+        settings=settings,
+        dense_csv=dense_csv,
+        workers=workers,
+        max_memory_gb=max_memory_gb,
+        engine=engine,
+        check_parity=check_parity,
+    )
     utils.console.log("[bold green]Analysis complete!")
 
 
+@app.command("stand-in")
+def serve_stand_in(
+    host: str = typer.Option("127.0.0.1", help="Host to bind the server to."),
+    port: int = typer.Option(8765, help="Port to bind the server to."),
+    latency_ms: float = typer.Option(0, help="Base latency added to every response."),
+    jitter_ms: float = typer.Option(0, help="Random latency added on top."),
+    throttle_rate: float = typer.Option(0, help="Fraction of requests answered 429."),
+    error_rate: float = typer.Option(0, help="Fraction of requests answered 5xx."),
+    timeout_rate: float = typer.Option(0, help="Fraction of requests that hang."),
+    hang_seconds: float = typer.Option(30, help="How long a hung request stalls."),
+    page_size: int = typer.Option(1000, help="Max records returned per page."),
+) -> None:
+    """Serve the local ArcGIS/Socrata stand-in until interrupted.
+
+    Point `geocode.build_url(base_url=...)` or a data source `url` at it to test
+    against injected latency, throttling and errors instead of the real services.
+
+    Example: opendata-pipeline stand-in --throttle-rate 0.2 --latency-ms 150
+    """
+    utils.console.rule("[bold cyan]Serving stand-in")
+    config = stand_in.StandInConfig(
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        throttle_rate=throttle_rate,
+        error_rate=error_rate,
+        timeout_rate=timeout_rate,
+        hang_seconds=hang_seconds,
+        page_size=page_size,
+    )
+    server = stand_in.StandInServer((host, port), config)
+    utils.console.log(f"Stand-in server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+@app.command("benchmark")
+def benchmark(
+    geocode_calls: int = typer.Option(200, help="Number of geocoding calls."),
+    page_calls: int = typer.Option(10, help="Number of paginated fetch calls."),
+    concurrency: int = typer.Option(10, help="Max concurrent calls."),
+    latency_ms: float = typer.Option(50, help="Base latency added to every response."),
+    jitter_ms: float = typer.Option(50, help="Random latency added on top."),
+    throttle_rate: float = typer.Option(
+        0.05, help="Fraction of requests answered 429."
+    ),
+    error_rate: float = typer.Option(0.02, help="Fraction of requests answered 5xx."),
+    timeout_rate: float = typer.Option(0.01, help="Fraction of requests that hang."),
+    hang_seconds: float = typer.Option(3, help="How long a hung request stalls."),
+    page_size: int = typer.Option(1000, help="Max records returned per page."),
+    client_timeout: float = typer.Option(2, help="Client timeout in seconds."),
+    retry_delay: float = typer.Option(0.1, help="Geocoding retry delay in seconds."),
+    seed: Optional[int] = typer.Option(None, help="Seed for the fault injection."),
+    hedge: bool = typer.Option(False, help="Hedge slow geocoding calls."),
+    hedge_percentile: float = typer.Option(95, help="Latency percentile to hedge at."),
+    max_hedge_rate: float = typer.Option(0.05, help="Max fraction of calls hedged."),
+) -> None:
+    """Measure geocode/fetch throughput against the local stand-in server.
+
+    Starts the stand-in on a free port, drives the real `get_geo_result` and
+    `get_record_set` code paths against it and reports requests/sec, p50/p99
+    latency and retry counts.
+
+    Example: opendata-pipeline benchmark --throttle-rate 0.3 --concurrency 20
+    """
+    utils.console.rule("[bold cyan]Benchmarking against stand-in")
+    config = stand_in.StandInConfig(
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        throttle_rate=throttle_rate,
+        error_rate=error_rate,
+        timeout_rate=timeout_rate,
+        hang_seconds=hang_seconds,
+        page_size=page_size,
+        seed=seed,
+    )
+    hedger = geocoder.RequestHedger(
+        enabled=hedge,
+        hedge_percentile=hedge_percentile,
+        max_hedge_rate=max_hedge_rate,
+    )
+    server = stand_in.start_server(config)
+    try:
+        reports = asyncio.run(
+            stand_in.run_harness(
+                server,
+                geocode_calls=geocode_calls,
+                page_calls=page_calls,
+                concurrency=concurrency,
+                client_timeout=client_timeout,
+                retry_delay=retry_delay,
+                hedger=hedger,
+            )
+        )
+    finally:
+        server.shutdown()
+    stand_in.log_reports(reports)
+    hedger.log_stats("geocode")
+    utils.console.log("[bold green]Benchmark complete!")
+
+
 @app.command("teardown")
 def teardown():
     """Teardown the project, deleting all data files."""
@@ -6,7 +6,7 @@ The settings are stored in a JSON file in the user's home directory.
 
 from __future__ import annotations
 
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel, Field, validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -33,6 +33,18 @@ class GeoBounds(BaseModel):
     spatial_reference: SpatialReference = Field(..., description="Spatial reference")
     """The spatial reference for the bounds."""
 
+    def extent(self, margin: float = 0.0) -> tuple[float, float, float, float]:
+        """The bounds as `(xmin, ymin, xmax, ymax)`, grown by `margin` on every side.
+
+        Tolerates swapped min/max values in the config.
+        """
+        return (
+            min(self.xmin, self.xmax) - margin,
+            min(self.ymin, self.ymax) - margin,
+            max(self.xmin, self.xmax) + margin,
+            max(self.ymin, self.ymax) + margin,
+        )
+
 
 class AddressFields(BaseModel):
     """The address fields for a dataset."""
@@ -58,11 +70,37 @@ class GeoConfig(BaseModel):
     """List of address fields."""
     bounds: GeoBounds = Field(..., description="Bounding box for geocoding")
     """Bounding box for geocoding."""
+    county_fips_codes: Optional[list[str]] = Field(
+        None, description="County FIPS codes to restrict the spatial join to"
+    )
+    """County FIPS codes (3 digits, e.g. "031" for Cook) to restrict the spatial join to.
+
+    If None the tracts are only clipped to the `bounds`.
+    """
+    coordinate_reference: SpatialReference = Field(
+        default_factory=lambda: SpatialReference(wkid=4326),
+        description="Spatial reference of the lat/lon fields",
+    )
+    """Spatial reference of `lat_field`/`lon_field`.
+
+    Defaults to WGS84 (4326). Projected sources, such as ArcGIS services queried
+    with `outSR=102100`, are transformed to WGS84 before spatial joining.
+    """
     spatial_join: bool = Field(
         ...,
         description="Should this dataset be spatially joined to the county and census tract boundaries?",
     )
     """Should this dataset be spatially joined to the county and census tract boundaries?"""
+    geographies: list[Literal["county", "block_group", "zcta"]] = Field(
+        default_factory=list,
+        description="Geographies to assign in addition to census tracts",
+    )
+    """Geographies to assign in addition to census tracts when spatially joining.
+
+    Each adds a `<geography>_geoid` column. Counties come from the tract GEOID and
+    block groups are looked up once with the tract derived from them, so only
+    `zcta` (which does not nest in tracts) adds another point-in-polygon pass.
+    """
 
 
 class DataSource(BaseModel):
@@ -105,6 +143,15 @@ class DataSource(BaseModel):
         ..., description="Date field, usually death-date, to analyze for timeseries"
     )
     """Date column to analyze for timeseries"""
+    date_format: Optional[str] = Field(
+        None,
+        description="Format of the date field (strftime, `ISO8601` or `mixed`), inferred if not set",
+    )
+    """Format of the date field (`strftime` codes, or `ISO8601`/`mixed`), inferred from the first value if not set"""
+    date_unit: Optional[Literal["s", "ms", "us", "ns"]] = Field(
+        None, description="Unit of the date field if it holds epoch timestamps"
+    )
+    """Unit of the date field if it holds epoch timestamps (e.g. `ms` for ArcGIS dates)"""
 
     state_fips_code: str = Field(..., description="The Census FIPS code for this state")
     """The Census FIPS code (with leading zeros when needed) for this State.
@@ -144,6 +191,11 @@ class DataSource(BaseModel):
                 f"Data source {self.name} is not supported. Must need pagination or be open data source"
             )
 
+    @property
+    def needs_spatial_join(self) -> bool:
+        """Whether or not the data source should be joined to census tracts."""
+        return self.spatial_config is not None and self.spatial_config.spatial_join
+
     @property
     def records_filename(self) -> str:
         """The filename for the records file."""
@@ -160,11 +212,21 @@ class DataSource(BaseModel):
         """The filename for the wide-form CSV file."""
         return f"{self.name.replace(' ', '_').lower()}_temp.csv"
 
+    @property
+    def temp_wide_parquet_filename(self) -> str:
+        """The filename for the wide-form Parquet file (drug indicators as booleans)."""
+        return f"{self.name.replace(' ', '_').lower()}_temp.parquet"
+
     @property
     def wide_form_filename(self) -> str:
         """The filename for the spatial join file."""
         return f"{self.name.replace(' ', '_').lower()}_wide_form.csv"
 
+    @property
+    def slim_filename(self) -> str:
+        """The filename for the slim release CSV file."""
+        return f"{self.name.replace(' ', '_').lower()}_slim.csv"
+
 
 class Settings(BaseSettings):
     """The settings for the package."""
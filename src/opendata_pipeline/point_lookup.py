@@ -0,0 +1,226 @@
+"""This module contains the point-in-polygon engine used for tract assignment.
+
+`geopandas.sjoin` builds a fresh R-tree on every run and tests every point
+against full resolution polygons. `PolygonLookup` instead precomputes a fine
+grid over the layer: cells that lie entirely inside one polygon resolve points
+to that polygon directly, cells outside every polygon resolve to nothing, and
+only points in cells straddling a boundary fall back to an exact `within` test
+against an STRtree of the (prepared) polygons.
+
+The grid is built once per layer and saved next to the cached layer in
+`data/spatial/cache`, so later runs only pay for loading it.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+from pathlib import Path
+
+import geopandas
+import numpy as np
+import shapely
+
+from opendata_pipeline import census_layers
+from opendata_pipeline.utils import console
+
+DEFAULT_CELL_SIZE = 0.01
+"""Grid cell size in degrees (roughly 1km)."""
+
+OUTSIDE = -1
+"""Cell/point code for "not in any polygon"."""
+
+BOUNDARY = -2
+"""Cell code for "straddles a boundary, test the point exactly"."""
+
+
+class PolygonLookup:
+    """Assigns points to the polygons of a layer.
+
+    Attributes:
+        geometries (np.ndarray): The polygons, prepared for repeated predicates.
+        tree (shapely.STRtree): Spatial index over `geometries`.
+        origin (tuple[float, float]): Lower left corner of the grid.
+        cell_size (float): Grid cell size in degrees.
+        cells (np.ndarray): `(rows, cols)` polygon position, `OUTSIDE` or `BOUNDARY` per cell.
+    """
+
+    def __init__(
+        self,
+        geometries: np.ndarray,
+        origin: tuple[float, float],
+        cell_size: float,
+        cells: np.ndarray,
+    ):
+        self.geometries = geometries
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self.origin = origin
+        self.cell_size = cell_size
+        self.cells = cells
+
+    @classmethod
+    def build(
+        cls, layer: geopandas.GeoDataFrame, cell_size: float = DEFAULT_CELL_SIZE
+    ) -> PolygonLookup:
+        """Build the lookup, classifying every grid cell over the layer's extent.
+
+        Args:
+            layer (geopandas.GeoDataFrame): The polygon layer (EPSG:4326).
+            cell_size (float): Grid cell size in degrees.
+
+        Returns:
+            PolygonLookup: The lookup, polygon positions follow the layer's row order.
+        """
+        geometries = np.asarray(layer.geometry.values, dtype=object)
+        xmin, ymin, xmax, ymax = shapely.total_bounds(geometries)
+        cols = max(int(np.ceil((xmax - xmin) / cell_size)), 1)
+        rows = max(int(np.ceil((ymax - ymin) / cell_size)), 1)
+        console.log(
+            f"Building {rows:,}x{cols:,} lookup grid for {len(layer):,} polygons"
+        )
+
+        col_idx, row_idx = np.meshgrid(np.arange(cols), np.arange(rows))
+        x0 = xmin + col_idx.ravel() * cell_size
+        y0 = ymin + row_idx.ravel() * cell_size
+        boxes = shapely.box(x0, y0, x0 + cell_size, y0 + cell_size)
+
+        lookup = cls(geometries, (xmin, ymin), cell_size, np.empty(0))
+        box_idx, geom_idx = lookup.tree.query(boxes, predicate="intersects")
+        hits = np.bincount(box_idx, minlength=len(boxes))
+        cells = np.full(len(boxes), OUTSIDE, dtype=np.int32)
+        cells[hits > 1] = BOUNDARY
+        # a cell touching a single polygon is only safe if that polygon covers it
+        single = hits[box_idx] == 1
+        covered = shapely.contains_properly(
+            geometries[geom_idx[single]], boxes[box_idx[single]]
+        )
+        cells[box_idx[single]] = np.where(covered, geom_idx[single], BOUNDARY)
+        lookup.cells = cells.reshape(rows, cols)
+        resolved = (lookup.cells != BOUNDARY).mean()
+        console.log(f"{resolved:.1%} of grid cells resolve without a polygon test")
+        return lookup
+
+    def lookup(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """Find the polygon each point falls within.
+
+        Args:
+            lon (np.ndarray): Longitudes, NaN for missing.
+            lat (np.ndarray): Latitudes, NaN for missing.
+
+        Returns:
+            np.ndarray: The polygon position for each point, `OUTSIDE` if none.
+        """
+        lon = np.asarray(lon, dtype="float64")
+        lat = np.asarray(lat, dtype="float64")
+        rows, cols = self.cells.shape
+        with np.errstate(invalid="ignore"):
+            col = np.floor((lon - self.origin[0]) / self.cell_size)
+            row = np.floor((lat - self.origin[1]) / self.cell_size)
+        on_grid = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+        result = np.full(len(lon), OUTSIDE, dtype=np.int32)
+        result[on_grid] = self.cells[row[on_grid].astype(int), col[on_grid].astype(int)]
+
+        exact = np.flatnonzero(result == BOUNDARY)
+        result[exact] = OUTSIDE
+        if len(exact):
+            points = shapely.points(lon[exact], lat[exact])
+            point_idx, geom_idx = self.tree.query(points, predicate="within")
+            # polygons don't overlap, but keep the first match like a dict would
+            first = np.unique(point_idx, return_index=True)[1]
+            result[exact[point_idx[first]]] = geom_idx[first]
+        return result
+
+    def save(self, path: Path, key: str) -> None:
+        """Save the grid to disk. `key` identifies the layer it was built from."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(
+            path,
+            key=np.array(key),
+            origin=np.array(self.origin),
+            cell_size=np.array(self.cell_size),
+            cells=self.cells,
+        )
+
+    @classmethod
+    def load(
+        cls, path: Path, key: str, layer: geopandas.GeoDataFrame
+    ) -> PolygonLookup | None:
+        """Load a saved grid for `layer`, None if missing or built from another layer."""
+        if not path.is_file():
+            return None
+        with np.load(path) as saved:
+            if str(saved["key"]) != key:
+                console.log(f"{path.name} is stale, rebuilding")
+                return None
+            return cls(
+                np.asarray(layer.geometry.values, dtype=object),
+                tuple(saved["origin"]),
+                float(saved["cell_size"]),
+                saved["cells"],
+            )
+
+
+def lookup_key(source: Path, cell_size: float, clip: str) -> str:
+    """Key identifying a lookup by the layer's source file, clipping and grid size."""
+    return f"{census_layers.file_hash(source)}:{clip}:{cell_size}"
+
+
+@functools.cache
+def load_layer_lookup(
+    kind: str,
+    fips_code: str,
+    extent: tuple[float, float, float, float] | None = None,
+    county_fips: tuple[str, ...] | None = None,
+    cell_size: float = DEFAULT_CELL_SIZE,
+) -> PolygonLookup:
+    """Load (or build and save) the lookup for a layer.
+
+    Polygon positions returned by the lookup index into
+    `census_layers.load_clipped_layer(kind, fips_code, extent, county_fips)`.
+
+    Args:
+        kind (str): The layer kind, a key of `census_layers.LAYER_FILES`.
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (tuple[float, float, float, float] | None): Clip the layer to this box first.
+        county_fips (tuple[str, ...] | None): Restrict the layer to these counties first.
+        cell_size (float): Grid cell size in degrees.
+
+    Returns:
+        PolygonLookup: The layer lookup.
+    """
+    source = census_layers.layer_zip_path(kind, fips_code)
+    layer = census_layers.load_clipped_layer(kind, fips_code, extent, county_fips)
+    clip = f"{extent}:{county_fips}"
+    parquet_path, _ = census_layers.cache_paths(source)
+    digest = hashlib.sha1(clip.encode("utf-8")).hexdigest()[:10]
+    path = parquet_path.with_suffix(f".{digest}.index.npz")
+    key = lookup_key(source, cell_size, clip)
+    lookup = PolygonLookup.load(path, key, layer)
+    if lookup is None:
+        lookup = PolygonLookup.build(layer, cell_size=cell_size)
+        lookup.save(path, key)
+    return lookup
+
+
+def load_tract_lookup(
+    fips_code: str,
+    extent: tuple[float, float, float, float] | None = None,
+    county_fips: tuple[str, ...] | None = None,
+    cell_size: float = DEFAULT_CELL_SIZE,
+) -> PolygonLookup:
+    """Load (or build and save) the tract lookup for a state.
+
+    Polygon positions returned by the lookup index into
+    `census_layers.load_clipped_tracts(fips_code, extent, county_fips)`.
+
+    Args:
+        fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
+        extent (tuple[float, float, float, float] | None): Clip the tracts to this box first.
+        county_fips (tuple[str, ...] | None): Restrict the tracts to these counties first.
+        cell_size (float): Grid cell size in degrees.
+
+    Returns:
+        PolygonLookup: The tract lookup.
+    """
+    return load_layer_lookup("tract", fips_code, extent, county_fips, cell_size)
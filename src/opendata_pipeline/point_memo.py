@@ -0,0 +1,171 @@
+"""This module memoizes point-in-polygon results across runs.
+
+Nearly every record has the same coordinates from one weekly run to the next,
+so the GEOID found for each point is saved in a SQLite file next to the cached
+layers (`data/spatial/cache/point_memo.sqlite`). Only points missing from the
+memo go through `point_lookup`.
+
+Points are keyed by their coordinates quantized to `QUANTUM` degrees (about
+0.1m), packed into one integer. Entries are scoped to a layer, state and clip,
+and versioned by the layer's TIGER file name and hash, so replacing a `tl_YYYY`
+zip (a new vintage) drops that scope's entries.
+
+Each process loads a scope's entries once into sorted arrays, memo lookups are
+a vectorized binary search.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from opendata_pipeline import census_layers, point_lookup
+from opendata_pipeline.utils import console
+
+MEMO_PATH = census_layers.CACHE_DIR / "point_memo.sqlite"
+"""The memo database."""
+
+QUANTUM = 1e-6
+"""Coordinate resolution of the memo keys, in degrees."""
+
+LON_BITS = 29
+"""Bits for the quantized longitude in a packed key (360 / 1e-6 < 2**29)."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    scope TEXT NOT NULL,
+    version TEXT NOT NULL,
+    point INTEGER NOT NULL,
+    geoid TEXT,
+    PRIMARY KEY (scope, point)
+) WITHOUT ROWID
+"""
+
+
+def pack(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """Pack coordinates into int64 memo keys, -1 for missing coordinates."""
+    valid = ~(np.isnan(lon) | np.isnan(lat))
+    qlon = np.round((np.where(valid, lon, 0) + 180) / QUANTUM).astype(np.int64)
+    qlat = np.round((np.where(valid, lat, 0) + 90) / QUANTUM).astype(np.int64)
+    return np.where(valid, (qlat << LON_BITS) | qlon, -1)
+
+
+def scope_key(kind: str, fips_code: str, clip: str) -> str:
+    """The memo scope of a layer, state and clip."""
+    digest = hashlib.sha1(clip.encode("utf-8")).hexdigest()[:10]
+    return f"{kind}:{fips_code}:{digest}"
+
+
+def version_key(source: Path) -> str:
+    """The memo version of a layer: its TIGER file name (with vintage) and hash."""
+    return f"{source.name}:{census_layers.file_hash(source)[:16]}"
+
+
+def connect() -> sqlite3.Connection:
+    """Open the memo database, creating it when needed."""
+    path = Path().cwd() / MEMO_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # worker processes write concurrently
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+@functools.cache
+def load_entries(scope: str, version: str) -> tuple[np.ndarray, np.ndarray]:
+    """Load a scope's entries as sorted `(points, geoids)`, dropping stale ones.
+
+    Args:
+        scope (str): The memo scope (see `scope_key`).
+        version (str): The current layer version (see `version_key`).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Sorted packed points and their GEOIDs
+            (None where the point is in no polygon).
+    """
+    with connect() as conn:
+        stale = conn.execute(
+            "DELETE FROM memo WHERE scope = ? AND version != ?", (scope, version)
+        ).rowcount
+        if stale:
+            console.log(f"Dropped {stale:,} memoized points for {scope}, layer changed")
+        rows = conn.execute(
+            "SELECT point, geoid FROM memo WHERE scope = ? ORDER BY point", (scope,)
+        ).fetchall()
+    conn.close()
+    points = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    geoids = np.array([r[1] for r in rows], dtype=object)
+    return points, geoids
+
+
+def save_entries(
+    scope: str, version: str, points: np.ndarray, geoids: np.ndarray
+) -> None:
+    """Save new entries to the memo."""
+    rows = zip(
+        [scope] * len(points),
+        [version] * len(points),
+        points.tolist(),
+        geoids.tolist(),
+        strict=True,
+    )
+    with connect() as conn:
+        conn.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+
+
+def memoized_lookup(
+    lookup: point_lookup.PolygonLookup,
+    layer: pd.DataFrame,
+    geoid_column: str,
+    scope: str,
+    version: str,
+    lon: np.ndarray,
+    lat: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Look points up in the memo, falling back to `lookup` for the rest.
+
+    Args:
+        lookup (point_lookup.PolygonLookup): The lookup for the layer.
+        layer (pd.DataFrame): The layer the lookup was built from.
+        geoid_column (str): The GEOID column of the layer.
+        scope (str): The memo scope (see `scope_key`).
+        version (str): The current layer version (see `version_key`).
+        lon (np.ndarray): Longitudes, NaN for missing.
+        lat (np.ndarray): Latitudes, NaN for missing.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The polygon position for each point
+            (`point_lookup.OUTSIDE` if none) and whether it came from the memo.
+    """
+    keys = pack(lon, lat)
+    # a trailing None so that OUTSIDE (-1) positions map to no GEOID
+    layer_geoids = np.append(layer[geoid_column].to_numpy(dtype=object), None)
+    positions = np.full(len(keys), point_lookup.OUTSIDE, dtype=np.int32)
+    hit = np.zeros(len(keys), dtype=bool)
+
+    points, geoids = load_entries(scope, version)
+    if len(points):
+        slot = np.minimum(np.searchsorted(points, keys), len(points) - 1)
+        hit = (keys >= 0) & (points[slot] == keys)
+        # GEOIDs map back to positions in the (clipped) layer of this run
+        found = pd.Series(geoids[slot[hit]], dtype="string")
+        positions[hit] = pd.Index(layer_geoids[:-1]).get_indexer(found)
+
+    # missing (or out of bounds) points are never memoized
+    miss = np.flatnonzero(~hit & (keys >= 0))
+    if len(miss):
+        # duplicates are common (e.g. records geocoded to the same address)
+        new_keys, first, inverse = np.unique(
+            keys[miss], return_index=True, return_inverse=True
+        )
+        new_positions = lookup.lookup(lon[miss[first]], lat[miss[first]])
+        positions[miss] = new_positions[inverse]
+        save_entries(scope, version, new_keys, layer_geoids[new_positions])
+    return positions, hit
@@ -0,0 +1,239 @@
+"""This module flags records that are unlikely to geocode *before* any network call.
+
+The rules are vectorized (pandas string ops) and each flagged record gets a
+`skip_reason`:
+
+- `empty_street`: the same values `geocode.clean_address_string` rejects
+- `po_box`: PO boxes have no rooftop location
+- `intersection`: an intersection missing its cross street (e.g. `MAIN ST &`)
+- `mile_marker`: highway mile markers/posts
+- `zip_out_of_bounds`: the ZIP's internal point is outside the source's `GeoBounds`
+- `city_out_of_bounds`: no place with that name lies inside the source's `GeoBounds`
+
+The ZIP and city checks use the Census Gazetteer files, which (like the TIGER
+tract files) need to be downloaded into `data/spatial`:
+
+- https://www2.census.gov/geo/docs/maps-data/data/gazetteer/2024_Gazetteer/2024_Gaz_zcta_national.zip
+- https://www2.census.gov/geo/docs/maps-data/data/gazetteer/2024_Gazetteer/2024_Gaz_place_national.zip
+
+When they are missing those two checks are skipped.
+"""
+
+from __future__ import annotations
+
+import functools
+from pathlib import Path
+from typing import Any
+
+import orjson
+import pandas as pd
+
+from opendata_pipeline import models
+from opendata_pipeline.utils import console
+
+ZCTA_GAZETTEER = Path("data") / "spatial" / "2024_Gaz_zcta_national.txt"
+"""Census ZCTA gazetteer (ZIP internal points)."""
+
+PLACE_GAZETTEER = Path("data") / "spatial" / "2024_Gaz_place_national.txt"
+"""Census place gazetteer (city internal points)."""
+
+BOUNDS_MARGIN = 0.1
+"""Degrees added around the `GeoBounds` before calling a ZIP/city out of bounds."""
+
+PO_BOX = r"\bp\.?\s*o\.?\s*box\b|\bpost\s+office\s+box\b|^box\s+\d"
+DANGLING_INTERSECTION = r"^(?:&|and\b|@|/)|(?:&|\band|@|/)$"
+MILE_MARKER = r"\bmile\s*(?:marker|post)\b|\bmilepost\b|\b(?:mm|mp)\s*\d"
+PLACE_SUFFIX = r"\s+(?:city|village|town|township|borough|cdp|municipality)$"
+
+UNLIKELY_VALUES = ("same", "none", "undetermined", "no scene")
+"""Street values `geocode.clean_address_string` rejects outright."""
+
+NO_CALL_REASONS = {"empty_street"}
+"""Reasons that never made a network call before the pre-flight existed."""
+
+
+def normalize_zip(zips: pd.Series) -> pd.Series:
+    """Normalize ZIP values (ints, floats, ZIP+4) to 5 character strings."""
+    return (
+        zips.astype("string")
+        .str.replace(r"\.0$", "", regex=True)
+        .str.extract(r"^\s*(\d{5})", expand=False)
+    )
+
+
+def normalize_place(names: pd.Series) -> pd.Series:
+    """Lowercase city/place names and drop the Census LSAD suffix."""
+    return (
+        names.astype("string")
+        .str.lower()
+        .str.strip()
+        .str.replace(PLACE_SUFFIX, "", regex=True)
+    )
+
+
+def read_gazetteer(path: Path, key: str) -> pd.DataFrame | None:
+    """Read a Census gazetteer file, returns None if it is not downloaded."""
+    if not path.is_file():
+        console.log(f"[yellow]{path} not found, skipping that pre-flight check")
+        return None
+    df = pd.read_csv(path, sep="\t", dtype={key: str})
+    # the last column name has trailing whitespace
+    df.columns = df.columns.str.strip()
+    return df
+
+
+@functools.cache
+def zip_points() -> pd.DataFrame | None:
+    """ZIP (ZCTA) internal points indexed by 5 digit ZIP."""
+    df = read_gazetteer(ZCTA_GAZETTEER, key="GEOID")
+    if df is None:
+        return None
+    return df.set_index("GEOID")[["INTPTLAT", "INTPTLONG"]]
+
+
+@functools.cache
+def place_points() -> pd.DataFrame | None:
+    """Place internal points with a normalized `name` column."""
+    df = read_gazetteer(PLACE_GAZETTEER, key="GEOID")
+    if df is None:
+        return None
+    df["name"] = normalize_place(df["NAME"])
+    return df[["name", "INTPTLAT", "INTPTLONG"]]
+
+
+def in_bounds(
+    lat: pd.Series, lon: pd.Series, bounds: models.GeoBounds, margin: float
+) -> pd.Series:
+    """Whether each point is inside the bounds (plus a margin)."""
+    xmin, ymin, xmax, ymax = bounds.extent(margin)
+    return lat.between(ymin, ymax) & lon.between(xmin, xmax)
+
+
+def zip_in_bounds(
+    zips: pd.Series, bounds: models.GeoBounds, margin: float
+) -> pd.Series:
+    """Whether each ZIP is consistent with the bounds.
+
+    Unknown or missing ZIPs are given the benefit of the doubt (True).
+    """
+    points = zip_points()
+    if points is None:
+        return pd.Series(True, index=zips.index)
+    inside = in_bounds(points["INTPTLAT"], points["INTPTLONG"], bounds, margin)
+    known = zips.isin(points.index)
+    return ~known | zips.isin(inside[inside].index)
+
+
+def city_in_bounds(
+    cities: pd.Series, bounds: models.GeoBounds, margin: float
+) -> pd.Series:
+    """Whether each city is consistent with the bounds.
+
+    Place names repeat across states, so a city only fails when *no* place with
+    that name lies inside the bounds. Unknown names pass.
+    """
+    points = place_points()
+    if points is None:
+        return pd.Series(True, index=cities.index)
+    inside = in_bounds(points["INTPTLAT"], points["INTPTLONG"], bounds, margin)
+    names = normalize_place(cities)
+    known = names.isin(points["name"])
+    return ~known | names.isin(points.loc[inside, "name"])
+
+
+def classify(
+    df: pd.DataFrame, config: models.DataSource, margin: float = BOUNDS_MARGIN
+) -> pd.Series:
+    """Classify records that are unlikely to geocode.
+
+    Args:
+        df (pd.DataFrame): The records to geocode (see `geocode.read_records`).
+        config (models.DataSource): The data source config.
+        margin (float): Degrees added around the bounds for the ZIP/city checks.
+
+    Returns:
+        pd.Series: The skip reason for each record, `<NA>` for records to geocode.
+    """
+    if config.spatial_config is None:
+        raise ValueError("spatial_config is required for geocoding")
+    address_config = config.spatial_config.address_fields
+    bounds = config.spatial_config.bounds
+    reasons = pd.Series(pd.NA, index=df.index, dtype="string")
+
+    street = df[address_config.street].astype("string").str.lower().str.strip()
+    # first matching rule wins, so assign in reverse priority order
+    if address_config.city is not None:
+        city_ok = city_in_bounds(df[address_config.city], bounds, margin)
+        reasons = reasons.mask(~city_ok, "city_out_of_bounds")
+    if address_config.zip is not None:
+        zip_ok = zip_in_bounds(normalize_zip(df[address_config.zip]), bounds, margin)
+        reasons = reasons.mask(~zip_ok, "zip_out_of_bounds")
+    reasons = reasons.mask(
+        street.str.contains(MILE_MARKER, regex=True, na=False), "mile_marker"
+    )
+    reasons = reasons.mask(
+        street.str.contains(DANGLING_INTERSECTION, regex=True, na=False),
+        "intersection",
+    )
+    reasons = reasons.mask(street.str.contains(PO_BOX, regex=True, na=False), "po_box")
+    empty = (
+        street.isna()
+        | street.str.contains("unk", regex=False, na=False)
+        | street.str.contains("n/a", regex=False, na=False)
+        | street.isin(UNLIKELY_VALUES)
+    )
+    reasons = reasons.mask(empty, "empty_street")
+    return reasons
+
+
+def filter_records(
+    records: list[dict[str, Any]], config: models.DataSource
+) -> tuple[list[dict[str, Any]], pd.DataFrame]:
+    """Split records into those worth geocoding and those to skip.
+
+    Args:
+        records (list[dict[str, Any]]): The records from `geocode.read_records`.
+        config (models.DataSource): The data source config.
+
+    Returns:
+        tuple[list[dict[str, Any]], pd.DataFrame]: The records to geocode and the
+            skipped `CaseIdentifier`s with their `skip_reason` and `data_source`.
+    """
+    if not records:
+        return records, pd.DataFrame(
+            columns=["CaseIdentifier", "skip_reason", "data_source"]
+        )
+    df = pd.DataFrame(records)
+    reasons = classify(df, config)
+    skip = reasons.notna()
+    kept = [r for r, s in zip(records, skip.tolist(), strict=True) if not s]
+    skipped = pd.DataFrame(
+        {
+            "CaseIdentifier": df.loc[skip, "CaseIdentifier"],
+            "skip_reason": reasons[skip],
+            "data_source": config.name,
+        }
+    )
+    return kept, skipped
+
+
+def log_summary(skipped: pd.DataFrame) -> None:
+    """Log per-source skip counts and how many ArcGIS calls were saved."""
+    if skipped.empty:
+        console.log("Pre-flight skipped no records")
+        return
+    for source, group in skipped.groupby("data_source", sort=False):
+        counts = group["skip_reason"].value_counts()
+        saved = int(counts[~counts.index.isin(NO_CALL_REASONS)].sum())
+        breakdown = ", ".join(f"{k}={v:,}" for k, v in counts.items())
+        console.log(
+            f"Pre-flight skipped {len(group):,} {source} records, "
+            f"saving {saved:,} geocoding calls ({breakdown})"
+        )
+
+
+def export_skipped(skipped: pd.DataFrame) -> None:
+    """Export the skipped records and their reasons to file."""
+    with open(Path("data") / "geocode_skipped.jsonl", "w") as f:
+        for record in skipped.to_dict(orient="records"):
+            f.write(orjson.dumps(record, default=str).decode("utf-8") + "\n")
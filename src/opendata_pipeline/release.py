@@ -0,0 +1,161 @@
+"""This module writes the release deliverables from the spatially joined files.
+
+The wide-form CSVs carry the point geometry as WKT text next to every tract
+column, so getting one county/year out of them means downloading and parsing
+the whole file. For each source this writes:
+
+- GeoParquet (WKB point geometry, EPSG:4326) partitioned by source and death
+  year: `data/geoparquet/data_source=<source>/death_year=<year>/part-0.parquet`.
+  Sources that are not spatially joined are written as plain Parquet.
+- A slim CSV (`<source>_slim.csv`) without the geometry and the tract detail
+  columns, the tract is still identified by `GEOID`.
+
+The drug flags (1 or missing in the CSVs) are written to Parquet as boolean
+columns, using the flag names analyze keeps in its Parquet file.
+"""
+
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+
+import geopandas
+import pandas as pd
+
+from opendata_pipeline import analyze, manage_config, models
+from opendata_pipeline.utils import console
+
+RELEASE_DIR = Path("data") / "geoparquet"
+"""Root of the partitioned GeoParquet dataset."""
+
+UNKNOWN_YEAR = "unknown"
+"""Partition value for records without a death year."""
+
+TRACT_DETAIL_COLUMNS = [
+    "geometry",
+    "index_right",
+    "STATEFP",
+    "COUNTYFP",
+    "TRACTCE",
+    "NAME",
+    "NAMELSAD",
+    "MTFCC",
+    "FUNCSTAT",
+    "ALAND",
+    "AWATER",
+    "INTPTLAT",
+    "INTPTLON",
+]
+"""Columns of the wide-form file left out of the slim CSV."""
+
+GEOID_COLUMNS = ["GEOID", "county_geoid", "block_group_geoid", "zcta_geoid"]
+"""Identifier columns read as text to keep their leading zeros."""
+
+
+def source_key(source: models.DataSource) -> str:
+    """The partition value for a source (its file name prefix)."""
+    return source.name.replace(" ", "_").lower()
+
+
+def read_wide_form(source: models.DataSource) -> pd.DataFrame:
+    """Read the spatially joined file for a source, identifiers kept as text."""
+    return pd.read_csv(
+        Path("data") / source.wide_form_filename,
+        low_memory=False,
+        dtype={column: "string" for column in GEOID_COLUMNS},
+    )
+
+
+def indicator_columns(source: models.DataSource) -> list[str]:
+    """The drug flag columns of a source, as listed by analyze (none if unknown)."""
+    path = Path("data") / source.temp_wide_parquet_filename
+    if not path.is_file():
+        return []
+    return analyze.read_wide_metadata(path)["indicators"]
+
+
+def to_boolean_flags(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """Convert drug flag columns (1 or missing) to booleans."""
+    present = [col for col in columns if col in df.columns]
+    return df.assign(**{col: df[col].notna() for col in present})
+
+
+def to_geodataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """Rebuild the point geometry from the composite coordinates.
+
+    Args:
+        df (pd.DataFrame): The wide-form records.
+
+    Returns:
+        pd.DataFrame: A GeoDataFrame with a WKB-serializable point geometry, or
+            the records unchanged (minus any WKT column) when they have no
+            coordinates.
+    """
+    df = df.drop(columns="geometry", errors="ignore")
+    if "composite_latitude" not in df.columns:
+        return df
+    return geopandas.GeoDataFrame(
+        df,
+        geometry=geopandas.points_from_xy(
+            df["composite_longitude"], df["composite_latitude"]
+        ),
+        crs="EPSG:4326",
+    )
+
+
+def write_partitions(df: pd.DataFrame, source: models.DataSource) -> int:
+    """Write a source's records partitioned by death year, replacing older output.
+
+    Args:
+        df (pd.DataFrame): The records, a GeoDataFrame for GeoParquet output.
+        source (models.DataSource): The data source config.
+
+    Returns:
+        int: The number of partitions written.
+    """
+    source_dir = RELEASE_DIR / f"data_source={source_key(source)}"
+    shutil.rmtree(source_dir, ignore_errors=True)
+    years = (
+        pd.to_numeric(df["death_year"], errors="coerce").astype("Int64")
+        if "death_year" in df.columns
+        else pd.Series(pd.NA, index=df.index, dtype="Int64")
+    )
+    partitions = years.astype("string").fillna(UNKNOWN_YEAR)
+    count = 0
+    for year, part in df.groupby(partitions, sort=True):
+        out_dir = source_dir / f"death_year={year}"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        # the year lives in the directory name, like a hive partitioned dataset
+        part = part.drop(columns="death_year", errors="ignore")
+        part.to_parquet(out_dir / "part-0.parquet", index=False)
+        count += 1
+    return count
+
+
+def slim(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop the geometry and tract detail columns."""
+    return df.drop(columns=TRACT_DETAIL_COLUMNS, errors="ignore")
+
+
+def run(config: models.Settings) -> None:
+    """Write the release deliverables for every source.
+
+    Args:
+        config (models.Settings): The settings for the app.
+    """
+    for source in config.sources:
+        path = Path("data") / source.wide_form_filename
+        if not path.is_file():
+            console.log(f"[yellow]{path} not found, skipping {source.name}")
+            continue
+        console.log(f"Writing release files for {source.name}")
+        df = read_wide_form(source)
+        flags = to_boolean_flags(df, indicator_columns(source))
+        count = write_partitions(to_geodataframe(flags), source)
+        console.log(f"Wrote {len(df):,} records in {count} death year partitions")
+        slim(df).to_csv(Path("data") / source.slim_filename, index=False)
+
+
+if __name__ == "__main__":
+    settings = manage_config.get_local_config()
+    run(config=settings)
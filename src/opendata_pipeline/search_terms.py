@@ -0,0 +1,122 @@
+"""This module keeps the drug search terms in a local cache.
+
+`search_terms.csv` is fetched from the drug extraction repo with a conditional
+GET (`If-None-Match` with the cached ETag), so an unchanged file is not
+downloaded again, and when GitHub can't be reached the cached copy is used.
+The cache lives in the app directory (e.g. `~/.config/opendata-pipeline`)
+next to the compiled matchers (see `drug_matcher.load_matcher`), which are
+keyed by the term file's SHA-256.
+
+Every run records the term version it used in `data/drug_terms_version.json`.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Literal, Optional
+
+import orjson
+import requests
+import typer
+from pydantic import BaseModel
+
+from opendata_pipeline.utils import console
+
+SEARCH_TERMS_URL = "https://raw.githubusercontent.com/UK-IPOP/drug-extraction/main/data/search_terms.csv"
+"""Where the search terms are published."""
+
+CACHE_DIR = Path(typer.get_app_dir("opendata-pipeline")) / "search_terms"
+"""Where the search terms and compiled matchers are cached."""
+
+VERSION_PATH = Path("data") / "drug_terms_version.json"
+"""Where a run records the term version it used."""
+
+
+class TermVersion(BaseModel):
+    """Which search terms a run used."""
+
+    sha256: str
+    """SHA-256 of `search_terms.csv`."""
+    etag: Optional[str] = None
+    """The ETag GitHub served the file with."""
+    fetched_at: str
+    """When the file was last downloaded (ISO 8601, UTC)."""
+    status: Literal["downloaded", "not_modified", "offline"] = "downloaded"
+    """How this run got the file."""
+
+
+def cache_paths() -> tuple[Path, Path]:
+    """The cached search terms file and its metadata."""
+    return CACHE_DIR / "search_terms.csv", CACHE_DIR / "search_terms.json"
+
+
+def file_sha256(path: Path) -> str:
+    """SHA-256 of a file."""
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def read_cached_version() -> TermVersion | None:
+    """The cached term version, None if the cache is empty or corrupt."""
+    terms_path, meta_path = cache_paths()
+    if not terms_path.is_file() or not meta_path.is_file():
+        return None
+    version = TermVersion.model_validate_json(meta_path.read_bytes())
+    if file_sha256(terms_path) != version.sha256:
+        console.log("[yellow]Cached search terms are corrupt, ignoring them")
+        return None
+    return version
+
+
+def fetch(url: str = SEARCH_TERMS_URL, timeout: float = 30) -> TermVersion:
+    """Refresh the cached search terms and copy them to `search_terms.csv`.
+
+    Args:
+        url (str): Where to fetch the search terms from.
+        timeout (float): Request timeout in seconds.
+
+    Raises:
+        requests.RequestException: If the terms can't be fetched and aren't cached.
+
+    Returns:
+        TermVersion: The version of the terms in `search_terms.csv`.
+    """
+    terms_path, meta_path = cache_paths()
+    cached = read_cached_version()
+    headers = {"If-None-Match": cached.etag} if cached and cached.etag else {}
+    try:
+        resp = requests.get(url, headers=headers, timeout=timeout)
+        if resp.status_code != 304:
+            resp.raise_for_status()
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        console.log(f"[yellow]Couldn't fetch search terms ({e}), using the cache")
+        version = cached.model_copy(update={"status": "offline"})
+    else:
+        if resp.status_code == 304 and cached is not None:
+            console.log("Search terms not modified, using the cache")
+            version = cached.model_copy(update={"status": "not_modified"})
+        else:
+            console.log("Downloaded search terms")
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            terms_path.write_bytes(resp.content)
+            version = TermVersion(
+                sha256=hashlib.sha256(resp.content).hexdigest(),
+                etag=resp.headers.get("ETag"),
+                fetched_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            )
+            meta_path.write_text(version.model_dump_json(indent=2))
+    shutil.copyfile(terms_path, Path("search_terms.csv"))
+    return version
+
+
+def record_version(version: TermVersion, engine: str) -> None:
+    """Record the term version (and engine) a run used."""
+    VERSION_PATH.write_bytes(
+        orjson.dumps(
+            {**version.model_dump(), "engine": engine}, option=orjson.OPT_INDENT_2
+        )
+    )
@@ -1,11 +1,19 @@
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import Generator
 
 import geopandas
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+import pyproj
 
-from opendata_pipeline import manage_config, models
+from opendata_pipeline import analyze, census_layers, enrichment, manage_config, models
 from opendata_pipeline.utils import console
 
+CLIP_MARGIN = 0.1
+"""Degrees added around a source's `GeoBounds` when clipping tracts to it."""
+
 
 def read_records(config: models.DataSource) -> pd.DataFrame:
     """Read the records from the wide-form dataset.
@@ -14,45 +22,106 @@ def read_records(config: models.DataSource) -> pd.DataFrame:
         config: The data source config.
 
     Returns:
-        df: The wide-form joined records.
+        df: The wide-form joined records, typed as they are published (see
+            `analyze.publish_types`).
     """
-    df: pd.DataFrame = pd.read_csv(
-        Path("data") / config.temp_wide_filename, low_memory=False
+    path = Path("data") / config.temp_wide_parquet_filename
+    return analyze.publish_types(
+        analyze.read_dense_wide(path), analyze.read_missing_integer_columns(path)
     )
-    return df
-
-
-def apply_composite_lat_long(
-    row, config: models.GeoConfig
-) -> tuple[str | None, str | None]:
-    """Apply the composite latitude and longitude to the dataframe."""
-    lat_val = row[config.lat_field.lower().replace(" ", "_")]
-    lon_val = row[config.lon_field.lower().replace(" ", "_")]
-    if pd.notna(lat_val) and pd.notna(lon_val):
-        if isinstance(lat_val, str):
-            x = lat_val.replace(" ", "", -1)
-            if "," in x:
-                lat, lon = x.split(",")
-                return lat, lon
-            else:
-                return None, None
-        else:
-            return lat_val, lon_val
-    # fields that may exist in the data
-    if "geocoded_latitude" not in row or "geocoded_longitude" not in row:
-        return None, None
-    elif pd.notna(row["geocoded_latitude"]) and pd.notna(row["geocoded_longitude"]):
-        return row["geocoded_latitude"], row["geocoded_longitude"]
-    else:
-        return None, None
+
+
+def iter_records(
+    config: models.DataSource, chunk_size: int, columns: list[str] | None = None
+) -> Generator[pd.DataFrame, None, None]:
+    """Stream the records from the wide-form dataset in chunks.
+
+    Args:
+        config: The data source config.
+        chunk_size: Records per chunk.
+        columns: Only read these columns, default all.
+
+    Yields:
+        df: The wide-form records of each chunk, typed as `read_records` types them.
+    """
+    path = Path("data") / config.temp_wide_parquet_filename
+    missing_integers = analyze.read_missing_integer_columns(path)
+    for chunk in analyze.iter_dense_wide(path, chunk_size, columns):
+        yield analyze.publish_types(chunk, missing_integers)
+
+
+def wide_columns(config: models.DataSource) -> list[str]:
+    """The columns of the wide-form dataset."""
+    return pq.read_schema(Path("data") / config.temp_wide_parquet_filename).names
+
+
+def source_crs(reference: models.SpatialReference) -> pyproj.CRS:
+    """Resolve an ArcGIS style wkid (EPSG or ESRI authority) to a CRS."""
+    try:
+        return pyproj.CRS.from_epsg(reference.wkid)
+    except pyproj.exceptions.CRSError:
+        return pyproj.CRS.from_user_input(f"ESRI:{reference.wkid}")
+
+
+def resolve_coordinates(
+    df: pd.DataFrame, config: models.GeoConfig
+) -> tuple[pd.Series, pd.Series]:
+    """Resolve a latitude and longitude for every record using column operations.
+
+    Source coordinates are preferred. The latitude field may hold a composite
+    "lat,lon" string, in which case it is split. Missing or zero coordinates fall
+    back to `geocoded_latitude`/`geocoded_longitude` when those columns exist.
+    Projected source coordinates (see `GeoConfig.coordinate_reference`) are
+    transformed to WGS84 in one batch.
+
+    Args:
+        df (pd.DataFrame): The wide-form records (lowercased column names).
+        config (models.GeoConfig): The spatial config for the source.
+
+    Returns:
+        tuple[pd.Series, pd.Series]: The latitude and longitude (float, NaN if unresolved).
+    """
+    lat_col = config.lat_field.lower().replace(" ", "_")
+    lon_col = config.lon_field.lower().replace(" ", "_")
+
+    lat_raw = df[lat_col].astype("string").str.replace(" ", "", regex=False)
+    lon_raw = df[lon_col].astype("string").str.replace(" ", "", regex=False)
+    composite = lat_raw.str.contains(",", regex=False, na=False)
+    if composite.any():
+        parts = lat_raw[composite].str.split(",", n=1, expand=True)
+        lat_raw = lat_raw.mask(composite, parts[0])
+        lon_raw = lon_raw.mask(composite, parts[1])
+    lat = pd.to_numeric(lat_raw, errors="coerce").astype("float64")
+    lon = pd.to_numeric(lon_raw, errors="coerce").astype("float64")
+
+    if config.coordinate_reference.wkid != 4326:
+        valid = lat.notna() & lon.notna()
+        transformer = pyproj.Transformer.from_crs(
+            source_crs(config.coordinate_reference), "EPSG:4326", always_xy=True
+        )
+        x, y = transformer.transform(lon[valid].to_numpy(), lat[valid].to_numpy())
+        lon[valid] = x
+        lat[valid] = y
+
+    # 0 is used as "missing" by some sources, same as in geocode.read_records
+    missing = lat.isna() | lon.isna() | (lat == 0) | (lon == 0)
+    lat = lat.mask(missing)
+    lon = lon.mask(missing)
+    if "geocoded_latitude" in df.columns and "geocoded_longitude" in df.columns:
+        geo_lat = pd.to_numeric(df["geocoded_latitude"], errors="coerce")
+        geo_lon = pd.to_numeric(df["geocoded_longitude"], errors="coerce")
+        use_geocoded = missing & geo_lat.notna() & geo_lon.notna()
+        lat = lat.mask(use_geocoded, geo_lat)
+        lon = lon.mask(use_geocoded, geo_lon)
+    return lat, lon
 
 
 def configure_source_data(df: pd.DataFrame, config: models.GeoConfig) -> pd.DataFrame:
     """Configure the source data for the spatial joins."""
-    coordinates = df.apply(lambda row: apply_composite_lat_long(row, config), axis=1)
+    lat, lon = resolve_coordinates(df, config)
     dff = df.copy()
-    dff["composite_latitude"] = coordinates.apply(lambda x: x[0])
-    dff["composite_longitude"] = coordinates.apply(lambda x: x[1])
+    dff["composite_latitude"] = lat
+    dff["composite_longitude"] = lon
     return dff
 
 
@@ -73,49 +142,279 @@ def convert_to_geodataframe(df: pd.DataFrame) -> geopandas.GeoDataFrame:
     return geo_df
 
 
+def clip_extent(config: models.GeoConfig) -> tuple[float, float, float, float]:
+    """The source's `GeoBounds` plus `CLIP_MARGIN`, in WGS84."""
+    bounds = config.bounds
+    if bounds.spatial_reference.wkid == 4326:
+        return bounds.extent(CLIP_MARGIN)
+    transformer = pyproj.Transformer.from_crs(
+        source_crs(bounds.spatial_reference), "EPSG:4326", always_xy=True
+    )
+    xmin, ymin, xmax, ymax = transformer.transform_bounds(*bounds.extent())
+    return (
+        xmin - CLIP_MARGIN,
+        ymin - CLIP_MARGIN,
+        xmax + CLIP_MARGIN,
+        ymax + CLIP_MARGIN,
+    )
+
+
+def flag_out_of_bounds(
+    geo_df: pd.DataFrame, extent: tuple[float, float, float, float]
+) -> pd.DataFrame:
+    """Flag points outside the clip extent in an `outside_bounds` column.
+
+    Points without coordinates are not flagged.
+    """
+    xmin, ymin, xmax, ymax = extent
+    lat = geo_df["composite_latitude"]
+    lon = geo_df["composite_longitude"]
+    geo_df["outside_bounds"] = (
+        lat.notna() & lon.notna() & ~(lat.between(ymin, ymax) & lon.between(xmin, xmax))
+    )
+    return geo_df
+
+
 def fetch_tracts(fips_code: str) -> geopandas.GeoDataFrame:
     """Fetch Census Tracts geodataframes
 
+    Served from the preprocessed GeoParquet cache, see `census_layers`.
+
     Args:
         fips_code (str): The Census FIPS Code (i.e. 17 for Illinois)
 
     Returns:
         geopandas.GeoDataFrame: The census tracts geodataframe
     """
-    fpath = Path().cwd() / "data" / "spatial" / f"tl_2024_{fips_code}_tract.zip"
-    dataset: geopandas.GeoDataFrame = geopandas.read_file(fpath).to_crs("EPSG:4326")
-    return dataset
+    return census_layers.load_tracts(fips_code)
+
 
+def clip_spec(
+    config: models.GeoConfig,
+) -> tuple[tuple[float, float, float, float], tuple[str, ...] | None]:
+    """The clip extent and county filter for a source's tract layer."""
+    counties = (
+        tuple(config.county_fips_codes)
+        if config.county_fips_codes is not None
+        else None
+    )
+    return clip_extent(config), counties
 
-def run(config: models.Settings) -> None:
+
+def layer_spec(
+    data_source: models.DataSource,
+) -> tuple[
+    str, tuple[float, float, float, float], tuple[str, ...] | None, tuple[str, ...]
+]:
+    """The `enrichment` arguments for a source: FIPS code, clip spec and geographies."""
+    spatial_config = data_source.spatial_config
+    extent, counties = clip_spec(spatial_config)
+    geographies = tuple(dict.fromkeys(spatial_config.geographies))
+    return data_source.state_fips_code, extent, counties, geographies
+
+
+def join_frame(
+    df: pd.DataFrame, data_source: models.DataSource, memo: bool = True
+) -> geopandas.GeoDataFrame:
+    """Spatially join a source's wide-form records in memory.
+
+    Args:
+        df (pd.DataFrame): The wide-form records (see `read_records`).
+        data_source (models.DataSource): The data source config.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+
+    Returns:
+        geopandas.GeoDataFrame: The records with their coordinates, points and
+            geographies.
+    """
+    spatial_config = data_source.spatial_config
+    spec = layer_spec(data_source)
+    extent = spec[1]
+    df = configure_source_data(df, spatial_config)
+    geo_df = convert_to_geodataframe(df)
+    console.log(f"Starting shape -> Rows: {geo_df.shape[0]} Columns: {geo_df.shape[1]}")
+    geo_df = flag_out_of_bounds(geo_df, extent)
+    console.log(
+        f"{geo_df['outside_bounds'].sum():,} points are outside the bounds of {data_source.name}"
+    )
+    geo_df = pd.concat([geo_df, enrichment.enrich(geo_df, *spec, memo=memo)], axis=1)
+    console.log(f"Updated shape -> Rows: {geo_df.shape[0]} Columns: {geo_df.shape[1]}")
+    return geo_df
+
+
+def join_source(data_source: models.DataSource, memo: bool = True) -> None:
+    """Spatially join a source in memory and write its wide-form file.
+
+    Args:
+        data_source (models.DataSource): The data source config.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+    """
+    geo_df = join_frame(read_records(data_source), data_source, memo=memo)
+
+    console.log("Writing to file...")
+    geo_df.to_csv(Path("data") / data_source.wide_form_filename, index=False)
+
+
+def locate_chunk(
+    coordinates: pd.DataFrame,
+    spec: tuple[
+        str, tuple[float, float, float, float], tuple[str, ...] | None, tuple[str, ...]
+    ],
+    memo: bool,
+) -> dict[str, np.ndarray]:
+    """Worker task: layer positions for a chunk of coordinates.
+
+    The lookups are loaded from their on-disk index once per worker process.
+    """
+    return enrichment.locate(coordinates, *spec, memo=memo)
+
+
+def coordinate_columns(config: models.GeoConfig, header: list[str]) -> list[str]:
+    """The columns of the wide-form file needed to resolve coordinates."""
+    wanted = [
+        "CaseIdentifier",
+        config.lat_field.lower().replace(" ", "_"),
+        config.lon_field.lower().replace(" ", "_"),
+        "geocoded_latitude",
+        "geocoded_longitude",
+    ]
+    return [col for col in dict.fromkeys(wanted) if col in header]
+
+
+def assign_geographies_chunked(
+    data_source: models.DataSource,
+    workers: int | None,
+    chunk_size: int,
+    memo: bool = True,
+) -> pd.DataFrame:
+    """Assign geographies reading only the ID and coordinate columns, in a process pool.
+
+    Args:
+        data_source (models.DataSource): The data source config.
+        workers (int | None): Number of worker processes, defaults to the CPU count.
+        chunk_size (int): Records per chunk.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+
+    Returns:
+        pd.DataFrame: Composite coordinates, `outside_bounds` and geography
+            columns, indexed by `CaseIdentifier`.
+    """
+    spatial_config = data_source.spatial_config
+    spec = layer_spec(data_source)
+    extent = spec[1]
+
+    columns = coordinate_columns(spatial_config, wide_columns(data_source))
+    chunks: list[tuple[pd.DataFrame, Future[dict[str, np.ndarray]]]] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # build (and save) the lookups up front so workers only load them
+        no_points = pd.DataFrame(
+            {"composite_latitude": [], "composite_longitude": []}, dtype="float64"
+        )
+        empty = enrichment.locate(no_points, *spec, memo=memo)
+        for chunk in iter_records(data_source, chunk_size, columns):
+            lat, lon = resolve_coordinates(chunk, spatial_config)
+            coordinates = flag_out_of_bounds(
+                pd.DataFrame(
+                    {
+                        "CaseIdentifier": chunk["CaseIdentifier"],
+                        "composite_latitude": lat,
+                        "composite_longitude": lon,
+                    }
+                ),
+                extent,
+            )
+            future = pool.submit(locate_chunk, coordinates, spec, memo)
+            chunks.append((coordinates, future))
+        results = [future.result() for _, future in chunks]
+    positions = {
+        layer: np.concatenate([empty[layer]] + [result[layer] for result in results])
+        for layer in empty
+    }
+    coordinates = pd.concat([c for c, _ in chunks], ignore_index=True)
+    console.log(
+        f"{coordinates['outside_bounds'].sum():,} points are outside the bounds of {data_source.name}"
+    )
+    lon, _ = enrichment.point_arrays(coordinates)
+    enrichment.log_memo_stats(positions, ~np.isnan(lon))
+    assignments = pd.concat(
+        [coordinates, enrichment.attributes(positions, coordinates.index, *spec)],
+        axis=1,
+    )
+    return assignments.set_index("CaseIdentifier")
+
+
+def join_source_chunked(
+    data_source: models.DataSource,
+    workers: int | None,
+    chunk_size: int,
+    memo: bool = True,
+) -> None:
+    """Spatially join a source chunk by chunk and write its wide-form file.
+
+    Geographies are assigned from the ID and coordinate columns only (see
+    `assign_geographies_chunked`), then the wide table is streamed through in chunks
+    and joined to them on `CaseIdentifier`, so peak memory stays flat as
+    sources grow.
+
+    Args:
+        data_source (models.DataSource): The data source config.
+        workers (int | None): Number of worker processes, defaults to the CPU count.
+        chunk_size (int): Records per chunk.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+    """
+    assignments = assign_geographies_chunked(data_source, workers, chunk_size, memo)
+    console.log("Writing to file...")
+    out_path = Path("data") / data_source.wide_form_filename
+    for i, chunk in enumerate(iter_records(data_source, chunk_size)):
+        joined = assignments.reindex(chunk["CaseIdentifier"])
+        joined.index = chunk.index
+        coordinates = ["composite_latitude", "composite_longitude"]
+        geo_df = convert_to_geodataframe(
+            pd.concat([chunk, joined[coordinates]], axis=1)
+        )
+        geo_df = pd.concat([geo_df, joined.drop(columns=coordinates)], axis=1)
+        geo_df.to_csv(out_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+
+def run(
+    config: models.Settings,
+    chunked: bool = False,
+    workers: int | None = None,
+    chunk_size: int = 50_000,
+    memo: bool = True,
+) -> None:
     """Run the spatial join.
+
     Args:
         config (models.Settings): The settings for the app.
+        chunked (bool): Join in chunks across a process pool to keep memory flat.
+        workers (int | None): Number of worker processes for `chunked`, defaults to the CPU count.
+        chunk_size (int): Records per chunk for `chunked`.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
     """
     for data_source in config.sources:
-        tracts_geodf = fetch_tracts(fips_code=data_source.state_fips_code)
-        if data_source.spatial_config is None:
+        if not data_source.needs_spatial_join:
             console.log(f"{data_source.name} needs no spatial joining")
             console.log("Writing to file...")
-            pd.read_csv(
-                Path("data") / data_source.temp_wide_filename, low_memory=False
-            ).to_csv(Path("data") / data_source.wide_form_filename, index=False)
+            out_path = Path("data") / data_source.wide_form_filename
+            if chunked:
+                for i, chunk in enumerate(iter_records(data_source, chunk_size)):
+                    chunk.to_csv(
+                        out_path,
+                        mode="w" if i == 0 else "a",
+                        header=i == 0,
+                        index=False,
+                    )
+            else:
+                read_records(data_source).to_csv(out_path, index=False)
             continue
         console.log(f"Spatially joining {data_source.name}")
-        records = read_records(data_source)
-        df = pd.DataFrame(records)
-        df = configure_source_data(df, data_source.spatial_config)
-        geo_df = convert_to_geodataframe(df)
-        console.log(
-            f"Starting shape -> Rows: {geo_df.shape[0]} Columns: {geo_df.shape[1]}"
-        )
-        geo_df = geopandas.sjoin(geo_df, tracts_geodf, how="left", predicate="within")
-        console.log(
-            f"Updated shape -> Rows: {geo_df.shape[0]} Columns: {geo_df.shape[1]}"
-        )
-
-        console.log("Writing to file...")
-        geo_df.to_csv(Path("data") / data_source.wide_form_filename, index=False)
+        if chunked:
+            join_source_chunked(
+                data_source, workers=workers, chunk_size=chunk_size, memo=memo
+            )
+        else:
+            join_source(data_source, memo=memo)
         console.log("Done!")
 
 
@@ -0,0 +1,446 @@
+"""This module contains a local stand-in for the web services the pipeline talks to.
+
+It serves the three response shapes the package relies on:
+
+- ArcGIS `findAddressCandidates` (used by `geocode`)
+- ArcGIS FeatureServer/MapServer `query` (used by `fetch` for paginated sources)
+- Socrata `query.json` / `resource/<id>.json` (the open data portals)
+
+Faults (latency, 429 throttling, 5xx errors, ArcGIS style error bodies and
+hung connections) are injected at configurable rates so the retry logic in
+`geocode.get_geo_result` and `fetch.get_record_set` can be exercised without
+touching the real endpoints.
+
+The harness (`run_harness`) drives the *real* code paths against the stand-in
+and reports requests/sec, p50/p99 latency and retry counts.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Awaitable, Callable
+
+import httpx
+import orjson
+from pydantic import BaseModel, Field
+
+from opendata_pipeline import fetch, geocode, models
+from opendata_pipeline.utils import console, percentile
+
+GEOCODE_PATH = "/arcgis/rest/services/World/GeocodeServer/findAddressCandidates"
+"""Path of the stand-in geocoding endpoint."""
+
+FEATURE_PATH = "/arcgis/rest/services/StandIn/FeatureServer/0/query"
+"""Path of the stand-in paginated (FeatureServer) endpoint."""
+
+SOCRATA_PATH = "/api/v3/views/stand-in/query.json"
+"""Path of the stand-in Socrata endpoint."""
+
+STAND_IN_BOUNDS = models.GeoBounds(
+    xmin=-88.3,
+    xmax=-87.5,
+    ymin=41.4,
+    ymax=42.2,
+    spatial_reference=models.SpatialReference(wkid=4326),
+)
+"""Bounds used for the synthetic geocoding requests (Cook County)."""
+
+
+class StandInConfig(BaseModel):
+    """Fault injection and sizing options for the stand-in server."""
+
+    latency_ms: float = Field(0, description="Base latency added to every response")
+    """Base latency (milliseconds) added to every response."""
+    jitter_ms: float = Field(0, description="Uniform random latency added on top")
+    """Uniform random latency (milliseconds) added on top of `latency_ms`."""
+    throttle_rate: float = Field(0, description="Fraction of requests answered 429")
+    """Fraction of requests answered with `429 Too Many Requests`."""
+    error_rate: float = Field(0, description="Fraction of requests answered 5xx")
+    """Fraction of requests answered with a 500/502/503."""
+    error_body_rate: float = Field(
+        0, description="Fraction of requests answered 200 with an ArcGIS error body"
+    )
+    """Fraction of requests answered `200` with an ArcGIS `{"error": ...}` body."""
+    timeout_rate: float = Field(0, description="Fraction of requests that hang")
+    """Fraction of requests that hang for `hang_seconds` before answering."""
+    hang_seconds: float = Field(30, description="How long a hung request stalls")
+    """How long (seconds) a hung request stalls before answering."""
+    no_match_rate: float = Field(
+        0, description="Fraction of geocode requests returning no candidates"
+    )
+    """Fraction of geocode requests that return no candidates."""
+    page_size: int = Field(1000, description="Max records returned per page")
+    """Max records returned per page, like the ArcGIS `maxRecordCount`."""
+    total_records: int = Field(5000, description="Records served by paged endpoints")
+    """Number of synthetic records served by the paged endpoints."""
+    seed: int | None = Field(None, description="Seed for the fault injection")
+    """Seed for the fault injection, for reproducible runs."""
+
+
+class StandInServer(ThreadingHTTPServer):
+    """A threaded HTTP server holding the stand-in config and request counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], config: StandInConfig):
+        super().__init__(address, StandInHandler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.hits: Counter[tuple[str, str]] = Counter()
+
+    @property
+    def base_url(self) -> str:
+        """The root url the server is listening on."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, endpoint: str, outcome: str) -> None:
+        """Count a response for `endpoint` with the given `outcome`."""
+        with self.lock:
+            self.hits[(endpoint, outcome)] += 1
+
+    def requests_for(self, endpoint: str) -> int:
+        """Total requests the server has seen for `endpoint`."""
+        with self.lock:
+            return sum(v for (e, _), v in self.hits.items() if e == endpoint)
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # clients that timed out on a hung request close the socket under us
+        pass
+
+    def draw(self) -> float:
+        """Thread-safe uniform draw used for the fault injection."""
+        with self.lock:
+            return self.random.random()
+
+
+def synthetic_record(index: int) -> dict[str, Any]:
+    """Build a deterministic fake medical examiner record."""
+    return {
+        "CaseNum": f"SI-{index:07d}",
+        "DeathDate": 1_577_836_800_000 + index * 3_600_000,
+        "CauseA": "acute combined fentanyl and cocaine toxicity",
+        "CauseB": None,
+        "DeathAddr": f"{100 + index % 9000} W Stand In St",
+        "DeathCity": "Chicago",
+        "DeathZip": "60601",
+    }
+
+
+def geocode_candidate(single_line: str, extent: str | None) -> dict[str, Any]:
+    """Deterministically place an address inside the requested search extent."""
+    bounds = STAND_IN_BOUNDS.model_dump()
+    if extent:
+        try:
+            bounds = orjson.loads(extent)
+        except orjson.JSONDecodeError:
+            pass
+    digest = hashlib.sha1(single_line.encode("utf-8")).digest()
+    fx = int.from_bytes(digest[:4], "big") / 2**32
+    fy = int.from_bytes(digest[4:8], "big") / 2**32
+    return {
+        "address": single_line.title(),
+        "location": {
+            "x": bounds["xmin"] + fx * (bounds["xmax"] - bounds["xmin"]),
+            "y": bounds["ymin"] + fy * (bounds["ymax"] - bounds["ymin"]),
+        },
+        "score": 90 + digest[8] % 11,
+        "attributes": {},
+    }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler answering in the shapes the pipeline expects."""
+
+    server: StandInServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # keep the console quiet, counters are reported by the harness
+        pass
+
+    def send_json(self, status: int, payload: Any) -> None:
+        body = orjson.dumps(payload)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_fault(self, endpoint: str) -> bool:
+        """Apply latency and maybe answer with a fault. Returns True if answered."""
+        config = self.server.config
+        delay = config.latency_ms + self.server.draw() * config.jitter_ms
+        if delay:
+            time.sleep(delay / 1000)
+        if self.server.draw() < config.timeout_rate:
+            self.server.record(endpoint, "hang")
+            time.sleep(config.hang_seconds)
+            self.send_json(504, {"error": {"code": 504, "message": "Timeout"}})
+            return True
+        if self.server.draw() < config.throttle_rate:
+            self.server.record(endpoint, "429")
+            self.send_json(429, {"error": {"code": 429, "message": "Throttled"}})
+            return True
+        if self.server.draw() < config.error_rate:
+            status = (500, 502, 503)[int(self.server.draw() * 3)]
+            self.server.record(endpoint, str(status))
+            self.send_json(status, {"error": {"code": status, "message": "Error"}})
+            return True
+        if endpoint != "socrata" and self.server.draw() < config.error_body_rate:
+            # ArcGIS likes to report errors with a 200
+            self.server.record(endpoint, "error_body")
+            self.send_json(200, {"error": {"code": 498, "message": "Invalid token"}})
+            return True
+        return False
+
+    def do_GET(self) -> None:
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        if parsed.path == GEOCODE_PATH:
+            self.handle_geocode(params)
+        elif parsed.path.endswith("/query") and (
+            "/FeatureServer/" in parsed.path or "/MapServer/" in parsed.path
+        ):
+            self.handle_features(params)
+        elif parsed.path.endswith("/query.json") or parsed.path.startswith(
+            "/resource/"
+        ):
+            self.handle_socrata(params)
+        else:
+            self.server.record("unknown", "404")
+            self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def handle_geocode(self, params: dict[str, str]) -> None:
+        if self.inject_fault("geocode"):
+            return
+        config = self.server.config
+        candidates = []
+        if self.server.draw() >= config.no_match_rate:
+            candidates.append(
+                geocode_candidate(
+                    params.get("SingleLine", ""), params.get("searchExtent")
+                )
+            )
+        self.server.record("geocode", "200")
+        self.send_json(
+            200,
+            {
+                "spatialReference": {"wkid": 4326, "latestWkid": 4326},
+                "candidates": candidates,
+            },
+        )
+
+    def handle_features(self, params: dict[str, str]) -> None:
+        if self.inject_fault("features"):
+            return
+        config = self.server.config
+        offset = int(params.get("resultOffset", 0))
+        count = min(
+            int(params.get("resultRecordCount", config.page_size)), config.page_size
+        )
+        stop = min(offset + count, config.total_records)
+        features = [{"attributes": synthetic_record(i)} for i in range(offset, stop)]
+        self.server.record("features", "200")
+        self.send_json(
+            200,
+            {
+                "objectIdFieldName": "OBJECTID",
+                "features": features,
+                "exceededTransferLimit": stop < config.total_records,
+            },
+        )
+
+    def handle_socrata(self, params: dict[str, str]) -> None:
+        if self.inject_fault("socrata"):
+            return
+        config = self.server.config
+        offset = int(params.get("$offset", 0))
+        limit = min(int(params.get("$limit", config.page_size)), config.page_size)
+        stop = min(offset + limit, config.total_records)
+        self.server.record("socrata", "200")
+        self.send_json(200, [synthetic_record(i) for i in range(offset, stop)])
+
+
+def start_server(
+    config: StandInConfig, host: str = "127.0.0.1", port: int = 0
+) -> StandInServer:
+    """Start the stand-in server on a background thread.
+
+    Args:
+        config (StandInConfig): The fault injection config.
+        host (str): Host to bind to.
+        port (int): Port to bind to, 0 picks a free port.
+
+    Returns:
+        StandInServer: The running server, call `shutdown()` when done.
+    """
+    server = StandInServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    console.log(f"Stand-in server listening on {server.base_url}")
+    return server
+
+
+class HarnessReport(BaseModel):
+    """Throughput and latency numbers for one endpoint."""
+
+    endpoint: str
+    calls: int
+    """Logical calls made by the pipeline code."""
+    failures: int
+    """Calls that raised (e.g. exceeded max retries)."""
+    server_requests: int
+    """HTTP requests the stand-in server actually received."""
+    elapsed_seconds: float
+    p50_ms: float
+    p99_ms: float
+
+    @property
+    def retries(self) -> int:
+        """Extra HTTP requests caused by the retry logic."""
+        return max(self.server_requests - self.calls, 0)
+
+    @property
+    def requests_per_second(self) -> float:
+        """Logical calls completed per second."""
+        if self.elapsed_seconds == 0:
+            return 0.0
+        return self.calls / self.elapsed_seconds
+
+
+async def time_calls(
+    calls: list[Callable[[], Awaitable[Any]]], concurrency: int
+) -> tuple[list[float], int, float]:
+    """Run the calls with bounded concurrency, timing each one.
+
+    Returns:
+        tuple[list[float], int, float]: latencies (ms), failure count, wall time (s)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    failures = 0
+
+    async def timed(call: Callable[[], Awaitable[Any]]) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call()
+            except Exception as e:
+                failures += 1
+                console.log(f"[red]Call failed: {e!r}")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    return latencies, failures, time.perf_counter() - start
+
+
+async def run_harness(
+    server: StandInServer,
+    geocode_calls: int = 200,
+    page_calls: int = 10,
+    concurrency: int = 10,
+    client_timeout: float = 20,
+    retry_delay: float = 0.1,
+    max_retries: int = 5,
+    hedger: geocode.RequestHedger | None = None,
+) -> list[HarnessReport]:
+    """Drive the real geocode and fetch code paths against the stand-in server.
+
+    Args:
+        server (StandInServer): A running stand-in server.
+        geocode_calls (int): Number of `get_geo_result` calls to make.
+        page_calls (int): Number of `get_record_set` pages to fetch.
+        concurrency (int): Max concurrent calls.
+        client_timeout (float): httpx timeout, lower than `hang_seconds` to exercise timeouts.
+        retry_delay (float): Passed to `get_geo_result`; the production default is 10s.
+        max_retries (int): Passed to `get_geo_result`.
+        hedger (geocode.RequestHedger | None): Hedges the geocoding calls if given.
+
+    Returns:
+        list[HarnessReport]: One report per endpoint.
+    """
+    reports: list[HarnessReport] = []
+    async with httpx.AsyncClient(
+        timeout=httpx.Timeout(client_timeout),
+        limits=httpx.Limits(max_connections=concurrency),
+        trust_env=False,
+    ) as client:
+        geocode_url = server.base_url + GEOCODE_PATH
+        calls: list[Callable[[], Awaitable[Any]]] = []
+        for i in range(geocode_calls):
+            url = geocode.build_url(
+                bounds=STAND_IN_BOUNDS,
+                address_data={"Address": f"{i} W Stand In St", "City": "Chicago"},
+                key="stand-in",
+                base_url=geocode_url,
+            )
+            call = functools.partial(
+                geocode.get_geo_result,
+                client=client,
+                url=url,
+                id_=i,
+                data_source_name="Stand In",
+                max_retries=max_retries,
+                retry_delay=retry_delay,
+            )
+            if hedger is not None:
+                call = functools.partial(hedger.run, call)
+            calls.append(call)
+        before = server.requests_for("geocode")
+        latencies, failures, elapsed = await time_calls(calls, concurrency)
+        reports.append(
+            HarnessReport(
+                endpoint="geocode",
+                calls=geocode_calls,
+                failures=failures,
+                server_requests=server.requests_for("geocode") - before,
+                elapsed_seconds=elapsed,
+                p50_ms=percentile(latencies, 50),
+                p99_ms=percentile(latencies, 99),
+            )
+        )
+
+        feature_url = server.base_url + FEATURE_PATH + "?f=json&where=1%3D1&outFields=*"
+        calls = [
+            lambda offset=offset: fetch.get_record_set(
+                client, fetch.build_url(offset=offset, base_url=feature_url)
+            )
+            for offset in range(0, page_calls * 1000, 1000)
+        ]
+        before = server.requests_for("features")
+        latencies, failures, elapsed = await time_calls(calls, concurrency)
+        reports.append(
+            HarnessReport(
+                endpoint="features",
+                calls=page_calls,
+                failures=failures,
+                server_requests=server.requests_for("features") - before,
+                elapsed_seconds=elapsed,
+                p50_ms=percentile(latencies, 50),
+                p99_ms=percentile(latencies, 99),
+            )
+        )
+    return reports
+
+
+def log_reports(reports: list[HarnessReport]) -> None:
+    """Log the harness reports to the console."""
+    for report in reports:
+        console.log(
+            f"[bold]{report.endpoint}[/bold] -> "
+            f"{report.requests_per_second:,.1f} req/s | "
+            f"p50 {report.p50_ms:,.1f} ms | p99 {report.p99_ms:,.1f} ms | "
+            f"calls {report.calls:,} | retries {report.retries:,} | "
+            f"failures {report.failures:,}"
+        )
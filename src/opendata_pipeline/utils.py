@@ -1,7 +1,10 @@
 """This module contains some very minimal utility functions."""
 
+import math
 from pathlib import Path
 import shutil
+from typing import Sequence
+
 from rich.console import Console
 
 
@@ -20,3 +23,20 @@ def teardown():
     p = Path("data")
     shutil.rmtree(p)
     Path("extracted_drugs.jsonl").unlink()
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of `values`.
+
+    Args:
+        values (Sequence[float]): The observations, in any order.
+        q (float): The percentile to compute, between 0 and 100.
+
+    Returns:
+        float: The percentile, or `nan` when there are no observations.
+    """
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
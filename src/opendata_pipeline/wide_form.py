@@ -0,0 +1,91 @@
+"""This module builds the wide-form deliverable of each source in one pass.
+
+Run separately, `analyze` writes the combined data to Parquet and the spatial
+join reads it back, only to write the wide-form file. Here the combined data
+stays in memory: it is densified, spatially joined when the source needs it,
+and written to `<source>_wide_form.csv` once.
+
+The analysis step files and the wide-form Parquet file (which the release
+reads the drug flags from) are still written, the temporary CSV is not.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Optional
+
+from opendata_pipeline import analyze, models, spatial_join
+from opendata_pipeline.utils import console
+
+
+def build_source(
+    data_source: models.DataSource, memo: bool = True, engine: str = "pandas"
+) -> analyze.SourceAnalysis:
+    """Builds one source's wide-form file.
+
+    Args:
+        data_source (models.DataSource): The source config.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+        engine (str): The analyze engine, `pandas` or `polars`.
+
+    Returns:
+        analyze.SourceAnalysis: The record count and step timings.
+    """
+    result = analyze.SourceAnalysis(source=data_source.name)
+    wide_df, integer_columns = analyze.BUILDERS[engine](data_source, result)
+    analyze.write_wide_parquet(
+        wide_df,
+        Path("data") / data_source.temp_wide_parquet_filename,
+        integer_columns,
+    )
+    # never leave a stale CSV next to the Parquet file
+    (Path("data") / data_source.temp_wide_filename).unlink(missing_ok=True)
+    df = analyze.densify(wide_df, integer_columns).reset_index()
+    df = analyze.publish_types(df, analyze.missing_integer_columns(df))
+    result.step("write wide")
+
+    if data_source.needs_spatial_join:
+        console.log(f"Spatially joining {data_source.name}")
+        df = spatial_join.join_frame(df, data_source, memo=memo)
+        result.step("spatial join")
+    else:
+        console.log(f"{data_source.name} needs no spatial joining")
+
+    console.log("Writing to file...")
+    df.to_csv(Path("data") / data_source.wide_form_filename, index=False)
+    result.step("write wide form")
+    return result
+
+
+def run(
+    settings: models.Settings,
+    workers: int = 1,
+    max_memory_gb: Optional[float] = None,
+    memo: bool = True,
+    engine: str = "pandas",
+) -> None:
+    """Builds the wide-form file of every source.
+
+    Args:
+        settings (models.Settings): The settings.
+        workers (int): Sources built at once, 1 to build them in turn in this
+            process (see `analyze.run_sources`).
+        max_memory_gb (Optional[float]): Memory the running sources may use,
+            defaults to most of the available memory.
+        memo (bool): Reuse point lookups from previous runs (see `point_memo`).
+        engine (str): The analyze engine, `pandas` or `polars` (see `analyze_polars`).
+
+    Raises:
+        ValueError: If the engine is unknown.
+        RuntimeError: If any source failed.
+    """
+    if engine not in analyze.ENGINES:
+        raise ValueError(f"engine must be one of {analyze.ENGINES}, got {engine!r}")
+    analyze.partition_artifacts(settings=settings)
+    results = analyze.run_sources(
+        build_source, settings.sources, workers, max_memory_gb, memo, engine
+    )
+    analyze.log_source_analyses(results)
+    failed = [result.source for result in results if result.error is not None]
+    if failed:
+        raise RuntimeError(f"Building the wide form failed for {', '.join(failed)}")